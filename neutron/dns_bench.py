@@ -0,0 +1,495 @@
+#! /usr/bin/python
+#
+# File:     dns_bench.py
+# Brief:    Benchmark dns_tools extract on synthetic syslog.
+#
+# Copyright (c) 2015, Cisco Systems
+
+import sys
+import os
+import time
+import gzip
+import json
+import random
+import resource
+import shutil
+import multiprocessing
+from optparse import OptionParser
+import dns_tools
+from dns_tools import logger
+
+""" ===========================================================
+Configurations
+=========================================================== """
+
+BENCH_DIR = '/tmp/dns_bench/'
+BENCH_SEED = 2015
+BENCH_HOST = 'net-001'
+BENCH_META = '.bench.json'
+
+SIZES_DEFAULT = '100M,1G,10G'
+MODES = ['serial', 'jobs', 'since', 'checkpoint', 'metrics', 'rotated']
+MODES_DEFAULT = ['serial', 'jobs', 'since', 'checkpoint', 'metrics']
+PIDS_DEFAULT = 500
+SERVERS_DEFAULT = 3
+JOBS_DEFAULT = multiprocessing.cpu_count()
+
+DUMP_PERIOD = 300           # seconds between cache dumps of each dnsmasq
+DUMP_CONCURRENT = 4         # dnsmasq dumping at the same time, lines interleave
+NOISE_RATIO = 0.5           # unrelated lines per cache dump line
+RESTART_RATE = 0.001        # chance of a dnsmasq restart per dump
+ROTATED_PARTS = 3           # syslog.2.gz, syslog.1 and syslog
+
+UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+""" ===========================================================
+Synthetic Syslog
+Writes cache dumps of many dnsmasq every DUMP_PERIOD seconds, a few of
+them interleaved line by line, among unrelated lines, some of which come
+from dnsmasq itself. A dnsmasq now and then restarts with a new pid and
+counters from zero. The time stamps end about now, so checkpoints keep
+them. With rotated, the same lines are also split into a rotated set,
+the oldest part compressed, the cut falling inside a dump.
+A description of what was written is kept next to the log, so a log of
+the same size and parameters is reused by the next run. It has, for each
+tick, the number of cache dumps and of queries since the previous dump
+of the same dnsmasq, from which the records and queries an extract from
+any tick on should find are known.
+=========================================================== """
+
+NOISE = [
+    "kernel: [%d.123456] device tap%d entered promiscuous mode\n",
+    "CRON[%d]: (root) CMD (command -v debian-sa1 > /dev/null && debian-sa1 1 1) %d\n",
+    "dnsmasq-dhcp[%d]: DHCPREQUEST(tap%d) 10.0.0.5 fa:16:3e:12:34:56\n",
+    "dnsmasq[%d]: reading /etc/resolv.conf %d\n",
+    "dnsmasq[%d]: query[A] host-%d.openstacklocal from 10.0.0.5\n",
+]
+
+
+class LogGen(object):
+    def __init__(self, path, size, pids=PIDS_DEFAULT, servers=SERVERS_DEFAULT,
+                 rotated=False, seed=BENCH_SEED):
+        """
+        path        log file to write
+        size        number of bytes to write, stopping after the dump that reaches it
+        pids        number of dnsmasq running at a time
+        servers     number of upstream servers of each dnsmasq
+        rotated     also write the lines as a rotated set in a directory next to path
+        """
+        self.path = path
+        self.size = size
+        self.pids = pids
+        self.servers = servers
+        self.rotated = rotated
+        self.seed = seed
+        self.rng = random.Random(seed)
+        self.meta = None
+        self.ticks = []
+        self.dumped = set()
+
+    def params(self):
+        return {'size': self.size, 'pids': self.pids, 'servers': self.servers, 'seed': self.seed,
+                'rotated': self.rotated}
+
+    def load(self):
+        """
+        Return True if a log of the same parameters was written before.
+        """
+        meta = self.path + BENCH_META
+        if not os.path.isfile(meta):
+            return False
+        with open(meta) as f:
+            saved = json.load(f)
+        if saved['params'] != self.params() or 'ticks' not in saved:
+            return False
+        if not all(os.path.isfile(name) for name in saved['files']):
+            return False
+        self.meta = saved
+        return True
+
+    def rotated_files(self):
+        """
+        Return names of the rotated set, oldest first.
+        """
+        base = os.path.join(os.path.dirname(self.path), 'rotated', os.path.basename(self.path))
+        names = ['%s.%d' % (base, i) for i in range(ROTATED_PARTS - 1, 0, -1)] + [base]
+        names[0] = names[0] + '.gz'
+        return names
+
+    def counters(self):
+        return [0, 0, self.rng.choice([150, 1000, 10000]), 0, 0,
+                [[0, 0] for i in range(self.servers)]]
+
+    def dump(self, prefix, pid, ts, c):
+        """
+        Advance counters c of pid and return lines of its cache dump at ts.
+        """
+        rng = self.rng
+        c[0] = c[0] + rng.randint(0, 60)
+        c[1] = c[1] + rng.randint(0, 30)
+        c[4] = c[4] + rng.randint(0, 20)
+        c[3] = c[3] + rng.randint(0, 2)
+        head = "%s dnsmasq[%d]: " % (prefix, pid)
+        lines = [head + "time %d\n" % ts,
+                 head + "cache size %d, %d/%d cache insertions re-used unexpired cache entries.\n" %
+                 (c[2], c[3], c[4]),
+                 head + "queries forwarded %d, queries answered locally %d\n" % (c[0], c[1])]
+        for i, server in enumerate(c[5]):
+            server[0] = server[0] + rng.randint(0, 30)
+            server[1] = server[1] + rng.randint(0, 1)
+            lines.append(head + "server 10.%d.0.1#53: queries sent %d, retried or failed %d\n" %
+                         (i, server[0], server[1]))
+        return lines
+
+    def tick(self, ts):
+        """
+        Return text of the dumps of all dnsmasq at ts, with noise.
+        Append [ts, number of dumps, queries since the previous dumps] to self.ticks.
+        """
+        rng = self.rng
+        queries = 0
+        t = time.localtime(ts)
+        prefix = "%s %2d %s %s" % (time.strftime('%b', t), t.tm_mday, time.strftime('%H:%M:%S', t), BENCH_HOST)
+        pids = list(self.running)
+        rng.shuffle(pids)
+        out = []
+        for i in range(0, len(pids), DUMP_CONCURRENT):
+            dumps = []
+            for pid in pids[i:i + DUMP_CONCURRENT]:
+                if rng.random() < RESTART_RATE:
+                    c = self.running.pop(pid)
+                    pid = self.next_pid
+                    self.next_pid = self.next_pid + 1
+                    self.running[pid] = self.counters()
+                    out.append("%s dnsmasq[%d]: started, version 2.66 cachesize %d\n" % (prefix, pid, c[2]))
+                c = self.running[pid]
+                before = c[0] + c[1]
+                dumps.append(self.dump(prefix, pid, ts, c))
+                if pid in self.dumped:
+                    queries = queries + c[0] + c[1] - before
+                self.dumped.add(pid)
+            for lines in zip(*dumps):
+                out.extend(lines)
+            for j in range(int(sum(map(len, dumps)) * NOISE_RATIO)):
+                n = rng.randint(1000, 99999)
+                out.append(prefix + ' ' + NOISE[n % len(NOISE)] % (n, n))
+        self.ticks.append([ts, len(pids), queries])
+        return ''.join(out)
+
+    def run(self):
+        """
+        Write the log, and the rotated set if asked for.
+        """
+        start = time.time()
+        self.running = dict((pid, self.counters()) for pid in range(1000, 1000 + self.pids))
+        self.next_pid = 1000 + self.pids
+        ticks = max(self.size // len(self.tick(0)), 1)
+        ts = (int(time.time()) - ticks * DUMP_PERIOD) // DUMP_PERIOD * DUMP_PERIOD
+        self.rng = random.Random(self.seed)
+        self.running = dict((pid, self.counters()) for pid in range(1000, 1000 + self.pids))
+        self.next_pid = 1000 + self.pids
+        self.ticks = []
+        self.dumped = set()
+
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        names = [self.path]
+        parts = []
+        if self.rotated:
+            parts = self.rotated_files()
+            if not os.path.isdir(os.path.dirname(parts[0])):
+                os.makedirs(os.path.dirname(parts[0]))
+        files = dict((name, [0, 0]) for name in names + parts)
+        out = open(self.path, 'wb')
+        part = 0
+        rot = gzip.open(parts[0], 'wb') if parts else None
+        written = 0
+        first = ts
+        try:
+            while written < self.size:
+                text = self.tick(ts)
+                out.write(text)
+                files[self.path][0] += len(text)
+                files[self.path][1] += text.count('\n')
+                while rot is not None and text:
+                    boundary = self.size * (part + 1) // ROTATED_PARTS
+                    if part < ROTATED_PARTS - 1 and written + len(text) > boundary:
+                        cut = text.find('\n', max(boundary - written, 0)) + 1 or len(text)
+                    else:
+                        cut = len(text)
+                    rot.write(text[:cut])
+                    files[parts[part]][0] += cut
+                    files[parts[part]][1] += text.count('\n', 0, cut)
+                    written = written + cut
+                    text = text[cut:]
+                    if text:
+                        rot.close()
+                        part = part + 1
+                        rot = open(parts[part], 'wb')
+                if rot is None:
+                    written = files[self.path][0]
+                ts = ts + DUMP_PERIOD
+        finally:
+            out.close()
+            if rot is not None:
+                rot.close()
+        self.meta = {'params': self.params(), 'first': first, 'last': ts - DUMP_PERIOD,
+                     'files': files, 'rotated': parts, 'ticks': self.ticks}
+        with open(self.path + BENCH_META, 'w') as f:
+            json.dump(self.meta, f)
+        duration = time.time() - start
+        logger.info("wrote %d bytes, %d lines to %s in %.3f seconds",
+                    files[self.path][0], files[self.path][1], self.path, duration)
+
+    def expect(self, ts=0):
+        """
+        Return tuple of (number of records, number of queries) that an extract
+        from time stamp ts should find. The queries up to the first dump from
+        ts on are not counted, having no earlier dump to take them from.
+        """
+        ticks = [tick for tick in self.meta['ticks'] if tick[0] >= ts]
+        return sum(tick[1] for tick in ticks), sum(tick[2] for tick in ticks[1:])
+
+    def remove(self):
+        for name in [self.path, self.path + BENCH_META] + self.rotated_files():
+            if os.path.isfile(name):
+                os.remove(name)
+
+""" ===========================================================
+Benchmark
+Each mode runs Extract.get_data and Extract.show_data in a process of
+its own, so its peak RSS is not hidden by an earlier mode. The peak RSS
+of worker processes is shown apart. Throughput is of the uncompressed
+bytes and lines the mode had to read. The records and queries found are
+checked against those written, with an empty network map so that each
+PID is its own series, and a checkpoint keeping the whole log.
+    serial      one process
+    jobs        chunks of the log in parallel
+    since       from the middle time stamp, found by binary search
+    checkpoint  without a checkpoint, then saving it
+    metrics     also cache and upstream server counters
+    rotated     the rotated set, files in parallel, only when asked for
+=========================================================== """
+
+
+def extract_mode(conn, mode, log_file, ts, jobs, checkpoint_dir, keep):
+    """
+    Measure one mode, in a child process, and send the result to conn.
+    keep is the number of seconds the checkpoint keeps samples for.
+    """
+    dns_tools.CHECKPOINT_DIR = checkpoint_dir
+    dns_tools.CHECKPOINT_KEEP = keep
+    if mode == 'checkpoint':
+        shutil.rmtree(checkpoint_dir, True)
+    if not os.path.isdir(checkpoint_dir):
+        os.makedirs(checkpoint_dir)
+    network_map = os.path.join(checkpoint_dir, 'networks.json')
+    with open(network_map, 'w') as f:
+        json.dump({}, f)
+    extract = dns_tools.Extract(log_file, ts, dns_tools.INTERVAL_DEFAULT,
+                                jobs if mode in ('jobs', 'rotated') else 1,
+                                mode == 'checkpoint', mode == 'rotated', metrics=mode == 'metrics')
+    extract.network_map = dns_tools.NetworkMap(network_map)
+    start = time.time()
+    extract.get_data()
+    parsed = time.time() - start
+    stdout = sys.stdout
+    start = time.time()
+    try:
+        sys.stdout = open(os.devnull, 'w')
+        extract.show_data()
+        if mode == 'metrics':
+            extract.show_cache()
+            extract.show_servers()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    shown = time.time() - start
+    records = sum(len(samples) for samples in extract.data.values())
+    queries = extract.get_histogram().total
+    conn.send((parsed, shown, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss, records, queries))
+    conn.close()
+
+
+class Bench(object):
+    def __init__(self, gen, modes=MODES_DEFAULT, jobs=JOBS_DEFAULT):
+        self.gen = gen
+        self.modes = modes
+        self.jobs = jobs
+        self.results = []
+        self.failed = []
+
+    def amount(self, mode):
+        """
+        Return tuple of (log file, time stamp, bytes, lines) that mode reads.
+        """
+        meta = self.gen.meta
+        path = self.gen.path
+        if mode == 'rotated':
+            parts = meta['rotated']
+            return (parts[-1], 0, sum(meta['files'][name][0] for name in parts),
+                    sum(meta['files'][name][1] for name in parts))
+        size, lines = meta['files'][path]
+        if mode != 'since':
+            return (path, 0, size, lines)
+        ts = (meta['first'] + meta['last']) // 2
+        offset = dns_tools.seek_time(path, ts)
+        lines = 0
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            for block in iter(lambda: f.read(dns_tools.CHUNK_SIZE), ''):
+                lines = lines + block.count('\n')
+        return (path, ts, size - offset, lines)
+
+    def run(self):
+        for mode in self.modes:
+            if mode == 'rotated' and not self.gen.rotated:
+                continue
+            log_file, ts, size, lines = self.amount(mode)
+            checkpoint_dir = os.path.join(os.path.dirname(self.gen.path), 'checkpoint')
+            keep = max(dns_tools.CHECKPOINT_KEEP, int(time.time()) - self.gen.meta['first'] + DUMP_PERIOD)
+            parent, child = multiprocessing.Pipe(False)
+            proc = multiprocessing.Process(target=extract_mode,
+                                           args=(child, mode, log_file, ts, self.jobs, checkpoint_dir, keep))
+            proc.start()
+            child.close()
+            try:
+                parsed, shown, rss, workers, records, queries = parent.recv()
+            except EOFError:
+                logger.error("%s failed on %s", mode, log_file)
+                self.failed.append(mode)
+                proc.join()
+                continue
+            proc.join()
+            expected = self.gen.expect(ts)
+            if (records, queries) != expected:
+                logger.error("%s found %d records and %d queries, expected %d and %d",
+                             mode, records, queries, expected[0], expected[1])
+                self.failed.append(mode)
+            self.results.append((mode, size, lines, parsed, shown, rss, workers, records))
+            logger.info("%s %d bytes, %d lines in %.3f + %.3f seconds, peak RSS %d KB",
+                        mode, size, lines, parsed, shown, rss)
+
+    def show(self):
+        params = self.gen.meta['params']
+        print("\n%s: %d MB, %d dnsmasq, %d upstream servers, %d jobs" %
+              (self.gen.path, params['size'] >> 20, params['pids'], params['servers'], self.jobs))
+        print("%-10s  %8s  %10s  %9s  %8s  %10s  %9s  %8s  %8s  %9s" %
+              ('Mode', 'MB', 'Lines', 'get_data', 'MB/s', 'Lines/s', 'show_data', 'RSS MB', 'Jobs MB',
+               'Records'))
+        print("%-10s  %8s  %10s  %9s  %8s  %10s  %9s  %8s  %8s  %9s" %
+              ('----', '--', '-----', '--------', '----', '-------', '---------', '------', '-------',
+               '-------'))
+        for mode, size, lines, parsed, shown, rss, workers, records in self.results:
+            duration = max(parsed, 0.001)
+            print("%-10s  %8.1f  %10d  %9.3f  %8.1f  %10d  %9.3f  %8.1f  %8.1f  %9d" %
+                  (mode, size / float(1 << 20), lines, parsed, size / float(1 << 20) / duration,
+                   lines / duration, shown, rss / 1024.0, workers / 1024.0, records))
+        if len(self.failed) > 0:
+            print("Wrong records or queries in %s" % ', '.join(self.failed))
+
+
+def parse_size(text):
+    """
+    Return number of bytes of a size such as 100M or 10G.
+    """
+    text = text.strip().upper()
+    if text[-1:] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def do_bench(sizes, modes=MODES_DEFAULT, pids=PIDS_DEFAULT, servers=SERVERS_DEFAULT, jobs=JOBS_DEFAULT,
+             directory=BENCH_DIR, keep=False):
+    """
+    For each size, write or reuse a synthetic log and measure each mode.
+    The log is removed afterwards unless keep is set.
+    Return list of modes that did not find the records and queries written.
+    """
+    failed = []
+    for size in sizes:
+        path = os.path.join(directory, '%dM' % (size >> 20), 'syslog')
+        gen = LogGen(path, size, pids, servers, 'rotated' in modes)
+        if not gen.load():
+            print("Writing %s" % path)
+            gen.run()
+        bench = Bench(gen, modes, jobs)
+        try:
+            bench.run()
+        finally:
+            if not keep:
+                gen.remove()
+                shutil.rmtree(os.path.join(os.path.dirname(path), 'checkpoint'), True)
+        bench.show()
+        failed.extend(bench.failed)
+    return failed
+
+""" ===========================================================
+Option Parsing
+=========================================================== """
+
+
+def do_parsing():
+    dir_help = "Directory to write synthetic logs in. Default is %s." % BENCH_DIR
+    help_help = "Show this help message and exit."
+    jobs_help = "Number of processes for the jobs and rotated modes. Default is %d." % JOBS_DEFAULT
+    keep_help = "Keep synthetic logs, to reuse them in the next run."
+    modes_help = ("Comma separated extraction modes, of %s. Default is %s." %
+                  (', '.join(MODES), ','.join(MODES_DEFAULT)))
+    pids_help = "Number of dnsmasq. Default is %d." % PIDS_DEFAULT
+    sizes_help = "Comma separated sizes of synthetic logs. Default is %s." % SIZES_DEFAULT
+    upstreams_help = "Number of upstream servers of each dnsmasq. Default is %d." % SERVERS_DEFAULT
+
+    parser = OptionParser(add_help_option=False)
+    parser.add_option('-d', '--dir', action='store', dest='dir', help=dir_help, metavar='DIR',
+                      default=BENCH_DIR)
+    parser.add_option('-h', '--help', action='store_true', dest='help', help=help_help, metavar='HELP')
+    parser.add_option('-j', '--jobs', action='store', dest='jobs', help=jobs_help, metavar='JOBS',
+                      type='int', default=JOBS_DEFAULT)
+    parser.add_option('-k', '--keep', action='store_true', dest='keep', help=keep_help, metavar='KEEP')
+    parser.add_option('-m', '--modes', action='store', dest='modes', help=modes_help, metavar='MODES',
+                      default=','.join(MODES_DEFAULT))
+    parser.add_option('-p', '--pids', action='store', dest='pids', help=pids_help, metavar='PIDS',
+                      type='int', default=PIDS_DEFAULT)
+    parser.add_option('-s', '--sizes', action='store', dest='sizes', help=sizes_help, metavar='SIZES',
+                      default=SIZES_DEFAULT)
+    parser.add_option('-u', '--upstreams', action='store', dest='upstreams', help=upstreams_help,
+                      metavar='UPSTREAMS', type='int', default=SERVERS_DEFAULT)
+
+    def usage():
+        parser.print_help()
+        print "\nSupported Operations:"
+        print "  dns_bench.py [ -s <sizes> ] [ -m <modes> ] [ -p <value> ] [ -u <value> ] [ -j <value> ] [ -d <dir> ] [ -k ]"
+        print "Examples:"
+        print "  dns_bench.py -s 100M -m serial,metrics"
+        print "  dns_bench.py -s 1G,10G -j 8 -k"
+        print "  dns_bench.py -s 1G -m serial,rotated"
+        sys.exit()
+
+    flags, args = parser.parse_args()
+
+    if flags.help or len(args) != 0:
+        usage()
+
+    modes = [mode for mode in flags.modes.split(',') if mode]
+    if any(mode not in MODES for mode in modes):
+        print("\nUnsupported mode!\n")
+        usage()
+    try:
+        sizes = [parse_size(size) for size in flags.sizes.split(',') if size]
+    except ValueError:
+        print("\nInvalid size!\n")
+        usage()
+
+    if len(do_bench(sizes, modes, flags.pids, flags.upstreams, flags.jobs, flags.dir, flags.keep is True)) > 0:
+        sys.exit(1)
+
+""" ===========================================================
+Main Program.
+=========================================================== """
+
+if __name__ == "__main__":
+    dns_tools.do_logging()
+    do_parsing()
@@ -12,9 +12,41 @@ import os
 import time
 from datetime import datetime
 from optparse import OptionParser
-# from matplotlib import pyplot, dates
 import re
+import glob
+import gzip
+import bz2
+import io
+import subprocess
+import json
+import contextlib
+import mmap
+import multiprocessing
+import operator
+import socket
+import select
+import struct
+import ctypes
+import ctypes.util
+import fcntl
+from array import array
+from tool_common import Metrics, log_handler
 import pdb
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    from matplotlib import pyplot, dates
+except ImportError:
+    pyplot = None
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 """ ===========================================================
 Configurations
@@ -30,81 +62,1746 @@ FILE_DEFAULT = '/var/log/syslog'
 TIMESTAMP_DEFAULT = 0
 SAMPLE_DEFAULT = 288
 INTERVAL_DEFAULT = 5
+JOBS_DEFAULT = 1
+CHUNK_SIZE = 64 * 1024 * 1024
+
+CHECKPOINT_DIR = '/var/lib/dns_tools/'
+CHECKPOINT_KEEP = 7 * 24 * 3600
+FOLLOW_DEFAULT = 10
+NETWORKS_FILE = CHECKPOINT_DIR + 'networks.json'
+GAP_FACTOR = 3
+
+BACKEND_DEFAULT = 'signal'
+STORE_FILE = CHECKPOINT_DIR + 'samples.dat'
+SERVERS_FILE = CHECKPOINT_DIR + 'servers.dat'
+DNS_PORT = 53
+CHAOS_TOUT = 2
+
+JITTER_MAX = 1
+SPREAD_FRACTION = 0.5
+SPREAD_BATCH = 50
+
+""" ===========================================================
+Metrics
+Timers of the phases of a run: query dnsmasq, signal them, store and roll
+up samples, parse logs, load samples and process them into a histogram,
+with counters of dnsmasq, ticks and lines, see tool_common.Metrics. Time
+spent in worker processes is seen as the time the parent waited for them.
+The metrics are written after each collect tick and when the run ends.
+=========================================================== """
+METRICS_PREFIX = 'dns_tools'
+
+metrics = Metrics(METRICS_PREFIX)
+
+""" ===========================================================
+Schedule samples
+Samples are taken at each multiple of the interval since the epoch, so
+that they fall in the same buckets Extract uses. Sleeping is timed with
+the monotonic clock, so a slow collection does not delay the following
+samples and the wall clock stepping does not shorten or stretch a sleep.
+A tick found more than half an interval past when the previous collection
+ends is skipped and counted as missed.
+=========================================================== """
+
+libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+CLOCK_MONOTONIC = 1
+
+
+class Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def monotonic():
+    """
+    Return seconds of the monotonic clock.
+    """
+    ts = Timespec()
+    if libc.clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+        raise OSError(ctypes.get_errno(), "clock_gettime")
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+
+class Schedule(object):
+    def __init__(self, period):
+        """
+        period      seconds between ticks
+        """
+        self.period = period
+        self.offset = time.time() - monotonic()
+        self.deadline = None
+        self.ticks = 0
+        self.missed = 0
+        self.max_late = 0.0
+
+    def sleep_until(self, deadline):
+        """
+        Sleep until deadline on the monotonic clock.
+        Return seconds late.
+        """
+        while True:
+            remaining = deadline - monotonic()
+            if remaining <= 0:
+                return -remaining
+            time.sleep(remaining)
+
+    def wait(self):
+        """
+        Sleep until the next tick. The first tick is the next multiple of
+        the period on the wall clock. A wall clock step of more than
+        JITTER_MAX seconds realigns the ticks to the wall clock.
+        Return number of ticks missed since the previous one.
+        """
+        offset = time.time() - monotonic()
+        if self.deadline is None or abs(offset - self.offset) > JITTER_MAX:
+            if self.deadline is not None:
+                logger.warning("wall clock stepped %.3f seconds", offset - self.offset)
+            self.offset = offset
+            wall = (int(time.time()) // self.period + 1) * self.period
+            self.deadline = wall - self.offset
+        else:
+            self.deadline = self.deadline + self.period
+        missed = 0
+        late = monotonic() - self.deadline
+        if late > self.period / 2.0:
+            missed = int((late + self.period / 2.0) // self.period)
+            self.deadline = self.deadline + missed * self.period
+            self.missed = self.missed + missed
+            logger.warning("missed %d ticks", missed)
+        late = self.sleep_until(self.deadline)
+        self.ticks = self.ticks + 1
+        self.max_late = max(self.max_late, late)
+        if late > JITTER_MAX:
+            logger.warning("tick %.3f seconds late", late)
+        return missed
 
 """ ===========================================================
 Collect samples
 =========================================================== """
 
 
+def read_pids(pid_dir=PID_DIR):
+    """
+    Read PID from the pid file under each network of the DHCP directory.
+    Return tuple of
+        list of PID for dnsmasq
+        dictionary key      PID of dnsmasq
+        dictionary value    network ID, name of the DHCP directory
+    """
+    pids = []
+    networks = {}
+    if os.path.isdir(pid_dir) is False:
+        return pids, networks
+    for name in os.listdir(pid_dir):
+        pid_file = os.path.join(pid_dir, name, PID_FILE)
+        try:
+            with open(pid_file) as f:
+                pid = int(f.readline().rstrip('\n'))
+            pids.append(pid)
+            networks[pid] = name
+        except (IOError, ValueError):
+            logger.warning("ignore %s", pid_file)
+    return pids, networks
+
+
 class Collect(object):
-    def __init__(self, sample=SAMPLE_DEFAULT, interval=INTERVAL_DEFAULT):
+    def __init__(self, sample=SAMPLE_DEFAULT, interval=INTERVAL_DEFAULT, backend=BACKEND_DEFAULT):
+        """
+        backend     chaos to query statistics from each dnsmasq into STORE_FILE,
+                    falling back to signal for dnsmasq that do not answer,
+                    signal to make each dnsmasq dump its cache to syslog
+        """
         self.sample = sample
         self.interval = interval
+        self.backend = backend
         self.pids = []
-        logger.info("%s:%s() %d: %d samples at %d minutes interval",
-                    self.__class__.__name__,
-                    sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                    self.sample, self.interval)
+        self.networks = {}
+        self.network_map = NetworkMap()
+        logger.info("%d samples at %d minutes interval with %s backend",
+                    self.sample, self.interval, self.backend)
 
     def run(self):
         """
         Collect data for extended time for all dnsmasq.
         """
-        logger.info("%s:%s() %d: starting at time stamp %d",
-                    self.__class__.__name__,
-                    sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                    int(time.time()))
-        for i in range(0, self.sample):
+        logger.info("starting at time stamp %d", int(time.time()))
+        self.network_map.load()
+        schedule = Schedule(self.interval * 60)
+        i = 0
+        while i < self.sample:
+            missed = schedule.wait()
+            metrics.count('missed_ticks', missed)
+            i = i + missed
+            if i >= self.sample:
+                break
             self.get_pids()
             if len(self.pids) > 0:
-                self.dump_dns_cache()
-            time.sleep(self.interval * 60)
+                if self.backend == 'chaos':
+                    self.query_dns_stats()
+                else:
+                    self.spread_dns_cache(schedule)
+                try:
+                    self.network_map.update(self.networks, int(time.time()))
+                    self.network_map.save()
+                except (IOError, OSError) as e:
+                    logger.warning("network map not saved: %s", e)
+            metrics.count('ticks')
+            metrics.export()
+            i = i + 1
+        logger.info("%d ticks, %d missed, at most %.3f seconds late",
+                    schedule.ticks, schedule.missed, schedule.max_late)
 
     def get_pids(self):
         """
         Read PID from the pid file under the DHCP directory.
         Populate self.pids
             list of PID for dnsmasq
+        Populate self.networks
+            dictionary key      PID of dnsmasq
+            dictionary value    network ID, name of the DHCP directory
         """
-        self.pids = []
         if os.path.isdir(PID_DIR) is False:
-            logger.error("%s:%s() %d: invalid %s", self.__class__.__name__,
-                         sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                         PID_DIR)
-            return
-        dirs = os.listdir(PID_DIR)
-        for name in dirs:
-            path = os.path.join(PID_DIR, name)
-            pid_file = os.path.join(path, PID_FILE)
-            with open(pid_file) as f:
-                try:
-                    lines = f.readlines()
-                    pid = int(lines[0].rstrip('\n'))
-                    self.pids.append(pid)
-                except:
-                    logger.warning("%s:%s() %d: ignore %s", self.__class__.__name__,
-                                   sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                                   pid_file)
-        logger.debug("%s:%s() %d: found %d dnsmasq", self.__class__.__name__,
-                     sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                     len(self.pids))
+            logger.error("invalid %s", PID_DIR)
+        self.pids, self.networks = read_pids()
+        logger.debug("found %d dnsmasq", len(self.pids))
 
-    def dump_dns_cache(self):
+    @metrics.timed('signal')
+    def dump_dns_cache(self, pids=None):
         """
-        Dump DNS cache for each dnsmasq
+        Dump DNS cache for each dnsmasq, or for pids, with a single signal command.
         """
+        pids = self.pids if pids is None else pids
         start = time.time()
-        for pid in self.pids:
-            cmd = "sudo kill -s SIGUSR1 %d" % pid
-            os.system(cmd)
+        cmd = ['sudo', 'kill', '-s', 'SIGUSR1'] + [str(pid) for pid in pids]
+        metrics.count('signaled', len(pids))
+        if subprocess.call(cmd) != 0:
+            logger.warning("failed to signal some dnsmasq")
         duration = time.time() - start
-        logger.info("%s:%s() %d: dumped cache for %d dnsmasq in %d seconds", self.__class__.__name__,
-                    sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                    len(self.pids), duration)
+        logger.info("dumped cache for %d dnsmasq in %d seconds", len(pids), duration)
+
+    def spread_dns_cache(self, schedule):
+        """
+        Dump DNS cache for each dnsmasq in batches of SPREAD_BATCH, spread
+        over SPREAD_FRACTION of the interval from the current tick, so that
+        rsyslog does not get all the dumps at once. Each network keeps its
+        place in the batches from one tick to the next.
+        """
+        pids = sorted(self.pids, key=lambda pid: self.networks.get(pid))
+        batches = [pids[i:i + SPREAD_BATCH] for i in range(0, len(pids), SPREAD_BATCH)]
+        step = schedule.period * SPREAD_FRACTION / len(batches)
+        tick = schedule.deadline
+        for i, batch in enumerate(batches):
+            schedule.sleep_until(tick + i * step)
+            self.dump_dns_cache(batch)
+
+    def query_dns_stats(self):
+        """
+        Query statistics of each dnsmasq and append them to STORE_FILE, and
+        those of each upstream server to SERVERS_FILE.
+        Dump DNS cache to syslog for dnsmasq that do not answer.
+        """
+        start = time.time()
+        stats = DnsStats()
+        samples = stats.query(self.pids)
+        ts = int(time.time())
+        store = Store(STORE_FILE, SAMPLE_FIELDS)
+        servers = Store(SERVERS_FILE, SERVER_FIELDS)
+        rows = []
+        server_rows = []
+        for pid in sorted(samples):
+            queries, cache, counters = samples[pid]
+            net = store.number('network', self.networks.get(pid, str(pid)))
+            rows.append([ts, pid, net] + queries + cache)
+            for name in sorted(counters):
+                server_rows.append([ts, pid, net, servers.number('server', name)] + counters[name])
+        try:
+            store.append(rows)
+            servers.append(server_rows)
+        except (IOError, OSError) as e:
+            logger.warning("samples not stored, %s", e)
+        rolled = None
+        try:
+            rollup = Rollup(ROLLUP_FILE, store)
+            rollup.update()
+            rolled = rollup.ts
+        except (IOError, OSError) as e:
+            logger.warning("rollup not updated, %s", e)
+        try:
+            if rolled is not None:
+                self.expire(store, min(ts - STORE_KEEP, rolled + 1))
+            self.expire(servers, ts - STORE_KEEP)
+        except (IOError, OSError) as e:
+            logger.warning("samples not pruned, %s", e)
+        duration = time.time() - start
+        logger.info("queried statistics of %d dnsmasq in %.3f seconds", len(samples), duration)
+        failed = [pid for pid in self.pids if pid not in samples]
+        metrics.count('answered', len(samples))
+        metrics.count('unanswered', len(failed))
+        if len(failed) > 0:
+            logger.warning("%d dnsmasq did not answer", len(failed))
+            self.dump_dns_cache(failed)
+
+    def expire(self, store, before):
+        """
+        Drop records of store before time stamp before, once the first one is
+        STORE_PRUNE older, so the file is rewritten about once a STORE_PRUNE.
+        """
+        first = store.first()
+        if first is not None and first < before - STORE_PRUNE:
+            store.prune(before)
+            logger.info("pruned %s before %d", store.path, before)
 
     def help(self):
         print("dns_tools.py collect -s S -i I")
         print("    Dump DNS cache to syslog for all dnsmasq S times every I minutes.")
+        print("    Samples are taken at each multiple of I minutes, without drifting.")
+        print("    Dumps are spread in batches of %d over the first part of each interval." % SPREAD_BATCH)
+        print("    Record the network of each dnsmasq in %s." % NETWORKS_FILE)
+        print("dns_tools.py collect -s S -i I -b chaos")
+        print("    Query statistics of all dnsmasq with CHAOS TXT queries into %s." % STORE_FILE)
+        print("    Samples are kept %d days, older ones only in the coarser tiers of the rollup." %
+              (STORE_KEEP // 86400))
+        print("    Needs root and dnsmasq answering CHAOS queries. dnsmasq that do not answer")
+        print("    dump their cache to syslog instead.")
+        print("dns_tools.py collect -s S -i I -x X")
+        print("    Also write query, signal, store and rollup timers and counters to X after each sample,")
+        print("    as JSON if X ends in .json, otherwise as a Prometheus textfile for the node exporter.")
+
+""" ===========================================================
+Query dnsmasq statistics
+dnsmasq answers TXT queries of class CHAOS for its own counters. Each
+dnsmasq listens in the network namespace of its network, so a UDP socket
+is opened in that namespace with setns(), using the address dnsmasq is
+bound to as found in /proc/<pid>/net/udp. The queries to all dnsmasq are
+then sent at once and their answers gathered with select(), without
+forking a process per dnsmasq or writing the cache to syslog.
+Needs root for setns(), so collect uses it only when asked to. DnsStats
+takes the function opening the socket, to query a resolver that is not in
+a network namespace.
+=========================================================== """
+
+CLONE_NEWNET = 0x40000000
+CHAOS_CLASS = 3
+TXT_TYPE = 16
+CHAOS_NAMES = ['misses.bind', 'hits.bind', 'cachesize.bind', 'evictions.bind', 'insertions.bind',
+               'servers.bind']
+
+
+def chaos_query(qid, name):
+    """
+    Return DNS query packet for TXT record name of class CHAOS.
+    """
+    labels = ''.join(chr(len(label)) + label for label in name.split('.'))
+    return struct.pack('!HHHHHH', qid, 0, 1, 0, 0, 0) + labels + '\0' + struct.pack('!HH', TXT_TYPE, CHAOS_CLASS)
+
+
+def skip_name(packet, offset):
+    """
+    Return offset after the domain name at offset of packet.
+    """
+    while True:
+        length = ord(packet[offset])
+        if length == 0:
+            return offset + 1
+        if length & 0xc0 == 0xc0:
+            return offset + 2
+        offset = offset + 1 + length
+
+
+def txt_answer(packet):
+    """
+    Parse DNS response packet.
+    Return tuple of (query ID, list of strings of the TXT answers)
+    """
+    qid, flags, qdcount, ancount = struct.unpack('!HHHH', packet[:8])
+    offset = 12
+    for i in range(qdcount):
+        offset = skip_name(packet, offset) + 4
+    strings = []
+    for i in range(ancount):
+        offset = skip_name(packet, offset)
+        rtype, rclass, ttl, length = struct.unpack('!HHIH', packet[offset:offset + 10])
+        offset = offset + 10
+        end = offset + length
+        while rtype == TXT_TYPE and offset < end:
+            size = ord(packet[offset])
+            strings.append(packet[offset + 1:offset + 1 + size])
+            offset = offset + 1 + size
+        offset = end
+    return qid, strings
+
+
+def listen_address(pid, port=DNS_PORT):
+    """
+    Return IPv4 address dnsmasq pid listens on for DNS, or None.
+    """
+    path = '/proc/%d/net/udp' % pid
+    try:
+        with open(path) as f:
+            lines = f.readlines()[1:]
+    except IOError:
+        return None
+    for line in lines:
+        local = line.split()[1]
+        address, local_port = local.split(':')
+        if int(local_port, 16) != port:
+            continue
+        address = socket.inet_ntoa(struct.pack('=I', int(address, 16)))
+        return '127.0.0.1' if address == '0.0.0.0' else address
+    return None
+
+
+def netns_socket(pid, port=DNS_PORT):
+    """
+    Return UDP socket in the network namespace of pid, connected to
+    dnsmasq pid, or None.
+    """
+    address = listen_address(pid, port)
+    if address is None:
+        return None
+    own = open('/proc/self/ns/net')
+    try:
+        with open('/proc/%d/ns/net' % pid) as ns:
+            if libc.setns(ns.fileno(), CLONE_NEWNET) != 0:
+                logger.warning("setns to dnsmasq %d: %s", pid, os.strerror(ctypes.get_errno()))
+                return None
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(0)
+            sock.connect((address, port))
+        finally:
+            if libc.setns(own.fileno(), CLONE_NEWNET) != 0:
+                raise OSError(ctypes.get_errno(), "setns back to own network namespace")
+        return sock
+    except IOError:
+        return None
+    finally:
+        own.close()
+
+
+class DnsStats(object):
+    def __init__(self, port=DNS_PORT, tout=CHAOS_TOUT, opener=netns_socket):
+        """
+        port        DNS port of dnsmasq
+        tout        seconds to wait for all the answers
+        opener      function of (pid, port) returning a non-blocking UDP socket
+                    connected to dnsmasq pid, or None
+        """
+        self.port = port
+        self.tout = tout
+        self.opener = opener
+
+    def open(self, pid):
+        """
+        Return UDP socket connected to dnsmasq pid, or None.
+        """
+        return self.opener(pid, self.port)
+
+    @metrics.timed('query')
+    def query(self, pids):
+        """
+        Query statistics of each dnsmasq of pids.
+        Return dictionary
+            key         pid of dnsmasq
+            value       [[forwarded queries, queries answered locally],
+                         [cache size, insertions that re-used unexpired entries, insertions],
+                         dictionary of upstream server to [queries sent, retried or failed]]
+        """
+        socks = {}
+        answers = {}
+        try:
+            for pid in pids:
+                sock = self.open(pid)
+                if sock is None:
+                    continue
+                socks[sock.fileno()] = (pid, sock)
+                answers[pid] = {}
+                for qid, name in enumerate(CHAOS_NAMES):
+                    try:
+                        sock.send(chaos_query(qid, name))
+                    except socket.error:
+                        break
+            deadline = time.time() + self.tout
+            waiting = dict((fd, len(CHAOS_NAMES)) for fd in socks)
+            while len(waiting) > 0 and time.time() < deadline:
+                ready, _, _ = select.select(list(waiting), [], [], max(deadline - time.time(), 0))
+                for fd in ready:
+                    pid, sock = socks[fd]
+                    try:
+                        qid, strings = txt_answer(sock.recv(4096))
+                    except (socket.error, struct.error, IndexError):
+                        waiting.pop(fd)
+                        continue
+                    if qid < len(CHAOS_NAMES):
+                        answers[pid][CHAOS_NAMES[qid]] = strings
+                    waiting[fd] = waiting[fd] - 1
+                    if waiting[fd] == 0:
+                        waiting.pop(fd)
+        finally:
+            for pid, sock in socks.values():
+                sock.close()
+        samples = {}
+        for pid in answers:
+            sample = self.sample(answers[pid])
+            if sample is not None:
+                samples[pid] = sample
+        return samples
+
+    def sample(self, answer):
+        """
+        Return sample of dnsmasq from its answers, None if incomplete.
+        Each server of servers.bind is "address#port sent failed".
+        """
+        try:
+            queries = [int(answer['misses.bind'][0]), int(answer['hits.bind'][0])]
+            cache = [int(answer['cachesize.bind'][0]), int(answer['evictions.bind'][0]),
+                     int(answer['insertions.bind'][0])]
+            servers = {}
+            for server in answer.get('servers.bind', []):
+                name, sent, failed = server.split()
+                servers[name] = [int(sent), int(failed)]
+        except (KeyError, IndexError, ValueError):
+            return None
+        return [queries, cache, servers]
+
+
+""" ===========================================================
+Store samples
+Samples collected with the chaos backend are appended to files of fixed
+width records of unsigned 32 bit numbers, after a short header. Strings
+such as network ID are stored as numbers, with the list of strings kept
+next to the file. As records are appended in time order, the first record
+of a time range is found by binary search in the memory mapped file, and
+the records from there are read at once into columns, as NumPy arrays or
+array module buffers when NumPy is missing.
+Collect drops the records older than STORE_KEEP, which the rollup has
+already added to its tiers, by rewriting the file once they are
+STORE_PRUNE older still.
+=========================================================== """
+
+STORE_MAGIC = 'DNSS'
+STORE_VERSION = 1
+STORE_HEADER = struct.Struct('<4sHH')
+SAMPLE_FIELDS = ['ts', 'pid', 'network', 'forwarded', 'answered', 'cache_size', 'evicted', 'inserted']
+SERVER_FIELDS = ['ts', 'pid', 'network', 'server', 'sent', 'failed']
+STORE_KEEP = 2 * 24 * 3600
+STORE_PRUNE = 6 * 3600
+
+
+class Store(object):
+    def __init__(self, path, fields, wide=False):
+        """
+        path        file of records
+        fields      names of the fields of a record, starting with time stamp
+        wide        numbers are unsigned 64 bit instead of 32 bit
+        """
+        self.path = path
+        self.fields = fields
+        self.wide = wide
+        self.record = struct.Struct('<%d%s' % (len(fields), 'Q' if wide else 'I'))
+        self.names_path = path + '.names'
+        self.names = None
+        self.numbers = {}
+        self.changed = False
+
+    def load_names(self):
+        """
+        Populate self.names
+            dictionary key      name of field
+            dictionary value    list of strings, indexed by the number stored
+        """
+        self.names = {}
+        if os.path.isfile(self.names_path):
+            with open(self.names_path) as f:
+                self.names = json.load(f)
+        self.numbers = dict((field, dict((name, i) for i, name in enumerate(names)))
+                            for field, names in self.names.items())
+
+    def number(self, field, name):
+        """
+        Return number standing for string name in field.
+        """
+        if self.names is None:
+            self.load_names()
+        numbers = self.numbers.setdefault(field, {})
+        if name not in numbers:
+            numbers[name] = len(numbers)
+            self.names.setdefault(field, []).append(name)
+            self.changed = True
+        return numbers[name]
+
+    @metrics.timed('store')
+    def append(self, rows):
+        """
+        Append records of rows, each a list of numbers of self.fields.
+        New strings are saved before the records that use them.
+        """
+        if os.path.isdir(os.path.dirname(self.path)) is False:
+            os.makedirs(os.path.dirname(self.path))
+        if self.changed:
+            tmp = self.names_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.names, f, separators=(',', ':'))
+            os.rename(tmp, self.names_path)
+            self.changed = False
+        if len(rows) == 0:
+            return
+        with open(self.path, 'ab') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                f.write(STORE_HEADER.pack(STORE_MAGIC, STORE_VERSION, len(self.fields)))
+            elif (size - STORE_HEADER.size) % self.record.size != 0:
+                f.truncate(size - (size - STORE_HEADER.size) % self.record.size)
+            f.write(''.join(self.record.pack(*row) for row in rows))
+
+    def find(self, m, ts):
+        """
+        Return offset in memory map m of the first record at or after time stamp ts.
+        """
+        lo = 0
+        hi = (len(m) - STORE_HEADER.size) // self.record.size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.record.unpack_from(m, STORE_HEADER.size + mid * self.record.size)[0] < ts:
+                lo = mid + 1
+            else:
+                hi = mid
+        return STORE_HEADER.size + lo * self.record.size
+
+    def load(self, since=0):
+        """
+        Read records at or after time stamp since, and self.names.
+        Return dictionary of field name to column of numbers, None if no record.
+        """
+        if os.path.isfile(self.path) is False or os.path.getsize(self.path) <= STORE_HEADER.size:
+            return None
+        self.load_names()
+        n = len(self.fields)
+        with open(self.path, 'rb') as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                magic, version, fields = STORE_HEADER.unpack_from(m, 0)
+                if magic != STORE_MAGIC or version != STORE_VERSION or fields != n:
+                    raise ValueError("%s is not a store of %s" % (self.path, ', '.join(self.fields)))
+                start = self.find(m, since)
+                count = (len(m) - start) // self.record.size
+                columns = {}
+                if numpy is not None:
+                    values = numpy.frombuffer(m, dtype='<u8' if self.wide else '<u4', count=count * n,
+                                              offset=start)
+                    for i, name in enumerate(self.fields):
+                        columns[name] = values[i::n].astype(numpy.int_)
+                    del values
+                else:
+                    values = array('L' if self.wide else 'I')
+                    values.fromstring(m[start:start + count * self.record.size])
+                    for i, name in enumerate(self.fields):
+                        columns[name] = values[i::n]
+            finally:
+                m.close()
+        return columns
+
+    def first(self):
+        """
+        Return time stamp of the first record, None if no record.
+        """
+        if os.path.isfile(self.path) is False or os.path.getsize(self.path) < STORE_HEADER.size + self.record.size:
+            return None
+        with open(self.path, 'rb') as f:
+            f.seek(STORE_HEADER.size)
+            return self.record.unpack(f.read(self.record.size))[0]
+
+    def prune(self, before):
+        """
+        Drop records before time stamp before, by rewriting the file.
+        """
+        if self.first() is None or self.first() >= before:
+            return
+        with open(self.path, 'rb') as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                start = self.find(m, before)
+                end = start + (len(m) - start) // self.record.size * self.record.size
+                tmp = self.path + '.tmp'
+                with open(tmp, 'wb') as out:
+                    out.write(m[:STORE_HEADER.size])
+                    out.write(m[start:end])
+            finally:
+                m.close()
+        os.rename(tmp, self.path)
+
+""" ===========================================================
+Roll up samples
+The number of queries of all dnsmasq is kept in tiers of buckets of one
+minute, five minutes, one hour and one day, each bucket with the sum of
+queries and the largest and smallest one minute sum within it. As records
+are appended to STORE_FILE, the deltas of the new samples are added to the
+open one minute bucket. A bucket is appended to its tier when a later
+sample closes it, and folded into the open bucket of the next tier. Each
+tier keeps its own retention. Across a gap in collection, the minutes a
+sample was due count as minutes without queries in the buckets around the
+gap. A histogram at an interval that is a
+multiple of a tier is then made from the coarsest such tier, without
+scanning the samples.
+=========================================================== """
+
+ROLLUP_TIERS = [(60, STORE_KEEP), (300, 14 * 24 * 3600), (3600, 90 * 24 * 3600),
+                (86400, 5 * 365 * 24 * 3600)]
+ROLLUP_FILE = CHECKPOINT_DIR + 'rollup.json'
+ROLLUP_FIELDS = ['ts', 'sum', 'max', 'min']
+
+
+class Rollup(object):
+    def __init__(self, path=ROLLUP_FILE, store=None):
+        """
+        path        JSON file of the state of the rollup
+        store       Store of the samples, STORE_FILE by default
+        """
+        self.path = path
+        self.store = store if store is not None else Store(STORE_FILE, SAMPLE_FIELDS)
+        base = os.path.splitext(path)[0]
+        self.tiers = [(period, retention, Store('%s.%d.dat' % (base, period), ROLLUP_FIELDS, True))
+                      for period, retention in ROLLUP_TIERS]
+        self.ts = 0
+        self.step = 0
+        self.last = {}
+        self.open = {}
+
+    def load(self):
+        """
+        Read the state of the rollup, if any.
+        Populate self.ts
+            time stamp of the last sample rolled up
+        Populate self.step
+            median spacing of samples at the last update, as an update with
+            one new sample per series cannot tell a gap from the spacing
+        Populate self.last
+            dictionary key      network
+            dictionary value    [pid, timestamp, counter] of its last sample
+        Populate self.open
+            dictionary key      tier period
+            dictionary value    [bucket timestamp, sum, max, min] of the open bucket
+        """
+        if os.path.isfile(self.path) is False:
+            return
+        with open(self.path) as f:
+            state = json.load(f)
+        self.ts = state['ts']
+        self.step = state.get('step', 0)
+        self.last = state['last']
+        self.open = dict((int(period), bucket) for period, bucket in state['open'].items())
+
+    def save(self):
+        if os.path.isdir(os.path.dirname(self.path)) is False:
+            os.makedirs(os.path.dirname(self.path))
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'ts': self.ts, 'step': self.step, 'last': self.last, 'open': self.open}, f, separators=(',', ':'))
+        os.rename(tmp, self.path)
+
+    @contextlib.contextmanager
+    def locked(self, exclusive=False):
+        """
+        Hold a lock on the rollup state, exclusive to update it, shared to read it.
+        Reading without the lock file, as before any update, is not locked.
+        """
+        path = self.path + '.lock'
+        if exclusive:
+            if os.path.isdir(os.path.dirname(path)) is False:
+                os.makedirs(os.path.dirname(path))
+            f = open(path, 'a')
+        elif os.path.isfile(path):
+            f = open(path)
+        else:
+            yield
+            return
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+        finally:
+            f.close()
+
+    @metrics.timed('rollup')
+    def update(self):
+        """
+        Roll up the samples appended to the store since the last update,
+        holding the lock for the whole read-modify-write so that an extract
+        overlapping collect does not add the same samples twice.
+        Return number of samples rolled up.
+        """
+        with self.locked(True):
+            self.load()
+            columns = self.store.load(self.ts + 1)
+            if columns is None or len(columns['ts']) == 0:
+                return 0
+            networks = self.store.names.get('network', [])
+            keys = list(set(networks[n] for n in columns['network']) | set(self.last))
+            number = dict((key, i) for i, key in enumerate(keys))
+            previous = [(number[key], pid, ts, count) for key, (pid, ts, count) in self.last.items()]
+            series = [number[networks[n]] for n in columns['network']]
+            counts = add(columns['forwarded'], columns['answered'])
+            rows = [list(column) for column in zip(*previous)] or [[], [], [], []]
+            series = rows[0] + list(series)
+            pids = rows[1] + list(columns['pid'])
+            ts = rows[2] + list(columns['ts'])
+            counts = rows[3] + list(counts)
+            if numpy is not None:
+                series, pids, ts, counts = [numpy.array(column, dtype=numpy.int_)
+                                            for column in (series, pids, ts, counts)]
+            else:
+                series, pids, ts, counts = [array('l', column) for column in (series, pids, ts, counts)]
+            samples = Samples.from_columns(keys, series, pids, ts, counts)
+            spacing = samples.spacing()
+            step = self.step or spacing
+            if spacing > 0:
+                self.step = spacing
+            max_gap = GAP_FACTOR * max(step, 1)
+            tms, owners, deltas = samples.deltas(max_gap)[:3]
+            minutes = {}
+            for i in range(len(tms)):
+                tm = int(tms[i]) // 60 * 60
+                minutes[tm] = minutes.get(tm, 0) + int(deltas[i])
+            step = max(60, step // 60 * 60)
+            prior = self.open.get(self.tiers[0][0], [None])[0]
+            for tm in sorted(minutes):
+                self.fill(prior, tm, step, max_gap)
+                self.add(0, [tm, minutes[tm], minutes[tm], minutes[tm]])
+                prior = tm
+            self.fill(prior, int(max(columns['ts'])) // 60 * 60, step, max_gap)
+            for i in range(len(samples.ts)):
+                if i + 1 == len(samples.ts) or samples.series[i + 1] != samples.series[i]:
+                    self.last[keys[samples.series[i]]] = [int(samples.pids[i]), int(samples.ts[i]),
+                                                          int(samples.counts[i])]
+            self.ts = int(max(columns['ts']))
+            now = time.time()
+            self.last = dict((key, last) for key, last in self.last.items() if last[1] >= now - CHECKPOINT_KEEP)
+            for period, retention, tier in self.tiers:
+                tier.prune(now - retention)
+            self.save()
+            return len(columns['ts'])
+
+    def fill(self, prior, tm, step, max_gap):
+        """
+        If minutes prior and tm are more than max_gap apart, add the minutes
+        a sample was due every step seconds between them, that are in the
+        same coarsest bucket as either, as minutes without queries. So the
+        quietest minute of a bucket with a gap in collection is 0, while the
+        coarsest buckets wholly in the gap stay absent.
+        """
+        if prior is None or tm - prior <= max_gap:
+            return
+        period = self.tiers[-1][0]
+        for slot in range(prior + step, tm, step):
+            if slot // period == prior // period or slot // period == tm // period:
+                self.add(0, [slot, 0, 0, 0])
+
+    def add(self, level, bucket):
+        """
+        Fold bucket into the open bucket of tier level, appending the open
+        bucket to its tier first if bucket is past it.
+        """
+        period, retention, tier = self.tiers[level]
+        tm = bucket[0] // period * period
+        current = self.open.get(period)
+        if current is not None and current[0] != tm:
+            tier.append([current])
+            if level + 1 < len(self.tiers):
+                self.add(level + 1, current)
+            current = None
+        if current is None:
+            self.open[period] = [tm] + bucket[1:]
+        else:
+            current[1] = current[1] + bucket[1]
+            current[2] = max(current[2], bucket[2])
+            current[3] = min(current[3], bucket[3])
+
+    def tier(self, period, since=0):
+        """
+        Pick the coarsest tier whose period divides period, and whose
+        retention covers the samples from time stamp since. since must be
+        a multiple of the tier period, as a bucket straddling it would count
+        queries from before since.
+        Return tuple of (tier period, list of [bucket timestamp, sum, max, min]),
+        including the open buckets, or None if no tier fits.
+        """
+        first = self.store.first()
+        if first is None:
+            return None
+        oldest = max(since, first)
+        now = time.time()
+        fits = [level for level, (p, retention, tier) in enumerate(self.tiers)
+                if period % p == 0 and since % p == 0 and oldest >= now - retention]
+        if len(fits) == 0:
+            return None
+        level = fits[-1]
+        tier_period = self.tiers[level][0]
+        with self.locked():
+            self.load()
+            columns = self.tiers[level][2].load(since)
+        buckets = []
+        if columns is not None:
+            buckets = [[int(value) for value in row] for row in zip(*[columns[name] for name in ROLLUP_FIELDS])]
+        current = None
+        for p, retention, tier in reversed(self.tiers[:level + 1]):
+            bucket = self.open.get(p)
+            if bucket is None:
+                continue
+            tm = bucket[0] // tier_period * tier_period
+            if current is not None and current[0] == tm:
+                current = [tm, current[1] + bucket[1], max(current[2], bucket[2]), min(current[3], bucket[3])]
+                continue
+            if current is not None and current[0] >= since:
+                buckets.append(current)
+            current = [tm] + bucket[1:]
+        if current is not None and current[0] >= since:
+            buckets.append(current)
+        return tier_period, buckets
+
+""" ===========================================================
+Map dnsmasq to networks
+Each network has its own dnsmasq, whose PID is in the pid file under the
+network DHCP directory. A restart gives the network a new PID, and an old
+PID may later be reused by another network, so Collect records over which
+time each PID served each network. Extract uses this to put all PID of a
+network into one series.
+=========================================================== """
+
+
+class NetworkMap(object):
+    def __init__(self, path=NETWORKS_FILE):
+        """
+        path        JSON file of the map
+        """
+        self.path = path
+        self.pids = {}
+
+    def load(self):
+        """
+        Read the map recorded by Collect. Without it, map the PID of
+        running dnsmasq from the DHCP directory.
+        Populate self.pids
+            dictionary key      PID of dnsmasq
+            dictionary value    list of [network ID, first seen, last seen]
+        """
+        self.pids = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.pids = dict((int(pid), spans) for pid, spans in json.load(f).items())
+            return
+        pids, networks = read_pids()
+        self.update(networks, int(time.time()))
+
+    def update(self, networks, ts):
+        """
+        Record that each PID served its network at time stamp ts.
+        networks    dictionary of PID to network ID, as Collect.networks
+        """
+        for pid, net in networks.items():
+            spans = self.pids.setdefault(pid, [])
+            if len(spans) > 0 and spans[-1][0] == net:
+                spans[-1][2] = ts
+            else:
+                spans.append([net, ts, ts])
+
+    def save(self):
+        """
+        Write the map, dropping PID not seen for CHECKPOINT_KEEP seconds.
+        """
+        oldest = time.time() - CHECKPOINT_KEEP
+        pids = {}
+        for pid, spans in self.pids.items():
+            spans = [span for span in spans if span[2] >= oldest]
+            if len(spans) > 0:
+                pids[pid] = spans
+        self.pids = pids
+        if os.path.isdir(os.path.dirname(self.path)) is False:
+            os.makedirs(os.path.dirname(self.path))
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.pids, f, separators=(',', ':'))
+        os.rename(tmp, self.path)
+
+    def lookup(self, pid, ts):
+        """
+        Return network ID served by pid at time stamp ts, or None if unknown.
+        The span closest to ts wins when pid served several networks.
+        """
+        spans = self.pids.get(pid)
+        if spans is None:
+            return None
+        best = None
+        distance = None
+        for net, first, last in spans:
+            d = max(first - ts, ts - last, 0)
+            if distance is None or d < distance:
+                best = net
+                distance = d
+        return best
+
+""" ===========================================================
+Parse dnsmasq cache dump
+A cheap substring test skips lines not from dnsmasq, then one anchored
+pattern picks the pid and either the time stamp or the query counters.
+When metrics are asked for, a longer pattern also picks the cache counters
+and the counters of each upstream server.
+The time stamp waits per pid for its counters, since dumps from many
+dnsmasq interleave in syslog.
+A file may be parsed in newline aligned chunks by several processes.
+The counters at the head of a chunk are then stitched to the time stamp
+left pending at the tail of the chunk before it.
+=========================================================== """
+
+DUMP_MARK = 'dnsmasq['
+DUMP_RE = re.compile(r'(?:\S+ +\d+ \S+|\S+) \S+ dnsmasq\[(\d+)\]: '
+                     r'(?:time (\d+)$|queries forwarded (\d+), queries answered locally (\d+)$)')
+STATS_RE = re.compile(r'(?:\S+ +\d+ \S+|\S+) \S+ dnsmasq\[(\d+)\]: '
+                      r'(?:time (\d+)$|queries forwarded (\d+), queries answered locally (\d+)$'
+                      r'|cache size (\d+), (\d+)/(\d+) cache insertions re-used unexpired cache entries\.$'
+                      r'|server (\S+): queries sent (\d+), retried or failed (\d+)$)')
+
+
+class Parser(object):
+    def __init__(self, since=0, metrics=False):
+        """
+        since       ignore cache dumps with time stamp before since
+        metrics     also parse cache and upstream server counters
+        """
+        self.since = since
+        self.metrics = metrics
+        self.data = {}
+        self.pending = {}
+        self.cache = {}
+        self.servers = {}
+        self.last = {}
+        self.head = {}
+        self.head_cache = {}
+        self.head_servers = {}
+        self.seen = set()
+        self.lines = 0
+
+    def parse(self, lines):
+        """
+        Parse lines of syslog.
+        Populate self.data
+            dictionary key      pid of dnsmasq
+            dictionary value    dictionary of
+                                key = timestamp
+                                value = number of forwarded + answered queries
+        Populate self.cache
+            dictionary key      pid of dnsmasq
+            dictionary value    dictionary of
+                                key = timestamp
+                                value = [cache size, insertions that re-used
+                                         unexpired entries, insertions]
+        Populate self.servers
+            dictionary key      pid of dnsmasq
+            dictionary value    dictionary of
+                                key = timestamp
+                                value = dictionary of upstream server to
+                                        [queries sent, retried or failed]
+        Populate self.pending
+            dictionary key      pid of dnsmasq
+            dictionary value    timestamp still waiting for its counters
+        Populate self.last
+            dictionary key      pid of dnsmasq
+            dictionary value    timestamp of the last cache dump
+        Populate self.head, self.head_cache and self.head_servers
+            dictionary key      pid of dnsmasq
+            dictionary value    counters seen before any timestamp of the pid
+        """
+        data = self.data
+        pending = self.pending
+        cache = self.cache
+        servers = self.servers
+        last = self.last
+        head = self.head
+        head_cache = self.head_cache
+        head_servers = self.head_servers
+        seen = self.seen
+        since = self.since
+        match = STATS_RE.match if self.metrics else DUMP_RE.match
+        n = 0
+        for line in lines:
+            n = n + 1
+            if DUMP_MARK not in line:
+                continue
+            m = match(line)
+            if m is None:
+                continue
+            kind = m.lastindex
+            pid = int(m.group(1))
+            if kind == 2:
+                ts = int(m.group(2))
+                seen.add(pid)
+                if ts < since:
+                    pending.pop(pid, None)
+                    last.pop(pid, None)
+                    continue
+                pending[pid] = ts
+                last[pid] = ts
+                data.setdefault(pid, {}).setdefault(ts, 0)
+            elif kind == 4:
+                forwarded, local = m.group(3, 4)
+                ts = pending.pop(pid, None)
+                if ts is not None:
+                    data[pid][ts] = int(forwarded) + int(local)
+                elif pid not in seen and pid not in head:
+                    head[pid] = int(forwarded) + int(local)
+            elif kind == 10:
+                server, sent, failed = m.group(8, 9, 10)
+                ts = last.get(pid)
+                if ts is not None:
+                    stats = servers.get(pid)
+                    if stats is None:
+                        stats = servers[pid] = {}
+                    stats = stats.get(ts)
+                    if stats is None:
+                        stats = servers[pid][ts] = {}
+                    stats[server] = [int(sent), int(failed)]
+                elif pid not in seen:
+                    head_servers.setdefault(pid, {})[server] = [int(sent), int(failed)]
+            else:
+                size, reused, inserted = m.group(5, 6, 7)
+                ts = last.get(pid)
+                if ts is not None:
+                    cache.setdefault(pid, {})[ts] = [int(size), int(reused), int(inserted)]
+                elif pid not in seen and pid not in head_cache:
+                    head_cache[pid] = [int(size), int(reused), int(inserted)]
+        self.lines = self.lines + n
+
+    def merge(self, other):
+        """
+        Append results of a parser that ran on the lines following ours.
+        """
+        for pid in other.head:
+            if pid in self.pending:
+                self.data[pid][self.pending.pop(pid)] = other.head[pid]
+            elif pid not in self.seen and pid not in self.head:
+                self.head[pid] = other.head[pid]
+        for pid in other.head_cache:
+            if pid in self.last:
+                self.cache.setdefault(pid, {})[self.last[pid]] = other.head_cache[pid]
+            elif pid not in self.seen and pid not in self.head_cache:
+                self.head_cache[pid] = other.head_cache[pid]
+        for pid in other.head_servers:
+            if pid in self.last:
+                self.servers.setdefault(pid, {}).setdefault(self.last[pid], {}).update(other.head_servers[pid])
+            elif pid not in self.seen:
+                self.head_servers.setdefault(pid, {}).update(other.head_servers[pid])
+        for pid in other.seen:
+            self.pending.pop(pid, None)
+            self.last.pop(pid, None)
+        for pid in other.data:
+            self.data.setdefault(pid, {}).update(other.data[pid])
+        for pid in other.cache:
+            self.cache.setdefault(pid, {}).update(other.cache[pid])
+        for pid in other.servers:
+            self.servers.setdefault(pid, {}).update(other.servers[pid])
+        self.pending.update(other.pending)
+        self.last.update(other.last)
+        self.seen.update(other.seen)
+        self.lines = self.lines + other.lines
+
+
+def read_lines(m, start, end):
+    """
+    Iterate over lines of memory map m from offset start up to offset end.
+    """
+    m.seek(start)
+    readline = m.readline
+    while m.tell() < end:
+        yield readline()
+
+
+def parse_chunk(args):
+    """
+    Parse lines of file between two offsets, in a worker process.
+    """
+    path, start, end, since, metrics = args
+    parser = Parser(since, metrics)
+    with open(path, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            parser.parse(read_lines(m, start, end))
+        finally:
+            m.close()
+    return parser
+
+
+def split_chunks(path, size=CHUNK_SIZE, start=0, since=0, metrics=False):
+    """
+    Split file into chunks of about size bytes, each ending after a newline.
+    Return list of (path, start offset, end offset, since, metrics)
+    """
+    chunks = []
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        total = f.tell()
+        while start < total:
+            end = start + size
+            if end < total:
+                f.seek(end)
+                f.readline()
+                end = f.tell()
+            else:
+                end = total
+            chunks.append((path, start, end, since, metrics))
+            start = end
+    return chunks
+
+
+def next_time(f, offset):
+    """
+    Find the first dnsmasq time stamp in a line starting at or after offset.
+    Return tuple of (offset of the line, time stamp), or (end of file, None)
+    """
+    if offset > 0:
+        f.seek(offset - 1)
+        f.readline()
+    else:
+        f.seek(0)
+    while True:
+        pos = f.tell()
+        line = f.readline()
+        if not line:
+            return pos, None
+        if DUMP_MARK not in line:
+            continue
+        m = DUMP_RE.match(line)
+        if m is not None and m.group(2) is not None:
+            return pos, int(m.group(2))
+
+
+def seek_time(path, ts):
+    """
+    Binary search file for the first cache dump with time stamp at or after ts.
+    Time stamps are assumed to increase through the file, as syslog appends.
+    Return offset of the line to start parsing from.
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        lo = 0
+        hi = f.tell()
+        while lo < hi:
+            mid = (lo + hi) // 2
+            pos, found = next_time(f, mid)
+            if found is None or found >= ts:
+                hi = mid
+            else:
+                lo = pos + 1
+        return next_time(f, lo)[0]
+
+""" ===========================================================
+Read log files
+A set of log files, given by a glob pattern or as a file with its rotated
+copies, is read oldest first. Rotated copies are ordered by their number,
+other files by modification time. Compressed files are decompressed while
+reading. Files may be parsed by several processes, then merged in order.
+=========================================================== """
+
+ROTATED_RE = re.compile(r'\.(\d+)(?:\.gz|\.bz2|\.xz)?$')
+COMPRESSED = ('.gz', '.bz2', '.xz')
+
+
+def list_logs(pattern, rotated=False):
+    """
+    Return list of log files matching pattern, oldest first.
+    With rotated, also include rotated copies such as pattern.1 and pattern.2.gz.
+    """
+    names = set(glob.glob(pattern))
+    if rotated:
+        names.update([name for name in glob.glob(pattern + '.[0-9]*') if ROTATED_RE.search(name)])
+
+    def age(name):
+        m = ROTATED_RE.search(name)
+        return (-int(m.group(1)) if m else 0, os.path.getmtime(name))
+
+    return sorted([name for name in names if os.path.isfile(name)], key=age)
+
+
+def read_log(path):
+    """
+    Iterate over lines of a plain, gzip, bzip2 or xz compressed log file.
+    """
+    proc = None
+    if path.endswith('.gz'):
+        f = io.BufferedReader(gzip.open(path, 'rb'))
+    elif path.endswith('.bz2'):
+        f = bz2.BZ2File(path, 'rb')
+    elif path.endswith('.xz') and lzma is not None:
+        f = io.BufferedReader(lzma.LZMAFile(path, 'rb'))
+    elif path.endswith('.xz'):
+        proc = subprocess.Popen(['xz', '-dc', path], stdout=subprocess.PIPE)
+        f = proc.stdout
+    else:
+        f = open(path, 'rb')
+    try:
+        for line in f:
+            yield line
+    finally:
+        f.close()
+        if proc is not None:
+            proc.wait()
+
+
+def parse_file(args):
+    """
+    Parse a whole log file, in a worker process.
+    """
+    path, since, metrics = args
+    parser = Parser(since, metrics)
+    if since > 0 and not path.endswith(COMPRESSED):
+        with open(path, 'rb') as f:
+            f.seek(seek_time(path, since))
+            parser.parse(f)
+    else:
+        parser.parse(read_log(path))
+    return parser
+
+""" ===========================================================
+Checkpoint
+Remember how far a log file has been parsed, so the next run only parses
+what has been appended since. The inode tells when logrotate has replaced
+the file, then the rest of the rotated file is read first.
+A sample is final once the next cache dump of its dnsmasq has started.
+Final samples are appended to a file of JSON lines next to the checkpoint,
+one line per run, so a run writes only what it parsed. The checkpoint keeps
+the offset and inode, and the last sample of each dnsmasq, which may still
+get its counters from lines not yet written. Lines older than
+CHECKPOINT_KEEP are dropped from the samples file about once a day.
+=========================================================== """
+
+CHECKPOINT_PRUNE = 24 * 3600
+
+
+def since(samples, ts):
+    """
+    Return samples, as Parser.data, without those before timestamp ts.
+    """
+    kept = {}
+    for pid in samples:
+        recent = dict((t, value) for t, value in samples[pid].items() if t >= ts)
+        if len(recent) > 0:
+            kept[pid] = recent
+    return kept
+
+
+def split_samples(samples, last, start):
+    """
+    Split samples, as Parser.data, at the last timestamp of each pid.
+    Return tuple of
+        final samples from timestamp start[pid] on, before last[pid]
+        samples at last[pid]
+    """
+    final = {}
+    tail = {}
+    for pid in samples:
+        end = last.get(pid)
+        begin = start.get(pid, 0)
+        for ts, value in samples[pid].items():
+            if ts == end:
+                tail.setdefault(pid, {})[ts] = value
+            elif ts >= begin and (end is None or ts < end):
+                final.setdefault(pid, {})[ts] = value
+    return final, tail
+
+
+def int_keys(samples):
+    """
+    Return samples, as Parser.data, read back from JSON with string keys.
+    """
+    return dict((int(pid), dict((int(ts), value) for ts, value in values.items()))
+                for pid, values in samples.items())
+
+
+class Checkpoint(object):
+    def __init__(self, log_file):
+        self.log_file = os.path.abspath(log_file)
+        name = self.log_file.strip('/').replace('/', '_')
+        self.path = os.path.join(CHECKPOINT_DIR, name + '.json')
+        self.samples_path = os.path.join(CHECKPOINT_DIR, name + '.samples')
+        self.inode = None
+        self.offset = 0
+        self.data = {}
+        self.pending = {}
+        self.cache = {}
+        self.servers = {}
+        self.last = {}
+        self.saved = {}
+
+    def load(self, ts=0):
+        """
+        Read checkpoint of the log file, if any, with the final samples
+        from timestamp ts.
+        """
+        if os.path.isfile(self.path) is False:
+            return
+        with open(self.path) as f:
+            saved = json.load(f)
+        self.inode = saved['inode']
+        self.offset = saved['offset']
+        self.data = int_keys(saved['data'])
+        self.pending = dict((int(pid), ts) for pid, ts in saved['pending'].items())
+        self.cache = int_keys(saved.get('cache', {}))
+        self.servers = int_keys(saved.get('servers', {}))
+        self.last = dict((int(pid), ts) for pid, ts in saved.get('last', {}).items())
+        self.load_samples(max(ts, time.time() - CHECKPOINT_KEEP))
+        self.mark_saved()
+        logger.info("%s at offset %d of inode %d", self.log_file, self.offset, self.inode)
+
+    def load_samples(self, ts):
+        """
+        Add the final samples from timestamp ts to self.data, self.cache
+        and self.servers. Rewrite the samples file without its expired lines
+        when the oldest is CHECKPOINT_PRUNE seconds past CHECKPOINT_KEEP.
+        """
+        if os.path.isfile(self.samples_path) is False:
+            return
+        oldest = time.time() - CHECKPOINT_KEEP
+        kept = []
+        prune = False
+        with open(self.samples_path) as f:
+            for line in f:
+                try:
+                    saved = json.loads(line)
+                except ValueError:
+                    logger.warning("ignore partial line in %s", self.samples_path)
+                    prune = True
+                    continue
+                if saved['last'] < oldest:
+                    prune = prune or saved['last'] < oldest - CHECKPOINT_PRUNE
+                    continue
+                kept.append(line)
+                if saved['last'] < ts:
+                    continue
+                for name, samples in (('data', self.data), ('cache', self.cache), ('servers', self.servers)):
+                    for pid, values in int_keys(saved[name]).items():
+                        samples.setdefault(pid, {}).update(values)
+        if prune:
+            tmp = self.samples_path + '.tmp'
+            with open(tmp, 'w') as f:
+                f.writelines(kept)
+            os.rename(tmp, self.samples_path)
+            logger.info("pruned %s to %d lines", self.samples_path, len(kept))
+
+    def save(self):
+        """
+        Append the samples made final since the last save, then write the
+        checkpoint. Samples and dnsmasq not seen for CHECKPOINT_KEEP seconds
+        are dropped from memory.
+        """
+        oldest = time.time() - CHECKPOINT_KEEP
+        self.data = since(self.data, oldest)
+        self.cache = since(self.cache, oldest)
+        self.servers = since(self.servers, oldest)
+        self.pending = dict((pid, ts) for pid, ts in self.pending.items() if ts >= oldest)
+        self.last = dict((pid, ts) for pid, ts in self.last.items() if ts >= oldest)
+        if os.path.isdir(CHECKPOINT_DIR) is False:
+            os.makedirs(CHECKPOINT_DIR)
+        saved = {}
+        tails = {}
+        last = 0
+        for name, samples in (('data', self.data), ('cache', self.cache), ('servers', self.servers)):
+            saved[name], tails[name] = split_samples(samples, self.last, self.saved)
+            for values in saved[name].values():
+                last = max(last, max(values))
+        if last > 0:
+            saved['last'] = last
+            with open(self.samples_path, 'a') as f:
+                f.write(json.dumps(saved, separators=(',', ':')) + '\n')
+        self.mark_saved()
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'inode': self.inode, 'offset': self.offset,
+                       'data': tails['data'], 'pending': self.pending, 'cache': tails['cache'],
+                       'servers': tails['servers'], 'last': self.last}, f, separators=(',', ':'))
+        os.rename(tmp, self.path)
+
+    def mark_saved(self):
+        """
+        Populate self.saved
+            dictionary key      pid of dnsmasq
+            dictionary value    first timestamp not yet in the samples file
+        """
+        self.saved = dict(self.last)
+        for samples in (self.data, self.cache, self.servers):
+            for pid, values in samples.items():
+                if pid not in self.last:
+                    self.saved[pid] = max(self.saved.get(pid, 0), max(values) + 1)
+
+    def read(self, parser):
+        """
+        Parse lines appended to the log file since the checkpoint.
+        A partial line at the end of the file is left for the next read.
+        """
+        stat = os.stat(self.log_file)
+        if self.inode is not None and (stat.st_ino != self.inode or stat.st_size < self.offset):
+            rotated = self.log_file + '.1'
+            if os.path.isfile(rotated) and os.stat(rotated).st_ino == self.inode:
+                logger.info("%s rotated, finish %s from offset %d", self.log_file, rotated, self.offset)
+                self.read_from(parser, rotated, self.offset)
+            else:
+                logger.warning("%s rotated, lost data after offset %d", self.log_file, self.offset)
+            self.offset = 0
+        self.inode = stat.st_ino
+        self.offset = self.read_from(parser, self.log_file, self.offset)
+
+    def read_from(self, parser, path, offset):
+        """
+        Parse complete lines of path from offset.
+        Return offset after the last complete line.
+        """
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            lines = []
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                offset = offset + len(line)
+                lines.append(line)
+                if len(lines) >= 10000:
+                    parser.parse(lines)
+                    lines = []
+            parser.parse(lines)
+        return offset
+
+""" ===========================================================
+Aggregate samples
+Samples of all dnsmasq are kept in flat arrays ordered by series then time
+stamp, in NumPy arrays or in array module buffers when NumPy is missing.
+A series is the network served by dnsmasq when known, else its PID.
+Deltas between consecutive samples of a series are summed into interval
+buckets, except that:
+- a counter lower than the one before means dnsmasq was restarted under
+  the same PID, and the new counter is taken as the delta
+- a new PID in a series means dnsmasq was restarted for the network, and
+  the new counter is taken as the delta
+- samples further apart than GAP_FACTOR times the median spacing are a
+  gap in collection, and their delta is dropped rather than put into a
+  single bucket
+The resulting Histogram is shared by the text, graph and export outputs.
+=========================================================== """
+
+
+class Histogram(object):
+    def __init__(self, period, times, queries, total, first, last,
+                 series=None, resets=0, restarts=0, gaps=0, maxima=None, minima=None):
+        """
+        period      bucket length in seconds
+        times       starting timestamp of each bucket, ascending
+        queries     number of queries in each bucket
+        total       number of queries in all buckets
+        first       starting timestamp of the first sample, None if no sample
+        last        starting timestamp of the last bucket, None if no bucket
+        series      dictionary of series to number of queries
+        resets      number of counter resets under the same PID
+        restarts    number of PID changes within a series
+        gaps        number of dropped deltas across gaps in collection
+        maxima      largest one minute sum of queries in each bucket, if rolled up
+        minima      smallest one minute sum of queries in each bucket, if rolled up
+        """
+        self.period = period
+        self.times = times
+        self.queries = queries
+        self.total = total
+        self.first = first
+        self.last = last
+        self.series = series if series is not None else {}
+        self.resets = resets
+        self.restarts = restarts
+        self.gaps = gaps
+        self.maxima = maxima
+        self.minima = minima
+
+    def items(self):
+        """
+        Iterate over (bucket timestamp, number of queries).
+        """
+        for i in range(len(self.times)):
+            yield int(self.times[i]), int(self.queries[i])
+
+    def rate(self, queries):
+        """
+        Return queries per second over one bucket.
+        """
+        return float(queries) / self.period
+
+
+def take(column, rows):
+    """
+    Return values of column at rows, a list of indexes or with NumPy a mask.
+    """
+    if numpy is not None:
+        return column[rows]
+    return array('l', [column[i] for i in rows])
+
+
+def add(a, b):
+    """
+    Return element wise sum of two columns.
+    """
+    if numpy is not None:
+        return a + b
+    return array('l', map(operator.add, a, b))
+
+
+class Samples(object):
+    def __init__(self, data, lookup=None):
+        """
+        data        dictionary of pid to dictionary of timestamp to counter,
+                    as Parser.data
+        lookup      function of (pid, timestamp) returning the network, or
+                    None, as NetworkMap.lookup
+        """
+        series = {}
+        for pid in data:
+            for ts in data[pid]:
+                key = lookup(pid, ts) if lookup is not None else None
+                key = key if key is not None else str(pid)
+                series.setdefault(key, []).append((ts, pid))
+        self.keys = sorted(series)
+        self.series = array('l')
+        self.pids = array('l')
+        self.ts = array('l')
+        self.counts = array('l')
+        for i, key in enumerate(self.keys):
+            for ts, pid in sorted(series[key]):
+                self.series.append(i)
+                self.pids.append(pid)
+                self.ts.append(ts)
+                self.counts.append(data[pid][ts])
+        if numpy is not None:
+            self.series = numpy.frombuffer(self.series, dtype=numpy.int_)
+            self.pids = numpy.frombuffer(self.pids, dtype=numpy.int_)
+            self.ts = numpy.frombuffer(self.ts, dtype=numpy.int_)
+            self.counts = numpy.frombuffer(self.counts, dtype=numpy.int_)
+
+    @classmethod
+    def from_columns(cls, keys, series, pids, ts, counts):
+        """
+        Return Samples of columns read from a Store, where records are in
+        time order.
+        keys        names of the series
+        series      index in keys of the series of each sample
+        """
+        samples = cls({})
+        samples.keys = keys
+        if numpy is not None:
+            order = numpy.argsort(series, kind='mergesort')
+            samples.series = series[order]
+            samples.pids = pids[order]
+            samples.ts = ts[order]
+            samples.counts = counts[order]
+        else:
+            order = sorted(range(len(series)), key=series.__getitem__)
+            samples.series = take(series, order)
+            samples.pids = take(pids, order)
+            samples.ts = take(ts, order)
+            samples.counts = take(counts, order)
+        return samples
+
+    def spacing(self):
+        """
+        Return the median spacing between samples of a series, 0 if no series
+        has two samples.
+        """
+        if numpy is not None:
+            spacing = numpy.diff(self.ts)[self.series[1:] == self.series[:-1]]
+            return int(numpy.median(spacing)) if len(spacing) > 0 else 0
+        spacing = sorted(self.ts[i] - self.ts[i - 1] for i in range(1, len(self.ts))
+                         if self.series[i] == self.series[i - 1])
+        return spacing[len(spacing) // 2] if len(spacing) > 0 else 0
+
+    def max_gap(self):
+        """
+        Return the longest spacing between samples of a series not taken
+        as a gap in collection.
+        """
+        return GAP_FACTOR * max(self.spacing(), 1)
+
+    def deltas(self, max_gap=None):
+        """
+        Compute the number of queries from each sample to the next in its series.
+        max_gap     longest spacing not taken as a gap, max_gap() by default
+        Return tuple of (timestamps, series, deltas, first timestamp, resets, restarts, gaps),
+        where timestamps, series and deltas are columns of the samples whose delta is kept,
+        and first timestamp is that of the earliest sample.
+        """
+        if max_gap is None:
+            max_gap = self.max_gap()
+        if numpy is not None:
+            return self.deltas_numpy(max_gap)
+        tms = []
+        owners = []
+        deltas = []
+        first = None
+        resets = restarts = gaps = 0
+        for i in range(len(self.ts)):
+            if i == 0 or self.series[i] != self.series[i - 1]:
+                first = self.ts[i] if first is None else min(first, self.ts[i])
+                continue
+            if self.pids[i] != self.pids[i - 1]:
+                restarts = restarts + 1
+                delta = self.counts[i]
+            elif self.counts[i] < self.counts[i - 1]:
+                resets = resets + 1
+                delta = self.counts[i]
+            else:
+                delta = self.counts[i] - self.counts[i - 1]
+            if self.ts[i] - self.ts[i - 1] > max_gap:
+                gaps = gaps + 1
+                continue
+            tms.append(self.ts[i])
+            owners.append(self.series[i])
+            deltas.append(delta)
+        return tms, owners, deltas, first, resets, restarts, gaps
+
+    def deltas_numpy(self, max_gap):
+        """
+        Same as deltas(), with NumPy operations on whole arrays.
+        """
+        start = numpy.ones(len(self.ts), dtype=bool)
+        start[1:] = self.series[1:] != self.series[:-1]
+        first = int(self.ts[start].min())
+        same = ~start[1:]
+        restart = same & (self.pids[1:] != self.pids[:-1])
+        deltas = numpy.diff(self.counts)
+        reset = same & ~restart & (deltas < 0)
+        deltas = numpy.where(restart | reset, self.counts[1:], deltas)
+        gap = same & (numpy.diff(self.ts) > max_gap)
+        keep = same & ~gap
+        return (self.ts[1:][keep], self.series[1:][keep], deltas[keep], first,
+                int(reset.sum()), int(restart.sum()), int(gap.sum()))
+
+    def histogram(self, interval):
+        """
+        Put samples into buckets of interval minutes.
+        Return Histogram
+        """
+        period = interval * 60
+        if len(self.ts) == 0:
+            return Histogram(period, [], [], 0, None, None)
+        tms, owners, deltas, first, resets, restarts, gaps = self.deltas()
+        first = first // period * period
+        if numpy is not None:
+            totals = numpy.bincount(owners, weights=deltas, minlength=len(self.keys))
+            series = dict((key, int(totals[i])) for i, key in enumerate(self.keys))
+            if len(tms) == 0:
+                return Histogram(period, [], [], 0, first, None, series, resets, restarts, gaps)
+            times, index = numpy.unique(tms // period * period, return_inverse=True)
+            queries = numpy.bincount(index, weights=deltas).astype(numpy.int_)
+            return Histogram(period, times, queries, int(deltas.sum()), first, int(times[-1]),
+                             series, resets, restarts, gaps)
+        buckets = {}
+        series = dict((key, 0) for key in self.keys)
+        for i in range(len(tms)):
+            tm = tms[i] // period * period
+            buckets[tm] = buckets.get(tm, 0) + deltas[i]
+            series[self.keys[owners[i]]] += deltas[i]
+        times = sorted(buckets)
+        queries = [buckets[tm] for tm in times]
+        return Histogram(period, times, queries, sum(deltas), first, times[-1] if times else None,
+                         series, resets, restarts, gaps)
 
 """ ===========================================================
 Extract data
@@ -112,19 +1809,43 @@ Extract data
 
 
 class Extract(object):
-    def __init__(self, log_file=FILE_DEFAULT, ts=TIMESTAMP_DEFAULT, interval=INTERVAL_DEFAULT):
+    def __init__(self, log_file=FILE_DEFAULT, ts=TIMESTAMP_DEFAULT, interval=INTERVAL_DEFAULT,
+                 jobs=JOBS_DEFAULT, incremental=False, rotated=False, output=None, networks=False,
+                 metrics=False, series=False):
+        """
+        log_file        log file, or glob pattern of log files
+        incremental     parse only what is appended since the last run, see Checkpoint
+        rotated         also parse the rotated copies of log_file
+        output          CSV file to export histogram to, if any
+        networks        also show queries of each network
+        metrics         also show cache and upstream server metrics
+        series          extract from STORE_FILE written by Collect instead of log_file
+        """
         self.log_file = log_file
         self.ts = ts
         self.interval = interval
+        self.jobs = jobs
+        self.rotated = rotated
+        self.output = output
+        self.networks = networks
+        self.metrics = metrics
+        self.series = series
+        self.network_map = NetworkMap()
+        self.checkpoint = Checkpoint(log_file) if incremental else None
         self.data = {}
-        self.buckets = {}
-        self.x_dates = []
-        self.y_queries = []
+        self.cache = {}
+        self.servers = {}
+        self.store = Store(STORE_FILE, SAMPLE_FIELDS)
+        self.server_store = Store(SERVERS_FILE, SERVER_FIELDS)
+        self.columns = None
+        self.server_columns = None
+        self.rolled_up = None
+        self.histogram = None
+        self.cache_sizes = {}
+        self.metric_histograms = []
         self.first_dt = None
         self.last_dt = None
-        logger.info("%s:%s() %d: process file %s, starting from timestamp %d, at %d minutes interval",
-                    self.__class__.__name__,
-                    sys._getframe().f_code.co_name, sys._getframe().f_lineno,
+        logger.info("process file %s, starting from timestamp %d, at %d minutes interval",
                     self.log_file, self.ts, self.interval)
 
     def run(self):
@@ -139,8 +1860,15 @@ class Extract(object):
             Feb 26 17:33:49 svl6-csl-b-net-001 dnsmasq[6336]: server 173.37.87.157#53: queries sent 0, retried or failed 0
         """
         self.get_data()
-        if len(self.data) > 0:
+        if len(self.data) > 0 or self.columns is not None or self.rolled_up is not None:
             self.show_data()
+            if self.networks:
+                self.show_networks()
+            if self.metrics:
+                self.show_cache()
+                self.show_servers()
+            if self.output:
+                self.export(self.output)
             self.show_graph()
         else:
             print("No data found!")
@@ -153,85 +1881,385 @@ class Extract(object):
                                 key = timestamp
                                 value = number of forwarded + answered queries
         """
-        if os.path.isfile(self.log_file) is False:
-            logger.error("%s:%s() %d: invalid %s", self.__class__.__name__,
-                         sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                         self.log_file)
+        if self.series:
+            if not self.networks and not self.metrics:
+                self.rolled_up = self.read_rollup()
+            if self.rolled_up is None:
+                self.read_store()
+            return
+        files = list_logs(self.log_file, self.rotated)
+        if len(files) == 0:
+            logger.error("invalid %s", self.log_file)
             return
-        ts = 0
+        parser = Parser(self.ts, self.metrics)
         start = time.time()
-        with open(self.log_file) as f:
-            for line in f:
-                try:
-                    m1 = re.search("dnsmasq\[\d+]", line)
-                    if m1:
-                        words = line.split()
-                        p1 = words[4].split('[')
-                        p2 = p1[-1].split(']')
-                        pid = int(p2[0])
-                        if pid not in self.data:
-                            self.data[pid] = {}
-                        m2 = re.search("dnsmasq\[\d+]: time ", line)
-                        if m2:
-                            ts = int(words[-1])
-                            if ts not in self.data[pid]:
-                                self.data[pid][ts] = 0
-                        elif ts != 0:
-                            m3 = re.search("dnsmasq\[\d+]: queries forwarded ", line)
-                            if m3:
-                                self.data[pid][ts] = int(words[7].rstrip(',')) + int(words[-1])
-                                ts = 0
-                except:
-                    logger.warning("%s:%s() %d: failed to process '%s'",
-                                   self.__class__.__name__,
-                                   sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                                   line)
+        if len(files) > 1 or files[0].endswith(COMPRESSED):
+            if self.checkpoint is not None:
+                logger.warning("no checkpoint for %d files in %s", len(files), self.log_file)
+            self.read_files(parser, files)
+        elif self.checkpoint is not None:
+            self.read_checkpoint(parser)
+        else:
+            self.read_file(parser)
+        self.data = parser.data
+        self.cache = parser.cache
+        self.servers = parser.servers
+        metrics.count('lines', parser.lines)
         duration = time.time() - start
-        logger.info("%s:%s() %d: processed %d dnsmasq cache records in %d seconds", self.__class__.__name__,
-                    sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                    len(self.data), duration)
+        logger.info("processed %d dnsmasq cache records from %d lines in %d seconds, %d lines/sec",
+                    len(self.data), parser.lines, duration, parser.lines / max(duration, 0.001))
 
-    def show_data(self):
+    @metrics.timed('load')
+    def read_store(self):
+        """
+        Read samples from timestamp self.ts in STORE_FILE, and in SERVERS_FILE for metrics.
+        Populate self.columns and self.server_columns
+            dictionary key      name of field, see SAMPLE_FIELDS and SERVER_FIELDS
+            dictionary value    column of numbers
+        """
+        start = time.time()
+        self.columns = self.store.load(self.ts)
+        if self.columns is None:
+            logger.error("no samples in %s", STORE_FILE)
+            return
+        if self.metrics:
+            self.server_columns = self.server_store.load(self.ts)
+        duration = time.time() - start
+        logger.info("loaded %d samples in %.3f seconds", len(self.columns['ts']), duration)
+
+    @metrics.timed('load')
+    def read_rollup(self):
         """
-        Put data from each dnsmasq into buckets.
-        Then display histogram.
-        buckets     key = ending timestamp of bucket
-                    value = number of queries
+        Bring the rollup of STORE_FILE up to date, when allowed to, and make
+        the histogram from the coarsest tier that fits self.interval.
+        Return Histogram, or None if no tier fits.
         """
-        print("\n%-20s  %s" % ("Ending Date/Time", "DNS Queries"))
-        print("%-20s  %s" % ("----------------", "-----------"))
+        start = time.time()
+        rollup = Rollup(ROLLUP_FILE, self.store)
+        try:
+            rollup.update()
+        except (IOError, OSError) as e:
+            logger.warning("rollup not updated, %s", e)
         period = self.interval * 60
-        total = 0
-        for pid in self.data:
-            last_ts = 0
-            last_count = 0
-            for ts in sorted(self.data[pid]):
-                tm = ts / period * period
-                if last_ts != 0:
-                    if tm not in self.buckets:
-                        self.buckets[tm] = 0
-                    self.buckets[tm] = self.buckets[tm] + self.data[pid][ts] - last_count
-                    total = total + self.data[pid][ts] - last_count
-                    last_tm = tm
+        picked = rollup.tier(period, self.ts)
+        if picked is None:
+            return None
+        tier_period, buckets = picked
+        sums = {}
+        maxima = {}
+        minima = {}
+        for ts, total, high, low in buckets:
+            tm = ts // period * period
+            sums[tm] = sums.get(tm, 0) + total
+            maxima[tm] = max(maxima.get(tm, high), high)
+            minima[tm] = min(minima.get(tm, low), low)
+        times = sorted(sums)
+        first = times[0] if times else None
+        last = times[-1] if times else None
+        histogram = Histogram(period, times, [sums[tm] for tm in times], sum(sums.values()), first, last,
+                              maxima=[maxima[tm] for tm in times], minima=[minima[tm] for tm in times])
+        duration = time.time() - start
+        logger.info("%d buckets from %d seconds tier in %.3f seconds", len(times), tier_period, duration)
+        return histogram
+
+    def store_samples(self, columns, counts, rows=None):
+        """
+        Return Samples of counts from columns of a store, with the series of each network.
+        Network numbers of both stores are those of self.store.
+        rows        selection of the records, all if None
+        """
+        series = columns['network']
+        pids = columns['pid']
+        ts = columns['ts']
+        if rows is not None:
+            series, pids, ts, counts = [take(column, rows) for column in (series, pids, ts, counts)]
+        return Samples.from_columns(self.store.names.get('network', []), series, pids, ts, counts)
+
+    @metrics.timed('parse')
+    def read_file(self, parser):
+        """
+        Parse the whole log file, or from timestamp self.ts, with self.jobs processes.
+        """
+        offset = 0
+        if self.ts > 0:
+            offset = seek_time(self.log_file, self.ts)
+            logger.info("skip %d bytes before timestamp %d", offset, self.ts)
+        if self.jobs > 1:
+            chunks = split_chunks(self.log_file, CHUNK_SIZE, offset, self.ts, self.metrics)
+            pool = multiprocessing.Pool(self.jobs)
+            try:
+                for part in pool.imap(parse_chunk, chunks):
+                    parser.merge(part)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            with open(self.log_file) as f:
+                f.seek(offset)
+                parser.parse(f)
+
+    @metrics.timed('parse')
+    def read_files(self, parser, files):
+        """
+        Parse log files in order, with self.jobs processes.
+        """
+        logger.info("process %s", ', '.join(files))
+        if self.jobs > 1:
+            pool = multiprocessing.Pool(self.jobs)
+            try:
+                for part in pool.imap(parse_file, [(name, self.ts, self.metrics) for name in files]):
+                    parser.merge(part)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for name in files:
+                parser.merge(parse_file((name, self.ts, self.metrics)))
+
+    @metrics.timed('parse')
+    def read_checkpoint(self, parser):
+        """
+        Parse the log file from the checkpoint of the last run, then save a new checkpoint.
+        Without a checkpoint, start from timestamp self.ts.
+        """
+        if self.checkpoint.inode is None:
+            self.checkpoint.load(self.ts)
+        if self.checkpoint.inode is None and self.ts > 0:
+            self.checkpoint.offset = seek_time(self.log_file, self.ts)
+        parser.data = self.checkpoint.data
+        parser.pending = self.checkpoint.pending
+        parser.cache = self.checkpoint.cache
+        parser.servers = self.checkpoint.servers
+        parser.last = self.checkpoint.last
+        self.checkpoint.read(parser)
+        self.checkpoint.save()
+        parser.data = since(self.checkpoint.data, self.ts)
+        parser.cache = since(self.checkpoint.cache, self.ts)
+        parser.servers = since(self.checkpoint.servers, self.ts)
+
+    @metrics.timed('process')
+    def get_histogram(self):
+        """
+        Put data from each dnsmasq into buckets of self.interval minutes.
+        Populate and return self.histogram
+        """
+        if self.rolled_up is not None:
+            self.histogram = self.rolled_up
+            return self.histogram
+        start = time.time()
+        if self.columns is not None:
+            columns = self.columns
+            samples = self.store_samples(columns, add(columns['forwarded'], columns['answered']))
+        else:
+            if len(self.network_map.pids) == 0:
+                self.network_map.load()
+            samples = Samples(self.data, self.network_map.lookup)
+        self.histogram = samples.histogram(self.interval)
+        duration = time.time() - start
+        logger.info("%d buckets in %.3f seconds, %d resets, %d restarts, %d gaps",
+                    len(self.histogram.times), duration, self.histogram.resets,
+                    self.histogram.restarts, self.histogram.gaps)
+        return self.histogram
+
+    def show_data(self):
+        """
+        Display histogram.
+        """
+        histogram = self.get_histogram()
+        if histogram.maxima is None:
+            print("\n%-20s  %-11s  %s" % ("Ending Date/Time", "DNS Queries", "Queries/s"))
+            print("%-20s  %-11s  %s" % ("----------------", "-----------", "---------"))
+        else:
+            print("\n%-20s  %-11s  %-9s  %-13s  %s" % ("Ending Date/Time", "DNS Queries", "Queries/s",
+                                                      "Busiest Min", "Quietest Min"))
+            print("%-20s  %-11s  %-9s  %-13s  %s" % ("----------------", "-----------", "---------",
+                                                    "-----------", "------------"))
+        for i, (ts, queries) in enumerate(histogram.items()):
+            dt = datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+            if histogram.maxima is None:
+                print("%-20s  %-11d  %.2f" % (dt, queries, histogram.rate(queries)))
+            else:
+                print("%-20s  %-11d  %-9.2f  %-13d  %d" % (dt, queries, histogram.rate(queries),
+                                                          histogram.maxima[i], histogram.minima[i]))
+        if histogram.first is None or histogram.last is None:
+            print("\nNot enough samples to count queries")
+            return
+        self.first_dt = datetime.fromtimestamp(histogram.first).strftime("%Y-%m-%d %H:%M:%S")
+        self.last_dt = datetime.fromtimestamp(histogram.last).strftime("%Y-%m-%d %H:%M:%S")
+        print("\n%d queries from %s to %s" % (histogram.total, self.first_dt, self.last_dt))
+        if histogram.maxima is None:
+            print("%d counter resets, %d dnsmasq restarts, %d gaps in collection" %
+                  (histogram.resets, histogram.restarts, histogram.gaps))
+
+    def show_networks(self):
+        """
+        Display queries of each network, or of each PID whose network is unknown.
+        """
+        if self.histogram is None:
+            self.get_histogram()
+        print("\n%-36s  %s" % ("Network", "DNS Queries"))
+        print("%-36s  %s" % ("-------", "-----------"))
+        series = self.histogram.series
+        for key in sorted(series, key=lambda k: series[k], reverse=True):
+            print("%-36s  %d" % (key, series[key]))
+
+    def get_metrics(self):
+        """
+        Put cache and upstream server counters into buckets of self.interval minutes.
+        Populate self.metric_histograms
+            list of (metric name, Histogram), for
+                cache_inserted      cache insertions
+                cache_evicted       cache insertions that re-used unexpired entries
+                sent:<server>       queries sent to upstream server
+                failed:<server>     queries to upstream server retried or failed
+        Populate self.cache_sizes
+            dictionary key      network, or PID of dnsmasq when network is unknown
+            dictionary value    last cache size
+        """
+        if self.columns is not None:
+            return self.get_store_metrics()
+        if len(self.network_map.pids) == 0:
+            self.network_map.load()
+        lookup = self.network_map.lookup
+
+        def column(samples, get):
+            return dict((pid, dict((ts, get(value)) for ts, value in samples[pid].items()))
+                        for pid in samples)
+
+        self.metric_histograms = [
+            ('cache_inserted', Samples(column(self.cache, lambda v: v[2]), lookup).histogram(self.interval)),
+            ('cache_evicted', Samples(column(self.cache, lambda v: v[1]), lookup).histogram(self.interval))]
+        names = set()
+        for pid in self.servers:
+            for stats in self.servers[pid].values():
+                names.update(stats)
+        for name in sorted(names):
+            samples = dict((pid, dict((ts, stats[name]) for ts, stats in self.servers[pid].items()
+                                      if name in stats))
+                           for pid in self.servers)
+            samples = dict((pid, values) for pid, values in samples.items() if len(values) > 0)
+            self.metric_histograms.append(('sent:' + name, Samples(column(samples, lambda v: v[0]),
+                                                                   lookup).histogram(self.interval)))
+            self.metric_histograms.append(('failed:' + name, Samples(column(samples, lambda v: v[1]),
+                                                                     lookup).histogram(self.interval)))
+        self.cache_sizes = {}
+        for pid in self.cache:
+            ts = max(self.cache[pid])
+            key = lookup(pid, ts)
+            self.cache_sizes[key if key is not None else str(pid)] = self.cache[pid][ts][0]
+        return self.metric_histograms
+
+    def get_store_metrics(self):
+        """
+        Same as get_metrics(), from the columns of the stores.
+        """
+        columns = self.columns
+        self.metric_histograms = [
+            ('cache_inserted', self.store_samples(columns, columns['inserted']).histogram(self.interval)),
+            ('cache_evicted', self.store_samples(columns, columns['evicted']).histogram(self.interval))]
+        servers = self.server_columns
+        if servers is not None:
+            for number, name in sorted(enumerate(self.server_store.names.get('server', [])), key=lambda x: x[1]):
+                if numpy is not None:
+                    rows = servers['server'] == number
                 else:
-                    first_tm = tm
-                last_ts = ts
-                last_count = self.data[pid][ts]
-        for ts in sorted(self.buckets):
-            dts = datetime.fromtimestamp(ts)
-            self.x_dates.append(dates.date2num(dts))
-            self.y_queries.append(self.buckets[ts])
-            dt = dts.strftime("%Y-%m-%d %H:%M:%S")
-            print("%-20s  %d" % (dt, self.buckets[ts]))
-        self.first_dt = datetime.fromtimestamp(first_tm).strftime("%Y-%m-%d %H:%M:%S")
-        self.last_dt = datetime.fromtimestamp(last_tm).strftime("%Y-%m-%d %H:%M:%S")
-        print("\n%d queries from %s to %s" % (total, self.first_dt, self.last_dt))
+                    rows = [i for i, value in enumerate(servers['server']) if value == number]
+                for counter in ('sent', 'failed'):
+                    samples = self.store_samples(servers, servers[counter], rows)
+                    self.metric_histograms.append((counter + ':' + name, samples.histogram(self.interval)))
+        networks = self.store.names.get('network', [])
+        if numpy is not None:
+            numbers, last = numpy.unique(columns['network'][::-1], return_index=True)
+            sizes = columns['cache_size'][::-1][last]
+        else:
+            last = dict(zip(columns['network'], columns['cache_size']))
+            numbers, sizes = list(last), list(last.values())
+        self.cache_sizes = dict((networks[number], int(size)) for number, size in zip(numbers, sizes))
+        return self.metric_histograms
+
+    def show_cache(self):
+        """
+        Display cache pressure of each network, the share of cache insertions
+        that had to re-use an unexpired entry. A high share asks for a larger
+        cache size.
+        """
+        if len(self.metric_histograms) == 0:
+            self.get_metrics()
+        metrics = dict(self.metric_histograms)
+        inserted = metrics['cache_inserted'].series
+        evicted = metrics['cache_evicted'].series
+        if len(self.cache_sizes) == 0:
+            print("\nNo cache statistics found")
+            return
+
+        def pressure(key):
+            return float(evicted.get(key, 0)) / inserted[key] if inserted.get(key, 0) > 0 else 0.0
+
+        print("\n%-36s  %-10s  %-10s  %-10s  %s" % ("Network", "Cache Size", "Insertions", "Evictions",
+                                                   "Pressure"))
+        print("%-36s  %-10s  %-10s  %-10s  %s" % ("-------", "----------", "----------", "---------",
+                                                 "--------"))
+        for key in sorted(self.cache_sizes, key=pressure, reverse=True):
+            print("%-36s  %-10d  %-10d  %-10d  %.1f%%" % (key, self.cache_sizes[key], inserted.get(key, 0),
+                                                         evicted.get(key, 0), 100 * pressure(key)))
+
+    def show_servers(self):
+        """
+        Display queries sent to each upstream server, and how many were
+        retried or failed, in total and at the worst bucket.
+        """
+        if len(self.metric_histograms) == 0:
+            self.get_metrics()
+        metrics = dict(self.metric_histograms)
+        names = sorted(name[len('sent:'):] for name in metrics if name.startswith('sent:'))
+        if len(names) == 0:
+            print("\nNo upstream server statistics found")
+            return
+        print("\n%-24s  %-10s  %-10s  %-8s  %s" % ("Upstream Server", "Sent", "Failed", "Failed %",
+                                                  "Peak Failed/s"))
+        print("%-24s  %-10s  %-10s  %-8s  %s" % ("---------------", "----", "------", "--------",
+                                                "-------------"))
+        for name in names:
+            sent = metrics['sent:' + name]
+            failed = metrics['failed:' + name]
+            share = 100.0 * failed.total / sent.total if sent.total > 0 else 0.0
+            peak = max([failed.rate(queries) for _, queries in failed.items()] or [0.0])
+            print("%-24s  %-10d  %-10d  %-8.1f  %.2f" % (name, sent.total, failed.total, share, peak))
+
+    def follow(self):
+        """
+        Keep parsing what is appended to the log file, and display buckets
+        as they are added or updated.
+        """
+        shown = {}
+        print("\n%-20s  %-11s  %s" % ("Ending Date/Time", "DNS Queries", "Queries/s"))
+        print("%-20s  %-11s  %s" % ("----------------", "-----------", "---------"))
+        while True:
+            self.get_data()
+            histogram = self.get_histogram()
+            for ts, queries in histogram.items():
+                if shown.get(ts) != queries:
+                    dt = datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+                    print("%-20s  %-11d  %.2f" % (dt, queries, histogram.rate(queries)))
+                    shown[ts] = queries
+            sys.stdout.flush()
+            time.sleep(FOLLOW_DEFAULT)
 
     def show_graph(self):
+        if pyplot is None:
+            logger.warning("matplotlib is not installed")
+            return
+        if self.histogram is None:
+            self.get_histogram()
+        x_dates = []
+        y_queries = []
+        for ts, queries in self.histogram.items():
+            x_dates.append(dates.date2num(datetime.fromtimestamp(ts)))
+            y_queries.append(queries)
         fmt = dates.DateFormatter('%m/%d %H:%M')
         fig = pyplot.figure()
         ax = fig.add_subplot(111)
-        ax.vlines(self.x_dates, 0, self.y_queries, color='k', linestyle='solid')
+        ax.vlines(x_dates, 0, y_queries, color='k', linestyle='solid')
         ax.xaxis.set_major_locator(dates.HourLocator())
         ax.xaxis.set_major_formatter(fmt)
         ax.set_ylim(bottom=0)
@@ -242,22 +2270,62 @@ class Extract(object):
         pyplot.subplots_adjust(bottom=.3)
         pyplot.show()
 
+    def export(self, path):
+        """
+        Write histogram to a CSV file.
+        """
+        if self.histogram is None:
+            self.get_histogram()
+        if self.metrics and len(self.metric_histograms) == 0:
+            self.get_metrics()
+        columns = [(name, dict(histogram.items())) for name, histogram in self.metric_histograms]
+        with open(path, 'w') as f:
+            f.write(','.join(["timestamp", "date", "queries", "rate"] + [name for name, _ in columns]) + "\n")
+            for ts, queries in self.histogram.items():
+                dt = datetime.fromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
+                values = ''.join(",%d" % (buckets.get(ts, 0)) for _, buckets in columns)
+                f.write("%d,%s,%d,%.3f%s\n" % (ts, dt, queries, self.histogram.rate(queries), values))
+        logger.info("exported %d buckets to %s", len(self.histogram.times), path)
+
     def help(self):
-        print("dns_tools.py extract -f F -t T -i I")
+        print("dns_tools.py extract -f F -t T -i I -j J")
         print("    Extract DNS queries from file F since timestamp T and show histogram every I minutes.")
+        print("    Use J processes to extract from a large file.")
+        print("dns_tools.py extract -f F -r -t T -i I -j J")
+        print("    Extract DNS queries from file F and its rotated copies F.1, F.2.gz, ..., oldest first.")
+        print("    F may also be a glob pattern. Compressed files are read without unpacking them.")
+        print("dns_tools.py extract -f F -i I -c [ -F ]")
+        print("    Extract DNS queries appended to file F since the last run with -c.")
+        print("    With -F, keep following file F and show histogram as it is updated.")
+        print("    F must be a single file, not a glob pattern.")
+        print("dns_tools.py extract -f F -t T -i I -n")
+        print("    Also show DNS queries of each network. A dnsmasq restart stays in its network,")
+        print("    using the PID of each network recorded by collect.")
+        print("dns_tools.py extract -f F -t T -i I -m")
+        print("    Also show cache pressure of each network, and queries sent and failed for each")
+        print("    upstream server.")
+        print("dns_tools.py extract -S -t T -i I")
+        print("    Extract DNS queries collected with the chaos backend into %s." % STORE_FILE)
+        print("    Without -m or -n, the histogram comes from the coarsest rollup tier of")
+        print("    1, 5, 60 or 1440 minutes that divides I, with the busiest and quietest minute.")
+        print("dns_tools.py extract -f F -t T -i I -o O")
+        print("    Extract DNS queries from file F since timestamp T and export histogram to CSV file O.")
+        print("dns_tools.py extract -f F -t T -i I -x X")
+        print("    Also write parse, load and process timers and counters to X, as JSON if X ends")
+        print("    in .json, otherwise as a Prometheus textfile for the node exporter.")
 
 """ ===========================================================
 Logging
+Messages are only formatted when their level is enabled. The caller and
+line of each message are filled in by the handler, see tool_common.
 =========================================================== """
 logger = logging.getLogger('dns_tools')
 
 
 def do_logging():
-    formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
-    handler = handlers.RotatingFileHandler(LOG_FILE, maxBytes=10485760, backupCount=3)
+    handler = log_handler(handlers.RotatingFileHandler(LOG_FILE, maxBytes=10485760, backupCount=3))
     logger.addHandler(handler)
     logger.setLevel(logging.INFO)
-    handler.setFormatter(formatter)
 
 """ ===========================================================
 Option Parsing
@@ -268,49 +2336,81 @@ EXTRACT_ARGS = 4
 
 
 def do_parsing():
-    file_help = "Text file with output of dnsmasq cache dump. Default is %s." % FILE_DEFAULT
+    backend_help = "Collect with chaos queries or signal. Default is %s." % BACKEND_DEFAULT
+    checkpoint_help = "Extract only data appended since the last run. Checkpoint is kept in %s." % CHECKPOINT_DIR
+    follow_help = "Keep following the file, and show histogram as it is updated."
+    file_help = "Text file, or glob pattern of files, with output of dnsmasq cache dump. Default is %s." % FILE_DEFAULT
     help_help = "Show this help message and exit."
+    metrics_help = "Also show cache and upstream server metrics."
+    networks_help = "Also show queries of each network."
+    output_help = "Export histogram to this CSV file."
+    jobs_help = "Number of processes to extract data with. Default is %s." % JOBS_DEFAULT
     interval_help = "Interval to collect samples in minutes. Default is every %s minutes." % INTERVAL_DEFAULT
+    rotated_help = "Also extract from rotated copies of the file, which may be compressed."
+    stats_help = ("Export phase timers and counters to this file, as JSON if it ends in .json, "
+                  "otherwise as a Prometheus textfile.")
+    series_help = "Extract from samples collected with the chaos backend in %s." % STORE_FILE
     sample_help = "Number of samples to collect. Default is %s." % SAMPLE_DEFAULT
     timestamp_help = "Extract data starting from specified time stamp.  Default is %s seconds." % TIMESTAMP_DEFAULT
 
     parser = OptionParser(add_help_option=False)
+    parser.add_option('-b', '--backend', action='store', dest='backend', type='choice',
+                      choices=['chaos', 'signal'], help=backend_help, metavar='BACKEND',
+                      default=BACKEND_DEFAULT)
+    parser.add_option('-c', '--checkpoint', action='store_true', dest='checkpoint',
+                      help=checkpoint_help, metavar='CHECKPOINT')
+    parser.add_option('-F', '--follow', action='store_true', dest='follow',
+                      help=follow_help, metavar='FOLLOW')
     parser.add_option('-f', '--file', action='store', dest='log_file',
                       help=file_help, metavar='FILE', default=FILE_DEFAULT)
     parser.add_option('-h', '--help', action='store_true', dest='help',
                       help=help_help, metavar='HELP')
     parser.add_option('-i', '--interval', action='store', dest='interval',
                       help=interval_help, metavar='INTERVAL', default=INTERVAL_DEFAULT)
+    parser.add_option('-j', '--jobs', action='store', dest='jobs',
+                      help=jobs_help, metavar='JOBS', default=JOBS_DEFAULT)
+    parser.add_option('-m', '--metrics', action='store_true', dest='metrics',
+                      help=metrics_help, metavar='METRICS')
+    parser.add_option('-n', '--networks', action='store_true', dest='networks',
+                      help=networks_help, metavar='NETWORKS')
+    parser.add_option('-o', '--output', action='store', dest='output',
+                      help=output_help, metavar='OUTPUT')
+    parser.add_option('-r', '--rotated', action='store_true', dest='rotated',
+                      help=rotated_help, metavar='ROTATED')
+    parser.add_option('-S', '--series', action='store_true', dest='series',
+                      help=series_help, metavar='SERIES')
     parser.add_option('-s', '--sample', action='store', dest='sample',
                       help=sample_help, metavar='SAMPLE', default=SAMPLE_DEFAULT)
     parser.add_option('-t', '--timestamp', action='store', dest='timestamp',
                       help=timestamp_help, metavar='TIMESTAMP', default=TIMESTAMP_DEFAULT)
+    parser.add_option('-x', '--stats', action='store', dest='stats',
+                      help=stats_help, metavar='FILE')
 
     def usage():
         parser.print_help()
         print "\nSupported Operations:"
-        print "  dns_tools.py collect [ -h ] [ -s <value> ] [ -i <value> ]"
-        print "  dns_tools.py extract [ -h ] [ -f <name> ] [ -t <value> ] [ -i <value ]"
+        print "  dns_tools.py collect [ -h ] [ -s <value> ] [ -i <value> ] [ -b chaos|signal ] [ -x <name> ]"
+        print "  dns_tools.py extract [ -h ] [ -f <name> ] [ -t <value> ] [ -i <value> ] [ -j <value> ] [ -r ] [ -c [ -F ] ] [ -m ] [ -n ] [ -o <name> ] [ -x <name> ]"
+        print "  dns_tools.py extract [ -h ] -S [ -t <value> ] [ -i <value> ] [ -m ] [ -n ] [ -o <name> ] [ -x <name> ]"
         sys.exit()
 
     flags, args = parser.parse_args()
+    metrics.path = flags.stats
     if flags.help and len(args) == 0:
         usage()
 
     if len(args) == 0 or (args[0] != 'collect' and args[0] != 'extract'):
-        logger.error("%s() %d: invalid options!",
-                     __name__, sys._getframe().f_lineno)
+        logger.error("invalid options!")
         print("\nInvalid options!\n")
         usage()
 
     if args[0] == 'collect':
         if len(args) > COLLECT_ARGS:
-            logger.error("%s() %d: too many arguments!",
-                         __name__, sys._getframe().f_lineno)
+            logger.error("too many arguments!")
             print("\nToo many arguments!\n")
             usage()
         try:
-            collect = Collect(int(flags.sample), int(flags.interval))
+            collect = Collect(int(flags.sample), int(flags.interval), flags.backend)
             if flags.help:
                 collect.help()
             else:
@@ -319,14 +2419,22 @@ def do_parsing():
             pass
     elif args[0] == 'extract':
         if len(args) > EXTRACT_ARGS:
-            logger.error("%s() %d: too many arguments!",
-                         __name__, sys._getframe().f_lineno)
+            logger.error("too many arguments!")
             print("\nToo many arguments!\n")
             usage()
+        if (flags.checkpoint or flags.follow) and glob.has_magic(flags.log_file):
+            logger.error("checkpoint of glob pattern %s", flags.log_file)
+            print("\nOptions -c and -F need a single file, not a glob pattern!\n")
+            usage()
         try:
-            extract = Extract(flags.log_file, int(flags.timestamp), int(flags.interval))
+            extract = Extract(flags.log_file, int(flags.timestamp), int(flags.interval), int(flags.jobs),
+                              flags.checkpoint is True or flags.follow is True, flags.rotated is True,
+                              flags.output, flags.networks is True, flags.metrics is True,
+                              flags.series is True)
             if flags.help:
                 extract.help()
+            elif flags.follow:
+                extract.follow()
             else:
                 extract.run()
         except:
@@ -338,4 +2446,7 @@ Main Program.
 
 if __name__ == "__main__":
     do_logging()
-    do_parsing()
+    try:
+        do_parsing()
+    finally:
+        metrics.export()
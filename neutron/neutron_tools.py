@@ -11,13 +11,22 @@ import sys
 import os
 import time
 import MySQLdb
+import MySQLdb.cursors
 from ConfigParser import RawConfigParser
 from optparse import OptionParser
 from datetime import datetime, timedelta
 from urlparse import urlparse
 import collections
+import gzip
+import hashlib
+import json
 import random
 import subprocess
+import shlex
+import signal
+import threading
+from multiprocessing.pool import ThreadPool
+from tool_common import Metrics, log_handler
 import pdb
 
 """ ===========================================================
@@ -30,6 +39,11 @@ NEUTRON_CONF = '/etc/neutron/neutron.conf'
 
 NEUTRON_DB = 'neutron'
 MY_TOUT = 15
+MY_CHUNK = 1000
+MY_BATCH = 500
+MY_COMMIT = 1
+MY_GONE = (2006, 2013)      # CR_SERVER_GONE_ERROR, CR_SERVER_LOST
+MY_DENIED = (1044, 1142, 1143)  # ER_DBACCESS_DENIED_ERROR, ER_TABLEACCESS_DENIED_ERROR, ER_COLUMNACCESS_DENIED_ERROR
 
 DEFAULT_HOST = 'localhost'
 DEFAULT_PORT = 3306
@@ -42,6 +56,14 @@ DEFAULT_DHCP_AGENTS_PER_NETWORK = 2
 KEYSTONE_CONF = '/etc/keystone/keystone.conf'
 KEYSTONE_DB = 'keystone'
 
+SSH_CMD = 'ssh'
+SSH_ERROR = 255
+DEFAULT_SSH_WORKERS = 16
+DEFAULT_SSH_TOUT = 30
+SSH_CONTROL_DIR = '~/.ssh/neutron_tools'
+SSH_CONTROL_PATH = '%C'         # hash of %l%h%p%r, short enough for the socket path limit
+DEFAULT_SSH_PERSIST = 600
+
 """ ===========================================================
 Configurable Parameters
 Initially designed for neutron, but extended for other services.
@@ -70,9 +92,7 @@ class MyConfig(object):
         Read configurable parameters.
         """
         if not os.path.isfile(self.conf_file):
-            logger.warning("%s:%s() %d: missing %s", self.__class__.__name__,
-                           sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                           self.conf_file)
+            logger.warning("missing %s", self.conf_file)
             raise IOError
         self.parser.read(self.conf_file)
         if self.conf_file == NEUTRON_CONF:
@@ -89,17 +109,12 @@ class MyConfig(object):
         try:
             self.agent_down_time = self.parser.getint(section, key1)
         except:
-            logger.warning("%s:%s() %d: %s %s", self.__class__.__name__,
-                           sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                           sys.exc_info()[0], sys.exc_info()[1])
+            logger.warning("%s %s", sys.exc_info()[0], sys.exc_info()[1])
         try:
             self.dhcp_agents_per_network = self.parser.getint(section, key2)
         except:
-            logger.warning("%s:%s() %d: %s %s", self.__class__.__name__,
-                           sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                           sys.exc_info()[0], sys.exc_info()[1])
-        logger.info("%s:%s() %d: read %s, use %s = %d, %s = %d", self.__class__.__name__,
-                    sys._getframe().f_code.co_name, sys._getframe().f_lineno,
+            logger.warning("%s %s", sys.exc_info()[0], sys.exc_info()[1])
+        logger.info("read %s, use %s = %d, %s = %d",
                     os.path.basename(self.conf_file),
                     key1, self.agent_down_time, key2, self.dhcp_agents_per_network)
 
@@ -119,31 +134,101 @@ class MyConfig(object):
             if parsed.password is not None:
                 self.passwd = parsed.password
         except:
-            logger.warning("%s:%s() %d: %s %s", self.__class__.__name__,
-                           sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                           sys.exc_info()[0], sys.exc_info()[1])
-        logger.debug("%s:%s() %d: read %s, use username = %s, password = %s",
-                     self.__class__.__name__,
-                     sys._getframe().f_code.co_name, sys._getframe().f_lineno,
+            logger.warning("%s %s", sys.exc_info()[0], sys.exc_info()[1])
+        logger.debug("read %s, use username = %s, password = %s",
                      os.path.basename(self.conf_file), self.user, self.passwd)
 
+""" ===========================================================
+Metrics
+Timers of the phases of a run: query and fetch rows from mySQL, process
+them, delete them, and ssh to network nodes, with counters of rows and
+hosts, see tool_common.Metrics. ssh runs on several threads, its time is
+the sum over hosts and overlaps the other phases. The metrics are written
+when the run ends.
+=========================================================== """
+METRICS_PREFIX = 'neutron_tools'
+
+metrics = Metrics(METRICS_PREFIX)
+
 """ ===========================================================
 Openstaack mySQL database
+Connections are shared within the process by a pool keyed by
+(host, port, user, db), so each server is connected to once even when
+several subsystems use it. A pooled connection is pinged before reuse
+and replaced when the ping fails.
 =========================================================== """
 
 
+class MyDbPool(object):
+    def __init__(self):
+        self.conns = {}
+        self.lock = threading.Lock()
+
+    def get(self, host, port, user, passwd, tout, db):
+        """
+        Return a live connection to db, reusing a pooled one if healthy.
+        """
+        key = (host, port, user, db)
+        with self.lock:
+            conn = self.conns.get(key)
+            if conn is not None:
+                try:
+                    conn.ping()
+                    logger.debug("reuse connection to %s:%d/%s", host, port, db)
+                    return conn
+                except:
+                    logger.warning("reconnect to %s:%d/%s, %s %s",
+                                   host, port, db, sys.exc_info()[0], sys.exc_info()[1])
+                    self.discard(key)
+            conn = MySQLdb.connect(host=host,
+                                   port=port,
+                                   user=user,
+                                   passwd=passwd,
+                                   db=db,
+                                   connect_timeout=tout)
+            self.conns[key] = conn
+            return conn
+
+    def discard(self, key):
+        """
+        Close and forget the connection for key.
+        """
+        conn = self.conns.pop(key, None)
+        if conn is None:
+            return
+        try:
+            conn.close()
+        except:
+            logger.debug("%s %s", sys.exc_info()[0], sys.exc_info()[1])
+
+    def close(self):
+        """
+        Close all pooled connections.
+        """
+        with self.lock:
+            for key in list(self.conns):
+                self.discard(key)
+
+db_pool = MyDbPool()
+
+
 class MyDb(object):
-    def __init__(self, host, port, user, passwd, tout):
+    def __init__(self, host, port, user, passwd, tout, stream=False, pool=db_pool):
+        """
+        stream      read query results from the server while iterating,
+                    instead of buffering the whole result in memory
+        pool        connection pool to share connections, None for a private connection
+        """
         self.host = host
         self.port = port
         self.user = user
         self.passwd = passwd
         self.tout = tout
+        self.stream = stream
+        self.pool = pool
         self.conn = None
         self.cur = None
-        logger.info("%s:%s() %d: %s:%d, user is %s", self.__class__.__name__,
-                    sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                    self.host, self.port, self.user)
+        logger.info("%s:%d, user is %s, stream is %s", self.host, self.port, self.user, self.stream)
 
     def connect(self, db):
         """
@@ -153,56 +238,432 @@ class MyDb(object):
         """
         self.db = db
         try:
-            logger.debug("%s:%s() %d: connecting to %s", self.__class__.__name__,
-                         sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                         self.db)
-            self.conn = MySQLdb.connect(host=self.host,
-                                        port=self.port,
-                                        user=self.user,
-                                        passwd=self.passwd,
-                                        db=self.db,
-                                        connect_timeout=self.tout)
+            logger.debug("connecting to %s", self.db)
+            if self.pool is not None:
+                self.conn = self.pool.get(self.host, self.port, self.user, self.passwd, self.tout, self.db)
+            else:
+                self.conn = MySQLdb.connect(host=self.host,
+                                            port=self.port,
+                                            user=self.user,
+                                            passwd=self.passwd,
+                                            db=self.db,
+                                            connect_timeout=self.tout)
             self.cur = self.conn.cursor()
-            logger.debug("%s:%s() %d: connected to %s", self.__class__.__name__,
-                         sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                         self.db)
+            logger.debug("connected to %s", self.db)
         except:
-            logger.warning("%s:%s() %d: %s %s", self.__class__.__name__,
-                           sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                           sys.exc_info()[0], sys.exc_info()[1])
+            logger.warning("%s %s", sys.exc_info()[0], sys.exc_info()[1])
             raise
 
+    def rows(self, query, args=None, chunk=MY_CHUNK):
+        """
+        Execute query and iterate over the result, fetching chunk rows at a time.
+        With stream enabled, an unbuffered cursor is used so memory stays flat
+        as the table grows. The result must be consumed before the next query.
+        If the server has gone away, reconnect and execute the query once more.
+        """
+        for attempt in range(2):
+            if self.stream:
+                cur = self.conn.cursor(MySQLdb.cursors.SSCursor)
+            else:
+                cur = self.cur
+            try:
+                with metrics.timer('query'):
+                    cur.execute(query, args)
+                break
+            except MySQLdb.OperationalError:
+                if cur is not self.cur:
+                    cur.close()
+                if attempt > 0 or sys.exc_info()[1].args[0] not in MY_GONE:
+                    raise
+                logger.warning("%s %s, reconnecting", sys.exc_info()[0], sys.exc_info()[1])
+                self.disconnect()
+                self.connect(self.db)
+        try:
+            while True:
+                with metrics.timer('fetch'):
+                    rows = cur.fetchmany(chunk)
+                if not rows:
+                    break
+                metrics.count('rows_fetched', len(rows))
+                for row in rows:
+                    yield row
+        finally:
+            if cur is not self.cur:
+                cur.close()
+
+    def delete(self, table, columns, keys, batch=MY_BATCH, commit=MY_COMMIT, where=None,
+               deleted=None):
+        """
+        Delete rows matching keys from table, many keys per statement.
+        input parameters
+            table:      table name
+            columns:    tuple of key column names
+            keys:       list of tuples of key values, in the order of columns
+            batch:      number of keys per DELETE statement
+            commit:     number of statements per transaction, 0 for a single transaction
+            where:      extra SQL predicate each deleted row must also satisfy
+            deleted:    list extended with the keys known to be deleted, once committed
+        Return number of deleted rows.
+        A statement that deleted fewer rows than it had keys does not tell which
+        of them were missing, so its keys are left out of deleted.
+        Multi-column keys are matched with OR-ed equalities rather than a row
+        constructor IN list, which mysql before 5.7 cannot resolve with an index.
+        """
+        if len(columns) == 1:
+            match = "%s IN (%%s)" % columns[0]
+        else:
+            match = "(%s)" % ' AND '.join(["%s = %%s" % c for c in columns])
+        count = 0
+        pending = 0
+        done = []
+        try:
+            for i in range(0, len(keys), batch):
+                chunk = keys[i:i + batch]
+                if len(columns) == 1:
+                    s = "DELETE FROM %s WHERE %s" % (table, match % ', '.join(['%s'] * len(chunk)))
+                else:
+                    s = "DELETE FROM %s WHERE (%s)" % (table, ' OR '.join([match] * len(chunk)))
+                if where is not None:
+                    s = "%s AND (%s)" % (s, where)
+                args = [value for key in chunk for value in key]
+                start = time.time()
+                with metrics.timer('delete'):
+                    before = self.lock_waits()
+                    num = self.cur.execute(s, args)
+                    count = count + num
+                    pending = pending + 1
+                    if num == len(chunk):
+                        done.extend(chunk)
+                    if commit > 0 and pending >= commit:
+                        self.conn.commit()
+                        pending = 0
+                        if deleted is not None:
+                            deleted.extend(done)
+                        done = []
+                    after = self.lock_waits()
+                duration = time.time() - start
+                metrics.count('rows_deleted', num)
+                metrics.count('delete_statements')
+                if before is not None and after is not None:
+                    metrics.count('row_lock_waits', after[0] - before[0])
+                    metrics.count('row_lock_wait_ms', after[1] - before[1])
+                    logger.info("batch %d deleted %d rows from %s in %.3f seconds, "
+                                "%d row lock waits for %d ms",
+                                i / batch, num, table, duration,
+                                after[0] - before[0], after[1] - before[1])
+                else:
+                    logger.info("batch %d deleted %d rows from %s in %.3f seconds",
+                                i / batch, num, table, duration)
+            if pending > 0:
+                with metrics.timer('delete'):
+                    self.conn.commit()
+                if deleted is not None:
+                    deleted.extend(done)
+        except:
+            logger.warning("%s %s after deleting %d rows from %s",
+                           sys.exc_info()[0], sys.exc_info()[1], count, table)
+            self.conn.rollback()
+            raise
+        return count
+
+    def lock_waits(self):
+        """
+        Return tuple of (number of InnoDB row lock waits, total row lock wait
+        time in milliseconds) since the server started, or None if unavailable.
+        The counters are server wide, so deltas include other sessions.
+        """
+        try:
+            self.cur.execute("SHOW GLOBAL STATUS WHERE Variable_name IN "
+                             "('Innodb_row_lock_waits', 'Innodb_row_lock_time')")
+            status = dict(self.cur.fetchall())
+            return (int(status['Innodb_row_lock_waits']), int(status['Innodb_row_lock_time']))
+        except:
+            logger.debug("%s %s", sys.exc_info()[0], sys.exc_info()[1])
+            return None
+
+    def count(self, table):
+        """
+        Return number of rows in table.
+        """
+        self.cur.execute("SELECT COUNT(*) FROM %s" % table)
+        return self.cur.fetchone()[0]
+
+    def checksum(self, table, columns, where=None):
+        """
+        Return [number of rows, checksum of columns over all rows] of table,
+        or of the rows matching SQL predicate where.
+        The checksum is computed by mysql and does not depend on row order.
+        """
+        s = "SELECT COUNT(*), BIT_XOR(CRC32(CONCAT_WS(',', %s))) FROM %s" % (', '.join(columns), table)
+        if where is not None:
+            s = "%s WHERE %s" % (s, where)
+        self.cur.execute(s)
+        row = self.cur.fetchone()
+        return [int(row[0]), int(row[1] or 0)]
+
     def disconnect(self):
         """
         Disconnect from mysql database.
+        A pooled connection is left open in the pool for reuse.
         """
         if self.conn is None:
             return
         try:
-            self.conn.close()
+            self.cur.close()
+            if self.pool is None:
+                self.conn.close()
             self.conn = None
             self.cur = None
-            logger.debug("%s:%s() %d: disconnected from %s", self.__class__.__name__,
-                         sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                         self.db)
+            logger.debug("disconnected from %s", self.db)
         except:
-            logger.warning("%s:%s() %d: %s %s", self.__class__.__name__,
-                           sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                           sys.exc_info()[0], sys.exc_info()[1])
+            logger.warning("%s %s", sys.exc_info()[0], sys.exc_info()[1])
+
+""" ===========================================================
+Deletion Plan
+A plan records the rows a fast clean up would delete, so it can be reviewed
+and applied later without reading all the tables again. The row count and a
+checksum of the key columns of each table, taken at planning time, are checked
+before applying to refuse a stale plan. The keys carry their own checksum to
+refuse a plan file changed since it was saved.
+Columns may be SQL expressions, so a table is checked on what the plan
+depends on, e.g. whether an agent is alive, not its last heartbeat.
+=========================================================== """
+
+
+class MyPlan(object):
+    def __init__(self, kind, tables=None, keys=None, names=None, where=None):
+        """
+        kind        'dhcp-agent' or 'security-group'
+        tables      dictionary of table name to tuple of key columns to check
+        keys        list of tuples of key values to delete
+        names       dictionary of ID to display name for reporting
+        where       dictionary of table name to SQL predicate of the rows to check
+        """
+        self.kind = kind
+        self.tables = tables or {}
+        self.where = where or {}
+        self.sums = {}
+        self.keys = keys or []
+        self.names = names or {}
+        self.created = int(time.time())
+
+    def snapshot(self, db):
+        """
+        Record the number of rows and checksum of each table at planning time.
+        """
+        self.sums = {}
+        for table in sorted(self.tables):
+            self.sums[table] = db.checksum(table, self.tables[table], self.where.get(table))
+
+    def keysum(self):
+        """
+        Return SHA1 of the sorted keys.
+        """
+        keys = sorted([list(key) for key in self.keys])
+        return hashlib.sha1(json.dumps(keys, separators=(',', ':'))).hexdigest()
+
+    def save(self, path):
+        """
+        Write plan as gzipped JSON.
+        """
+        data = {'kind': self.kind, 'created': self.created, 'tables': self.tables,
+                'where': self.where, 'sums': self.sums, 'keys': self.keys, 'keysum': self.keysum(), 'names': self.names}
+        with gzip.open(path, 'wb') as f:
+            f.write(json.dumps(data, separators=(',', ':')))
+        logger.info("saved %s plan with %d keys to %s", self.kind, len(self.keys), path)
+
+    def load(self, path):
+        """
+        Read plan written by save().
+        """
+        with gzip.open(path, 'rb') as f:
+            data = json.loads(f.read())
+        if data['kind'] != self.kind:
+            logger.warning("%s is a %s plan, not %s", path, data['kind'], self.kind)
+            raise ValueError
+        self.created = data['created']
+        self.tables = data.get('tables', {})
+        self.where = data.get('where', {})
+        self.sums = data.get('sums', {})
+        self.keys = [tuple(key) for key in data['keys']]
+        self.names = data['names']
+        if data.get('keysum') != self.keysum():
+            logger.warning("%s keys do not match their checksum", path)
+            raise ValueError
+        logger.info("loaded %s plan with %d keys from %s", self.kind, len(self.keys), path)
+
+    def is_fresh(self, db):
+        """
+        Return True if every table still has the row count and checksum seen
+        at planning time.
+        """
+        if len(self.sums) == 0:
+            logger.warning("plan has no table checksums")
+            return False
+        fresh = True
+        for table in sorted(self.sums):
+            num, checksum = db.checksum(table, self.tables[table], self.where.get(table))
+            if num != self.sums[table][0]:
+                logger.warning("%s has %d rows, planned with %d", table, num, self.sums[table][0])
+                fresh = False
+            elif checksum != self.sums[table][1]:
+                logger.warning("%s rows changed since planning", table)
+                fresh = False
+        return fresh
+
+""" ===========================================================
+Remote commands over SSH
+Run the same command on many hosts with a bounded pool of workers,
+so the total time depends on the slowest host, not the sum of all hosts.
+Connections are multiplexed over one ControlMaster socket per host, which
+outlives this process for persist seconds, so repeated runs skip the TCP
+and key exchange.
+=========================================================== """
+
+
+class MySsh(object):
+    def __init__(self, cmd=SSH_CMD, workers=DEFAULT_SSH_WORKERS, tout=DEFAULT_SSH_TOUT,
+                 persist=DEFAULT_SSH_PERSIST):
+        """
+        cmd         ssh command, may be replaced by a local fake for testing
+        workers     maximum number of concurrent ssh sessions
+        tout        per-host timeout in seconds
+        persist     seconds to keep an idle master connection, 0 to disable
+        """
+        self.cmd = cmd
+        self.workers = workers
+        self.tout = tout
+        self.persist = persist
+        self.control_dir = os.path.expanduser(SSH_CONTROL_DIR)
+        self.hosts = set()
+        if self.persist > 0 and not os.path.isdir(self.control_dir):
+            try:
+                os.makedirs(self.control_dir, 0700)
+            except OSError:
+                logger.warning("%s %s, disable connection sharing", sys.exc_info()[0], sys.exc_info()[1])
+                self.persist = 0
+        logger.info("%s with %d workers, %d seconds timeout per host, %d seconds persist",
+                    self.cmd, self.workers, self.tout, self.persist)
+
+    def options(self):
+        """
+        Return list of ssh options.
+        """
+        opts = ['-o', 'StrictHostKeyChecking=no']
+        if self.persist > 0:
+            opts = opts + ['-o', 'ControlMaster=auto',
+                           '-o', 'ControlPath=%s' % os.path.join(self.control_dir, SSH_CONTROL_PATH),
+                           '-o', 'ControlPersist=%d' % self.persist]
+        return opts
+
+    def run(self, host, command):
+        """
+        Run command on a single host.
+        Return a tuple of
+            host
+            list of output lines
+            error message, or None on success
+        """
+        args = shlex.split(self.cmd) + [host] + self.options() + [command]
+        self.hosts.add(host)
+        timer = None
+        expired = []
+        start = time.time()
+        try:
+            proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    preexec_fn=os.setsid)
+
+            def expire():
+                expired.append(True)
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+
+            timer = threading.Timer(self.tout, expire)
+            timer.start()
+            out, err = proc.communicate()
+        except:
+            logger.warning("%s %s %s", host, sys.exc_info()[0], sys.exc_info()[1])
+            return (host, [], "%s" % sys.exc_info()[1])
+        finally:
+            if timer is not None:
+                timer.cancel()
+            metrics.add('ssh', time.time() - start)
+            metrics.count('ssh_hosts')
+        duration = time.time() - start
+        if expired:
+            error = "timed out after %d seconds" % self.tout
+        elif proc.returncode == SSH_ERROR:
+            error = err.strip() or "ssh exit status %d" % proc.returncode
+        else:
+            error = None
+        if error is not None:
+            metrics.count('ssh_failed_hosts')
+            logger.warning("%s %s", host, error)
+        logger.debug("%s returned %d lines in %.3f seconds",
+                     host, len(out.splitlines()) if out else 0, duration)
+        return (host, out.splitlines() if out else [], error)
+
+    def run_all(self, hosts, command):
+        """
+        Run command on all hosts concurrently.
+        Return dictionary
+            dictionary key      host name
+            dictionary value    tuple of (list of output lines, error message or None)
+        """
+        results = {}
+        hosts = sorted(set(hosts))
+        if len(hosts) == 0:
+            return results
+        pool = ThreadPool(min(self.workers, len(hosts)))
+        try:
+            for host, lines, error in pool.imap_unordered(lambda h: self.run(h, command), hosts):
+                results[host] = (lines, error)
+        finally:
+            pool.close()
+            pool.join()
+        return results
+
+    def close(self, hosts=None):
+        """
+        Stop the master connection to each host, or to every host used so far.
+        Masters are otherwise left running for reuse by the next invocation.
+        """
+        if self.persist == 0:
+            return
+        if hosts is None:
+            hosts = list(self.hosts)
+        for host in hosts:
+            args = shlex.split(self.cmd) + [host] + self.options() + ['-O', 'exit']
+            try:
+                with open(os.devnull, 'w') as null:
+                    subprocess.call(args, stdout=null, stderr=null)
+            except OSError:
+                logger.warning("%s %s %s", host, sys.exc_info()[0], sys.exc_info()[1])
+            self.hosts.discard(host)
 
 """ ===========================================================
 Neutron DHCP Agent to Network Mapping
 It is easier to process the data, after reading mysql tables to internal lists,
 then to do mysql join.
+With join enabled, the three tables are read in one round trip instead, and
+bindings to disabled networks or agents are filtered by mysql.
 =========================================================== """
 
+AgentDiff = collections.namedtuple('AgentDiff', ['missing_in_netns', 'missing_in_db', 'unknown'])
+
 
 class MyNeutron(object):
-    def __init__(self):
+    def __init__(self, ssh=None, join=False, stream=False, batch=MY_BATCH, commit=MY_COMMIT):
+        self.ssh = ssh if ssh is not None else MySsh()
+        self.join = join
+        self.batch = batch
+        self.commit = commit
         self.config = MyConfig(NEUTRON_CONF, 'database')
         self.config.read()
         self.db = MyDb(self.config.host, self.config.port,
-                       self.config.user, self.config.passwd, MY_TOUT)
+                       self.config.user, self.config.passwd, MY_TOUT, stream)
         try:
             self.db.connect(NEUTRON_DB)
         except:
@@ -214,7 +675,21 @@ class MyNeutron(object):
         self.net_in_agent = {}
         self.del_in_agent_count = {}
         self.net_in_ns = {}
+        self.netns_failed = {}
+        self.diff = {}
 
+    def load(self):
+        """
+        Read dhcp agents, networks and bindings from mySQL.
+        """
+        if self.join:
+            self.get_all()
+        else:
+            self.get_agents()
+            self.get_networks()
+            self.get_bindings()
+
+    @metrics.timed('process')
     def get_agents(self):
         """
         Query all dhcp agents.
@@ -227,11 +702,10 @@ class MyNeutron(object):
         if self.db.cur is None:
             return
         start = time.time()
+        debug = logger.isEnabledFor(logging.DEBUG)
         try:
             s = "SELECT id, host, heartbeat_timestamp FROM agents WHERE topic = 'dhcp_agent' AND admin_state_up = '1'"
-            self.db.cur.execute(s)
-            rows = self.db.cur.fetchall()
-            for row in rows:
+            for row in self.db.rows(s):
                 self.net_in_agent[row[0]] = []
                 self.net_in_ns[row[0]] = []
                 self.agents[row[0]]['host'] = row[1]
@@ -239,21 +713,16 @@ class MyNeutron(object):
                     self.agents[row[0]]['alive'] = False
                 else:
                     self.agents[row[0]]['alive'] = True
-                logger.debug("%s:%s() %d: %s %s", self.__class__.__name__,
-                         sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                         row[0], self.agents[row[0]])
+                if debug:
+                    logger.debug("%s %s", row[0], self.agents[row[0]])
         except:
-            logger.warning("%s:%s() %d: %s %s", self.__class__.__name__,
-                           sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                           sys.exc_info()[0], sys.exc_info()[1])
+            logger.warning("%s %s", sys.exc_info()[0], sys.exc_info()[1])
             raise
         finally:
             duration = time.time() - start
-            logger.info("%s:%s() %d: found %d enabled dhcp agents in %.3f seconds",
-                        self.__class__.__name__,
-                        sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                        len(self.agents), duration)
+            logger.info("found %d enabled dhcp agents in %.3f seconds", len(self.agents), duration)
 
+    @metrics.timed('process')
     def get_networks(self):
         """
         Query all enabled networks.
@@ -264,28 +733,22 @@ class MyNeutron(object):
         if self.db.cur is None:
             return
         start = time.time()
+        debug = logger.isEnabledFor(logging.DEBUG)
         try:
             s = "SELECT id, name from networks WHERE admin_state_up = '1'"
-            self.db.cur.execute(s)
-            rows = self.db.cur.fetchall()
-            for row in rows:
+            for row in self.db.rows(s):
                 self.agent_in_net[row[0]] = []
                 self.networks[row[0]] = row[1]
-                logger.debug("%s:%s() %d: %s %s", self.__class__.__name__,
-                         sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                         row[0], self.networks[row[0]])
+                if debug:
+                    logger.debug("%s %s", row[0], self.networks[row[0]])
         except:
-            logger.warning("%s:%s() %d: %s %s", self.__class__.__name__,
-                           sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                           sys.exc_info()[0], sys.exc_info()[1])
+            logger.warning("%s %s", sys.exc_info()[0], sys.exc_info()[1])
             raise
         finally:
             duration = time.time() - start
-            logger.info("%s:%s() %d: found %d enabled networks in %.3f seconds",
-                        self.__class__.__name__,
-                        sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                        len(self.networks), duration)
+            logger.info("found %d enabled networks in %.3f seconds", len(self.networks), duration)
 
+    @metrics.timed('process')
     def get_bindings(self):
         """
         Query all network to dhcp agent bindings.
@@ -300,118 +763,255 @@ class MyNeutron(object):
             return
         count = 0
         start = time.time()
+        debug = logger.isEnabledFor(logging.DEBUG)
         try:
             s = "SELECT network_id, dhcp_agent_id FROM networkdhcpagentbindings"
-            self.db.cur.execute(s)
-            rows = self.db.cur.fetchall()
-            for row in rows:
+            for row in self.db.rows(s):
+                if row[0] not in self.agent_in_net or row[1] not in self.net_in_agent:
+                    if debug:
+                        logger.debug("skip %s %s in disabled network or agent", row[0], row[1])
+                    continue
                 self.agent_in_net[row[0]].append(row[1])
                 self.net_in_agent[row[1]].append(row[0])
-                logger.debug("%s:%s() %d: %s %s", self.__class__.__name__,
-                         sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                         row[0], row[1])
+                if debug:
+                    logger.debug("%s %s", row[0], row[1])
             for uuid in self.agent_in_net:
                 num = len(self.agent_in_net[uuid])
                 self.agent_in_net_count[str(num)] = self.agent_in_net_count.get(str(num), 0) + 1
                 count = count + 1
         except:
-            logger.warning("%s:%s() %d: %s %s", self.__class__.__name__,
-                           sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                           sys.exc_info()[0], sys.exc_info()[1])
+            logger.warning("%s %s", sys.exc_info()[0], sys.exc_info()[1])
             raise
         finally:
             duration = time.time() - start
-            logger.info("%s:%s() %d: found %d bindings for %d networks in %.3f seconds",
-                        self.__class__.__name__,
-                        sys._getframe().f_code.co_name, sys._getframe().f_lineno,
+            logger.info("found %d bindings for %d networks in %.3f seconds",
                         count, len(self.agent_in_net), duration)
 
-    def rm_bindings(self):
+    @metrics.timed('process')
+    def get_all(self):
         """
-        Delete extra dhcp agents in each network.
+        Query all dhcp agents, enabled networks and bindings between them
+        in a single statement, tagging each row with its source table.
+        Populate self.agents, self.networks, self.agent_in_net,
+        self.net_in_agent and self.agent_in_net_count as in
+        get_agents(), get_networks() and get_bindings().
         """
         if self.db.cur is None:
             return
         count = 0
         start = time.time()
         try:
-            for net in self.agent_in_net:
-                if len(self.agent_in_net[net]) <= self.config.dhcp_agents_per_network:
-                    continue
-                alive = []
-                dead = []
-                del_alive = []
-                del_dead = []
-                for agent in self.agent_in_net[net]:
-                    if self.agents[agent]['alive']:
-                        alive.append(agent)
-                    else:
-                        dead.append(agent)
-                n_extra = len(self.agent_in_net[net]) - self.config.dhcp_agents_per_network
-                n_extra_dead = min(n_extra, len(dead))
-                if n_extra_dead > 0:
-                    del_dead = random.sample(dead, n_extra_dead)
-                n_extra_alive = n_extra - n_extra_dead
-                n_extra_alive = min(n_extra, n_extra_alive)
-                if n_extra_alive > 0:
-                    del_alive = random.sample(alive, n_extra_alive)
-                del_agent = del_dead + del_alive
-                for agent in del_agent:
-                    s = "DELETE FROM networkdhcpagentbindings WHERE network_id = '%s' AND dhcp_agent_id = '%s'" % (net, agent)
-                    self.db.cur.execute(s)
-                    self.del_in_agent_count[agent] = self.del_in_agent_count.get(agent, 0) + 1
+            s = ("SELECT 'a', id, host, heartbeat_timestamp FROM agents "
+                 "WHERE topic = 'dhcp_agent' AND admin_state_up = '1' "
+                 "UNION ALL "
+                 "SELECT 'n', id, name, NULL FROM networks WHERE admin_state_up = '1' "
+                 "UNION ALL "
+                 "SELECT 'b', b.network_id, b.dhcp_agent_id, NULL FROM networkdhcpagentbindings b "
+                 "JOIN networks n ON n.id = b.network_id AND n.admin_state_up = '1' "
+                 "JOIN agents a ON a.id = b.dhcp_agent_id "
+                 "AND a.topic = 'dhcp_agent' AND a.admin_state_up = '1'")
+            now = datetime.utcnow()
+            down = timedelta(seconds=self.config.agent_down_time)
+            for row in self.db.rows(s):
+                if row[0] == 'b':
+                    self.agent_in_net.setdefault(row[1], []).append(row[2])
+                    self.net_in_agent.setdefault(row[2], []).append(row[1])
                     count = count + 1
-                    logger.debug("%s:%s() %d: removing %s from DHCP agent in %s",
-                                 self.__class__.__name__,
-                                 sys._getframe().f_code.co_name, sys._getframe().f_lineno,
+                elif row[0] == 'n':
+                    self.agent_in_net.setdefault(row[1], [])
+                    self.networks[row[1]] = row[2]
+                else:
+                    self.net_in_agent.setdefault(row[1], [])
+                    self.net_in_ns[row[1]] = []
+                    self.agents[row[1]]['host'] = row[2]
+                    self.agents[row[1]]['alive'] = now - row[3] <= down
+            for uuid in self.agent_in_net:
+                num = str(len(self.agent_in_net[uuid]))
+                self.agent_in_net_count[num] = self.agent_in_net_count.get(num, 0) + 1
+        except:
+            logger.warning("%s %s", sys.exc_info()[0], sys.exc_info()[1])
+            raise
+        finally:
+            duration = time.time() - start
+            logger.info("found %d enabled dhcp agents, %d enabled networks "
+                        "and %d bindings in %.3f seconds",
+                        len(self.agents), len(self.networks), count, duration)
+
+    @metrics.timed('process')
+    def plan_bindings(self):
+        """
+        Choose extra dhcp agents to remove from each network, dead agents first.
+        Return list of (network ID, dhcp agent ID)
+        """
+        pairs = []
+        debug = logger.isEnabledFor(logging.DEBUG)
+        for net in self.agent_in_net:
+            if len(self.agent_in_net[net]) <= self.config.dhcp_agents_per_network:
+                continue
+            alive = []
+            dead = []
+            del_alive = []
+            del_dead = []
+            for agent in self.agent_in_net[net]:
+                if self.agents[agent]['alive']:
+                    alive.append(agent)
+                else:
+                    dead.append(agent)
+            n_extra = len(self.agent_in_net[net]) - self.config.dhcp_agents_per_network
+            n_extra_dead = min(n_extra, len(dead))
+            if n_extra_dead > 0:
+                del_dead = random.sample(dead, n_extra_dead)
+            n_extra_alive = n_extra - n_extra_dead
+            n_extra_alive = min(n_extra, n_extra_alive)
+            if n_extra_alive > 0:
+                del_alive = random.sample(alive, n_extra_alive)
+            for agent in del_dead + del_alive:
+                pairs.append((net, agent))
+                if debug:
+                    logger.debug("removing %s from DHCP agent in %s",
                                  self.networks[net], self.agents[agent]['host'])
-                self.db.conn.commit()
+        return pairs
+
+    def rm_bindings(self, pairs=None):
+        """
+        Delete extra dhcp agents in each network.
+        input parameters
+            pairs:      list of (network ID, dhcp agent ID), default from plan_bindings()
+        """
+        if self.db.cur is None:
+            return
+        count = 0
+        start = time.time()
+        try:
+            if pairs is None:
+                pairs = self.plan_bindings()
+            deleted = []
+            count = self.db.delete('networkdhcpagentbindings', ('network_id', 'dhcp_agent_id'),
+                                   pairs, self.batch, self.commit, deleted=deleted)
+            for net, agent in deleted:
+                self.del_in_agent_count[agent] = self.del_in_agent_count.get(agent, 0) + 1
+            if count != len(pairs):
+                msg = "Removed %d of %d planned bindings, %d not counted by agent" % (
+                      count, len(pairs), count - len(deleted))
+                print("%s" % msg)
+                logger.warning("%s", msg)
             for agent in self.del_in_agent_count:
                 msg = "Removed %d networks for DHCP agent in %s" % (
                       self.del_in_agent_count[agent], self.agents[agent]['host'])
                 print("%s" % msg)
-                logger.info("%s:%s() %d: %s", self.__class__.__name__,
-                            sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                            msg)
+                logger.info("%s", msg)
         except:
-            logger.warning("%s:%s() %d: %s %s", self.__class__.__name__,
-                           sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                           sys.exc_info()[0], sys.exc_info()[1])
+            logger.warning("%s %s", sys.exc_info()[0], sys.exc_info()[1])
             raise
         finally:
             duration = time.time() - start
-            msg = "Removed %d network-to-agent bindings in %.3f seconds" % (count, duration)
+            rate = count / duration if duration > 0 else 0
+            msg = "Removed %d network-to-agent bindings in %.3f seconds (%.1f rows/sec)" % (
+                  count, duration, rate)
             print("%s" % msg)
-            logger.info("%s:%s() %d: %s", self.__class__.__name__,
-                        sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                        msg)
+            logger.info("%s", msg)
+
+    def save_plan(self, path):
+        """
+        Save bindings that rm_bindings() would delete, without deleting them.
+        """
+        pairs = self.plan_bindings()
+        hosts = {}
+        for net, agent in pairs:
+            hosts[agent] = self.agents[agent]['host']
+        alive = ("heartbeat_timestamp >= UTC_TIMESTAMP() - INTERVAL %d SECOND" %
+                 self.config.agent_down_time)
+        tables = {'networkdhcpagentbindings': ('network_id', 'dhcp_agent_id'),
+                  'networks': ('id', 'admin_state_up'),
+                  'agents': ('id', 'admin_state_up', alive)}
+        plan = MyPlan('dhcp-agent', tables, pairs, hosts, {'agents': "topic = 'dhcp_agent'"})
+        plan.snapshot(self.db)
+        plan.save(path)
+        print("Planned removal of %d network-to-agent bindings from %d DHCP agents in %s" %
+              (len(pairs), len(hosts), path))
+
+    def apply_plan(self, path):
+        """
+        Delete bindings saved by save_plan(), if mySQL has not changed since.
+        """
+        if self.db.cur is None:
+            return
+        plan = MyPlan('dhcp-agent')
+        plan.load(path)
+        if not plan.is_fresh(self.db):
+            print("Plan in %s is out of date, create a new plan" % path)
+            raise ValueError
+        for agent in plan.names:
+            self.agents[agent]['host'] = plan.names[agent]
+        self.rm_bindings(plan.keys)
 
     def get_netns(self):
         """
         Get all the network namespace in each network node.
+        Populate self.net_in_ns
+            dictionary key      dhcp agent ID
+            dictionary value    list of network ID
+        Populate self.netns_failed
+            dictionary key      dhcp agent ID
+            dictionary value    error message for unreachable or slow host
         """
         count = 0
         start = time.time()
         try:
+            hosts = [self.agents[agent]['host'] for agent in self.agents]
+            results = self.ssh.run_all(hosts, 'ip netns | grep qdhcp')
             for agent in self.agents:
-                c = "ssh %s -o 'StrictHostKeyChecking=no' 'ip netns | grep qdhcp'" % (
-                    self.agents[agent]['host'])
-                pipe = subprocess.Popen(c, shell=True, stdout=subprocess.PIPE).stdout
-                for line in pipe:
+                lines, error = results[self.agents[agent]['host']]
+                if error is not None:
+                    self.netns_failed[agent] = error
+                    continue
+                for line in lines:
                     s = line.strip().split('qdhcp-')
-                    self.net_in_ns[agent].append(s[1])
+                    if len(s) < 2:
+                        continue
+                    self.net_in_ns[agent].append(s[1].split()[0])
                     count = count + 1
         except:
-            logger.warning("%s:%s() %d: %s %s", self.__class__.__name__,
-                           sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                           sys.exc_info()[0], sys.exc_info()[1])
+            logger.warning("%s %s", sys.exc_info()[0], sys.exc_info()[1])
             raise
         finally:
             duration = time.time() - start
-            logger.info("%s:%s() %d: found %d IP network namespace in %.3f seconds",
-                        self.__class__.__name__,
-                        sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                        count, duration)
+            logger.info("found %d IP network namespace in %.3f seconds, %d hosts failed",
+                        count, duration, len(self.netns_failed))
+
+    def show_failed(self):
+        """
+        Display dhcp agents whose network namespace could not be collected.
+        """
+        if len(self.netns_failed) == 0:
+            return
+        print("\nFailed to collect IP network namespace from %d DHCP agents:" % len(self.netns_failed))
+        for agent in sorted(self.netns_failed, key=lambda x: self.agents[x]['host']):
+            print("  %-16s  %s" % (self.agents[agent]['host'], self.netns_failed[agent]))
+
+    @metrics.timed('process')
+    def get_diff(self):
+        """
+        Compare the networks of each dhcp agent in mySQL and ip network namespace.
+        Agents whose network namespace could not be collected are left out.
+        Populate and return self.diff
+            dictionary key      dhcp agent ID
+            dictionary value    AgentDiff of sorted lists of network ID
+                                missing_in_netns    in mySQL but not in ip-netns
+                                missing_in_db       in ip-netns but not in mySQL
+                                unknown             either of above, but not in net-list
+        """
+        self.diff = {}
+        for agent in self.agents:
+            if agent in self.netns_failed:
+                continue
+            in_db = set(self.net_in_agent[agent])
+            in_ns = set(self.net_in_ns[agent])
+            missing_in_netns = in_db - in_ns
+            missing_in_db = in_ns - in_db
+            unknown = set([x for x in missing_in_netns | missing_in_db if x not in self.networks])
+            self.diff[agent] = AgentDiff(sorted(missing_in_netns), sorted(missing_in_db), sorted(unknown))
+        return self.diff
 
     def find_diff(self):
         """
@@ -419,19 +1019,19 @@ class MyNeutron(object):
         """
         count = 0
         try:
-            for agent in self.agents:
-                in_agent = [x for x in self.net_in_agent[agent] if x not in self.net_in_ns[agent]]
-                in_ns = [x for x in self.net_in_ns[agent] if x not in self.net_in_agent[agent]]
-                if len(in_agent) + len(in_ns) > 0:
+            self.get_diff()
+            for agent in self.diff:
+                diff = self.diff[agent]
+                if len(diff.missing_in_netns) + len(diff.missing_in_db) > 0:
                     print("DHCP agent in %s:" % self.agents[agent]['host'])
-                    for net in in_agent:
+                    for net in diff.missing_in_netns:
                         if net in self.networks:
                             print("  %s %s is in mySQL but not in ip-netns" %
                                  (net, self.networks[net]))
                         else:
                             print("  %s is in mySQL but not in net-list" % net)
                         count = count + 1
-                    for net in in_ns:
+                    for net in diff.missing_in_db:
                         if net in self.networks:
                             print("  %s %s is in ip-netns but not in mySQL" %
                                  (net, self.networks[net]))
@@ -439,12 +1039,12 @@ class MyNeutron(object):
                             print("  %s is in ip-netns but not in net-list" % net)
                         count = count + 1
         except:
-            logger.warning("%s:%s() %d: %s %s", self.__class__.__name__,
-                           sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                           sys.exc_info()[0], sys.exc_info()[1])
+            logger.warning("%s %s", sys.exc_info()[0], sys.exc_info()[1])
             raise
         finally:
+            metrics.count('discrepancies', count)
             print("Found %d discrepancies in network-to-agent between mySQL and IP network namespace" % count)
+            self.show_failed()
 
     def show_detail(self):
         print("\nFrom MySQL")
@@ -480,6 +1080,7 @@ class MyNeutron(object):
                  (uuid, self.agents[uuid]['host'], len(self.net_in_ns[uuid])))
             for net in self.net_in_ns[uuid]:
                 print("  %s  %s" % (net, self.networks[net]))
+        self.show_failed()
 
     def show_brief(self):
         print("\nFrom mySQL")
@@ -497,6 +1098,7 @@ class MyNeutron(object):
         for n in sorted(self.net_in_agent):
             print("DHCP agent in %s hosts %d networks" %
                  (self.agents[n]['host'], len(self.net_in_ns[n])))
+        self.show_failed()
 
 """ ===========================================================
 DHCP Agent
@@ -504,34 +1106,45 @@ DHCP Agent
 
 
 class DhcpAgent(object):
-    def __init__(self):
+    def __init__(self, workers=DEFAULT_SSH_WORKERS, tout=DEFAULT_SSH_TOUT,
+                 persist=DEFAULT_SSH_PERSIST, join=False, stream=False,
+                 batch=MY_BATCH, commit=MY_COMMIT):
         try:
-            self.n = MyNeutron()
+            self.n = MyNeutron(MySsh(SSH_CMD, workers, tout, persist), join, stream, batch, commit)
         except:
             print("\nFailed to access neutron database")
             print("Check %s for more details" % LOG_FILE)
 
-    def fast_clean(self):
+    def fast_clean(self, plan=None):
         """
-        Fast clean up
+        Fast clean up, or only save the clean up plan to a file
         """
         try:
-            self.n.get_agents()
-            self.n.get_networks()
-            self.n.get_bindings()
-            self.n.rm_bindings()
+            self.n.load()
+            if plan is None:
+                self.n.rm_bindings()
+            else:
+                self.n.save_plan(plan)
         except:
             print("\nFailed to complete cleaning up dhcp-agent-list-hosting-net")
             print("Check %s for more details" % LOG_FILE)
 
+    def apply(self, plan):
+        """
+        Apply clean up plan from a file
+        """
+        try:
+            self.n.apply_plan(plan)
+        except:
+            print("\nFailed to apply clean up plan for dhcp-agent-list-hosting-net")
+            print("Check %s for more details" % LOG_FILE)
+
     def compare(self):
         """
         Compare mysql with ip network namespace
         """
         try:
-            self.n.get_agents()
-            self.n.get_networks()
-            self.n.get_bindings()
+            self.n.load()
             self.n.get_netns()
             self.n.find_diff()
         except:
@@ -543,9 +1156,7 @@ class DhcpAgent(object):
         Display summary
         """
         try:
-            self.n.get_agents()
-            self.n.get_networks()
-            self.n.get_bindings()
+            self.n.load()
             self.n.get_netns()
             self.n.show_brief()
         except:
@@ -557,9 +1168,7 @@ class DhcpAgent(object):
         Display details
         """
         try:
-            self.n.get_agents()
-            self.n.get_networks()
-            self.n.get_bindings()
+            self.n.load()
             self.n.get_netns()
             self.n.show_detail()
         except:
@@ -570,7 +1179,8 @@ class DhcpAgent(object):
         """
         Display help message
         """
-        print("neutron_tools.py [ -b | -c | -d | -f ] dhcp-agent\n")
+        print("neutron_tools.py [ -b | -c | -d | -f [ -P <plan> ] | -A <plan> ] [ -j ] [ -s ] [ -w <value> ] [ -T <value> ] [ -p <value> ]\n"
+              "                 [ -B <value> ] [ -C <value> ] [ -x <file> ] dhcp-agent\n")
         print("This utility affects 'neutron dhcp-agent-list-hosting-net'.")
         print("  -b --brief            Show summary of networks hosted by DHCP agents from mySQL.")
         print("  -c --compare          Compare network hosted by DHCP agents from mySQL and IP network namespace.")
@@ -578,19 +1188,46 @@ class DhcpAgent(object):
         print("  -f --fastclean        Fast clean up of extra DHCP agents for each enabled network in mySQL.\n"
             "\t\t\tMust restart neutron-dhcp-agent after clean up.\n"
             "\t\t\tRecommend to run this before upgrade with all dhcp agents up and running.")
+        print("  -P --plan             With -f, save the bindings to remove in file PLAN instead of removing them.")
+        print("  -A --apply            Remove the bindings saved in file PLAN, if the bindings, enabled networks\n"
+              "\t\t\tand DHCP agents, enabled or alive, have not changed since.")
+        print("  -B --batch            Number of bindings removed per DELETE statement. Default is %d." % MY_BATCH)
+        print("  -C --commit           Number of DELETE statements per transaction, 0 for one transaction.\n"
+              "\t\t\tDefault is %d." % MY_COMMIT)
+        print("  -j --join             Read agents, networks and bindings from mySQL in one query.")
+        print("  -s --stream           Stream rows from mySQL instead of buffering whole tables in memory.")
+        print("  -w --workers          Number of concurrent ssh sessions to network nodes. Default is %d."
+              % DEFAULT_SSH_WORKERS)
+        print("  -T --timeout          Timeout in seconds for ssh to each network node. Default is %d."
+              % DEFAULT_SSH_TOUT)
+        print("  -p --persist          Seconds to keep ssh connections to network nodes for reuse. Default is %d.\n"
+              "\t\t\tUse 0 to open a new connection on every run." % DEFAULT_SSH_PERSIST)
+        print("  -x --stats            Export query, fetch, process, delete and ssh timers and counters to file.\n"
+              "\t\t\tJSON if it ends in .json, otherwise a Prometheus textfile for the node exporter.")
 
 """ ===========================================================
 Security Groups in Tenants
 It is easier to process the data, after reading mysql tables to internal lists,
 then to do mysql join.
+With keystone join enabled, only the tenants owning security groups are read
+from keystone, by a cross-schema join when both databases are on the same
+server and the neutron user may read keystone, by a second query otherwise.
 =========================================================== """
 
+SG_UNBOUND = ("NOT EXISTS (SELECT 1 FROM securitygroupportbindings b "
+              "WHERE b.security_group_id = securitygroups.id)")
+
 
 class MyTenantSecurityGroup(object):
-    def __init__(self):
-        config = MyConfig(NEUTRON_CONF, 'database')
-        config.read()
-        self.db = MyDb(config.host, config.port, config.user, config.passwd, MY_TOUT)
+    def __init__(self, stream=False, batch=MY_BATCH, commit=MY_COMMIT, keystone=False):
+        self.config = MyConfig(NEUTRON_CONF, 'database')
+        self.config.read()
+        self.stream = stream
+        self.batch = batch
+        self.commit = commit
+        self.keystone = keystone
+        self.db = MyDb(self.config.host, self.config.port, self.config.user, self.config.passwd,
+                       MY_TOUT, stream)
         try:
             self.db.connect(NEUTRON_DB)
         except:
@@ -601,6 +1238,17 @@ class MyTenantSecurityGroup(object):
         self.n_groups_in_tenants = 0
         self.n_groups_in_orphans = 0
 
+    def load(self):
+        """
+        Read tenants from keystone and security groups from neutron.
+        """
+        if self.keystone:
+            self.get_group_tenants()
+        else:
+            self.get_tenants()
+        self.get_secgroups()
+
+    @metrics.timed('process')
     def get_tenants(self):
         """
         Query all tenants, similar to "keystone tenant-list".
@@ -612,7 +1260,7 @@ class MyTenantSecurityGroup(object):
         """
         keystone = MyConfig(KEYSTONE_CONF, 'sql')
         keystone.read()
-        kdb = MyDb(keystone.host, keystone.port, keystone.user, keystone.passwd, MY_TOUT)
+        kdb = MyDb(keystone.host, keystone.port, keystone.user, keystone.passwd, MY_TOUT, self.stream)
         try:
             kdb.connect(KEYSTONE_DB)
         except:
@@ -620,29 +1268,78 @@ class MyTenantSecurityGroup(object):
         if kdb.cur is None:
             return
         start = time.time()
+        debug = logger.isEnabledFor(logging.DEBUG)
         try:
             s = "SELECT id, name FROM project"
-            kdb.cur.execute(s)
-            rows = kdb.cur.fetchall()
-            for row in rows:
+            for row in kdb.rows(s):
                 self.tenants[row[0]]['name'] = row[1]
                 self.tenants[row[0]]['group'] = []
-                logger.debug("%s:%s() %d: %s %s", self.__class__.__name__,
-                             sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                             row[0], self.tenants[row[0]])
+                if debug:
+                    logger.debug("%s %s", row[0], self.tenants[row[0]])
         except:
-            logger.warning("%s:%s() %d: %s %s", self.__class__.__name__,
-                           sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                           sys.exc_info()[0], sys.exc_info()[1])
+            logger.warning("%s %s", sys.exc_info()[0], sys.exc_info()[1])
             raise
         finally:
             kdb.disconnect()
             duration = time.time() - start
-            logger.info("%s:%s() %d: found %d tenants in %.3f seconds",
-                        self.__class__.__name__,
-                        sys._getframe().f_code.co_name, sys._getframe().f_lineno,
+            logger.info("found %d tenants in %.3f seconds", len(self.tenants), duration)
+
+    @metrics.timed('process')
+    def get_group_tenants(self):
+        """
+        Query only the tenants that own security groups.
+        Populate self.tenants as get_tenants() does, without tenants that own
+        no security group. If keystone is on the same server as neutron with
+        the same user, one cross-schema query is used. Otherwise, or if that
+        user may not read keystone, the distinct tenant IDs are looked up in
+        keystone, self.batch at a time.
+        """
+        keystone = MyConfig(KEYSTONE_CONF, 'sql')
+        keystone.read()
+        if self.db.cur is None:
+            return
+        start = time.time()
+        try:
+            joined = False
+            if ((keystone.host, keystone.port, keystone.user) ==
+                    (self.config.host, self.config.port, self.config.user)):
+                s = ("SELECT p.id, p.name FROM %s.project p "
+                     "JOIN (SELECT DISTINCT tenant_id FROM %s.securitygroups) g ON g.tenant_id = p.id" %
+                     (KEYSTONE_DB, NEUTRON_DB))
+                try:
+                    for row in self.db.rows(s):
+                        self.tenants[row[0]]['name'] = row[1]
+                        self.tenants[row[0]]['group'] = []
+                    joined = True
+                except MySQLdb.Error:
+                    if sys.exc_info()[1].args[0] not in MY_DENIED:
+                        raise
+                    logger.warning("%s %s, reading %s separately",
+                                   sys.exc_info()[0], sys.exc_info()[1], KEYSTONE_DB)
+                    self.tenants.clear()
+            if not joined:
+                s = "SELECT DISTINCT tenant_id FROM securitygroups"
+                ids = [row[0] for row in self.db.rows(s) if row[0] is not None]
+                kdb = MyDb(keystone.host, keystone.port, keystone.user, keystone.passwd, MY_TOUT, self.stream)
+                kdb.connect(KEYSTONE_DB)
+                try:
+                    for i in range(0, len(ids), self.batch):
+                        chunk = ids[i:i + self.batch]
+                        s = "SELECT id, name FROM project WHERE id IN (%s)" % ', '.join(['%s'] * len(chunk))
+                        for row in kdb.rows(s, chunk):
+                            self.tenants[row[0]]['name'] = row[1]
+                            self.tenants[row[0]]['group'] = []
+                finally:
+                    kdb.disconnect()
+        except:
+            logger.warning("%s %s", sys.exc_info()[0], sys.exc_info()[1])
+            raise
+        finally:
+            duration = time.time() - start
+            logger.info("found %d tenants owning security groups in %.3f seconds",
                         len(self.tenants), duration)
 
+    @metrics.timed('process')
     def get_secgroups(self):
         """
         Query all security groups, similar to "neutron security-group-list"
@@ -661,67 +1358,96 @@ class MyTenantSecurityGroup(object):
         self.n_groups = 0
         self.n_groups_in_tenants = 0
         self.n_groups_in_orphans = 0
+        debug = logger.isEnabledFor(logging.DEBUG)
         try:
             s = "SELECT tenant_id, name FROM securitygroups"
-            self.db.cur.execute(s)
-            rows = self.db.cur.fetchall()
-            for row in rows:
+            for row in self.db.rows(s):
                 if row[0] in self.tenants:
                     self.tenants[row[0]]['group'].append(row[1])
                     self.n_groups_in_tenants = self.n_groups_in_tenants + 1
-                    logger.debug("%s:%s() %d: %s %s", self.__class__.__name__,
-                                 sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                                 row[0], self.tenants[row[0]])
+                    if debug:
+                        logger.debug("%s %s", row[0], self.tenants[row[0]])
                 else:
                     if row[0] not in self.orphans:
                         self.orphans[row[0]] = []
                     self.orphans[row[0]].append(row[1])
                     self.n_groups_in_orphans = self.n_groups_in_orphans + 1
-                    logger.debug("%s:%s() %d: %s %s", self.__class__.__name__,
-                                 sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                                 row[0], self.orphans[row[0]])
+                    if debug:
+                        logger.debug("%s %s", row[0], self.orphans[row[0]])
                 self.n_groups = self.n_groups + 1
         except:
-            logger.warning("%s:%s() %d: %s %s", self.__class__.__name__,
-                           sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                           sys.exc_info()[0], sys.exc_info()[1])
+            logger.warning("%s %s", sys.exc_info()[0], sys.exc_info()[1])
             raise
         finally:
             duration = time.time() - start
-            logger.info("%s:%s() %d: found %d security groups in %.3f seconds",
-                        self.__class__.__name__,
-                        sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                        self.n_groups, duration)
+            logger.info("found %d security groups in %.3f seconds", self.n_groups, duration)
 
-    def rm_secgroups(self):
+    def rm_secgroups(self, keys=None):
         """
         Chunk delete orphaned security groups
+        input parameters
+            keys:       list of (security group ID,), default from plan_secgroups()
+        A group bound to a port since it was planned is left in place.
         """
         if self.db.cur is None:
             return
         count = 0
         start = time.time()
         try:
-            for tenant in self.orphans:
-                s = "DELETE FROM securitygroups WHERE tenant_id = '%s' AND id NOT IN (SELECT security_group_id FROM securitygroupportbindings)" % (tenant)
-                num = self.db.cur.execute(s)
-                self.db.conn.commit()
-                count = count + num
-                logger.debug("%s:%s() %d: removed %d security groups from tenant %s",
-                             self.__class__.__name__,
-                             sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                             num, tenant)
-        except:
-            logger.warning("%s:%s() %d: %s %s", self.__class__.__name__,
-                           sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                           sys.exc_info()[0], sys.exc_info()[1])
+            if keys is None:
+                keys, names = self.plan_secgroups()
+            count = self.db.delete('securitygroups', ('id',), keys, self.batch, self.commit,
+                                   where=SG_UNBOUND)
+        except:
+            logger.warning("%s %s", sys.exc_info()[0], sys.exc_info()[1])
             raise
         finally:
             duration = time.time() - start
-            logger.info("%s:%s() %d: removed %d security groups in %.3f seconds",
-                        self.__class__.__name__,
-                        sys._getframe().f_code.co_name, sys._getframe().f_lineno,
-                        count, duration)
+            logger.info("removed %d security groups in %.3f seconds", count, duration)
+
+    @metrics.timed('process')
+    def plan_secgroups(self):
+        """
+        Find security groups in deleted tenants that are not bound to any port.
+        The port bindings are scanned once by an anti-join for all tenants.
+        Return list of (security group ID,) and dictionary of ID to "tenant name"
+        """
+        keys = []
+        names = {}
+        s = ("SELECT g.id, g.tenant_id, g.name FROM securitygroups g "
+             "LEFT JOIN securitygroupportbindings b ON b.security_group_id = g.id "
+             "WHERE b.security_group_id IS NULL")
+        for row in self.db.rows(s):
+            if row[1] in self.orphans:
+                keys.append((row[0],))
+                names[row[0]] = "%s %s" % (row[1], row[2])
+        return keys, names
+
+    def save_plan(self, path):
+        """
+        Save security groups that rm_secgroups() would delete, without deleting them.
+        """
+        keys, names = self.plan_secgroups()
+        tables = {'securitygroups': ('id',),
+                  'securitygroupportbindings': ('port_id', 'security_group_id')}
+        plan = MyPlan('security-group', tables, keys, names)
+        plan.snapshot(self.db)
+        plan.save(path)
+        print("Planned removal of %d security groups from %d deleted tenants in %s" %
+              (len(keys), len(self.orphans), path))
+
+    def apply_plan(self, path):
+        """
+        Delete security groups saved by save_plan(), if mySQL has not changed since.
+        """
+        if self.db.cur is None:
+            return
+        plan = MyPlan('security-group')
+        plan.load(path)
+        if not plan.is_fresh(self.db):
+            print("Plan in %s is out of date, create a new plan" % path)
+            raise ValueError
+        self.rm_secgroups(plan.keys)
 
     def show_brief(self):
         print("Total number of security groups                   %d" % self.n_groups)
@@ -749,32 +1475,43 @@ Security Group
 
 
 class SecurityGroup(object):
-    def __init__(self):
+    def __init__(self, stream=False, batch=MY_BATCH, commit=MY_COMMIT, keystone=False):
         try:
-            self.t = MyTenantSecurityGroup()
+            self.t = MyTenantSecurityGroup(stream, batch, commit, keystone)
         except:
             print("\nFailed to access neutron database")
             print("Check %s for more details" % LOG_FILE)
 
-    def fast_clean(self):
+    def fast_clean(self, plan=None):
         """
-        Fast clean up
+        Fast clean up, or only save the clean up plan to a file
         """
         try:
-            self.t.get_tenants()
-            self.t.get_secgroups()
-            self.t.rm_secgroups()
+            self.t.load()
+            if plan is None:
+                self.t.rm_secgroups()
+            else:
+                self.t.save_plan(plan)
         except:
             print("\nFailed to complete cleaning up security-group-list")
             print("Check %s for more details" % LOG_FILE)
 
+    def apply(self, plan):
+        """
+        Apply clean up plan from a file
+        """
+        try:
+            self.t.apply_plan(plan)
+        except:
+            print("\nFailed to apply clean up plan for security-group-list")
+            print("Check %s for more details" % LOG_FILE)
+
     def show_brief(self):
         """
         Display summary
         """
         try:
-            self.t.get_tenants()
-            self.t.get_secgroups()
+            self.t.load()
             self.t.show_brief()
         except:
             print("\nFailed to show brief information related to tenant-list and security-group-list")
@@ -785,8 +1522,7 @@ class SecurityGroup(object):
         Display detailed information
         """
         try:
-            self.t.get_tenants()
-            self.t.get_secgroups()
+            self.t.load()
             self.t.show_detail()
         except:
             print("\nFailed to show detailed information related to tenant-list and security-group-list")
@@ -796,32 +1532,50 @@ class SecurityGroup(object):
         """
         Display help message
         """
-        print("neutron_tools.py [ -b | -d | -f ] security-group\n")
+        print("neutron_tools.py [ -b | -d | -f [ -P <plan> ] | -A <plan> ] [ -K ] [ -s ] [ -B <value> ] [ -C <value> ]\n"
+              "                 [ -x <file> ] security-group\n")
         print("This utility affects 'neutron security-group-list'.")
         print("  -b --brief            Show summary of security groups in tenants from mySQL.")
         print("  -d --detail           Show details of security groups in tenants from mySQL.")
-        print("  -f --fastclean        Fast clean up of security groups not belonged to any tenant in mySQL.\n")
+        print("  -f --fastclean        Fast clean up of security groups not belonged to any tenant in mySQL.")
+        print("  -P --plan             With -f, save the security groups to remove in file PLAN instead of removing them.")
+        print("  -A --apply            Remove the security groups saved in file PLAN, if mySQL has not changed since.")
+        print("  -B --batch            Number of security groups removed per DELETE statement. Default is %d." % MY_BATCH)
+        print("  -C --commit           Number of DELETE statements per transaction, 0 for one transaction.\n"
+              "\t\t\tDefault is %d." % MY_COMMIT)
+        print("  -K --keystone-join    Read only the tenants owning security groups from keystone, joining it\n"
+              "\t\t\tin mySQL when the neutron user may read keystone. -b then counts only those tenants.")
+        print("  -s --stream           Stream rows from mySQL instead of buffering whole tables in memory.")
+        print("  -x --stats            Export query, fetch, process and delete timers and counters to file.\n"
+              "\t\t\tJSON if it ends in .json, otherwise a Prometheus textfile for the node exporter.\n")
 
 """ ===========================================================
 Tests
 =========================================================== """
 
 
-def do_test():
-    print("\nNot implemented")
+def do_test(flags):
+    """
+    Benchmark on synthetic data in a local mySQL, see neutron_bench.py.
+    """
+    sys.modules.setdefault('neutron_tools', sys.modules[__name__])
+    import neutron_bench
+    neutron_bench.do_bench(neutron_bench.default_url(), stream=flags.stream is True,
+                           join=flags.join is True, batch=flags.batch, commit=flags.commit,
+                           keystone=flags.keystone is True)
 
 """ ===========================================================
 Logging
+Messages are only formatted when their level is enabled. The caller and
+line of each message are filled in by the handler, see tool_common.
 =========================================================== """
 logger = logging.getLogger('neutron_tools')
 
 
 def do_logging():
-    formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
-    handler = handlers.RotatingFileHandler(LOG_FILE, maxBytes=10485760, backupCount=3)
+    handler = log_handler(handlers.RotatingFileHandler(LOG_FILE, maxBytes=10485760, backupCount=3))
     logger.addHandler(handler)
     logger.setLevel(logging.INFO)
-    handler.setFormatter(formatter)
 
 """ ===========================================================
 Option Parsing
@@ -830,60 +1584,108 @@ NUM_ARGS = 1
 
 
 def do_parsing():
+    apply_help = "Apply clean up plan saved in file."
+    batch_help = "Number of rows removed per DELETE statement. Default is %d." % MY_BATCH
     brief_help = "Show information summary."
+    commit_help = "Number of DELETE statements per transaction, 0 for one transaction. Default is %d." % MY_COMMIT
     compare_help = "Compare information in different stores."
     detail_help = "Show detailed information."
     fastclean_help = "Fast clean up directly in mySQL."
     help_help = "Show this help message and exit."
-    test_help = "Do not use this option."
+    join_help = "Read related tables in one query."
+    keystone_help = "Read only the tenants owning security groups, joining keystone in mySQL."
+    plan_help = "With fast clean up, save clean up plan in file instead of applying it."
+    persist_help = "Seconds to keep ssh connections for reuse, 0 to disable. Default is %d." % DEFAULT_SSH_PERSIST
+    stats_help = ("Export phase timers and counters to this file, as JSON if it ends in .json, "
+                  "otherwise as a Prometheus textfile.")
+    stream_help = "Stream rows from mySQL instead of buffering whole tables."
+    test_help = "Benchmark on synthetic data in a local mySQL."
+    timeout_help = "Timeout in seconds for ssh to each host. Default is %d." % DEFAULT_SSH_TOUT
+    workers_help = "Number of concurrent ssh sessions. Default is %d." % DEFAULT_SSH_WORKERS
 
     parser = OptionParser(add_help_option=False)
+    parser.add_option('-A', '--apply', action='store', dest='apply', help=apply_help, metavar='PLAN')
+    parser.add_option('-B', '--batch', action='store', dest='batch', help=batch_help, metavar='BATCH',
+                      type='int', default=MY_BATCH)
     parser.add_option('-b', '--brief', action='store_true', dest='brief', help=brief_help, metavar='BRIEF')
     parser.add_option('-c', '--compare', action='store_true', dest='compare', help=compare_help, metavar='COMPARE')
+    parser.add_option('-C', '--commit', action='store', dest='commit', help=commit_help, metavar='COMMIT',
+                      type='int', default=MY_COMMIT)
     parser.add_option('-d', '--detail', action='store_true', dest='detail', help=detail_help, metavar='DETAIL')
     parser.add_option('-f', '--fastclean', action='store_true', dest='fast', help=fastclean_help, metavar='FAST')
     parser.add_option('-h', '--help', action='store_true', dest='help', help=help_help, metavar='HELP')
+    parser.add_option('-j', '--join', action='store_true', dest='join', help=join_help, metavar='JOIN')
+    parser.add_option('-K', '--keystone-join', action='store_true', dest='keystone', help=keystone_help,
+                      metavar='KEYSTONE')
+    parser.add_option('-P', '--plan', action='store', dest='plan', help=plan_help, metavar='PLAN')
+    parser.add_option('-p', '--persist', action='store', dest='persist', help=persist_help, metavar='PERSIST',
+                      type='int', default=DEFAULT_SSH_PERSIST)
+    parser.add_option('-s', '--stream', action='store_true', dest='stream', help=stream_help, metavar='STREAM')
     parser.add_option('-t', '--test', action='store_true', dest='test', help=test_help, metavar='TEST')
+    parser.add_option('-T', '--timeout', action='store', dest='timeout', help=timeout_help, metavar='TIMEOUT',
+                      type='int', default=DEFAULT_SSH_TOUT)
+    parser.add_option('-w', '--workers', action='store', dest='workers', help=workers_help, metavar='WORKERS',
+                      type='int', default=DEFAULT_SSH_WORKERS)
+    parser.add_option('-x', '--stats', action='store', dest='stats', help=stats_help, metavar='FILE')
 
     def usage():
         parser.print_help()
         print "\nSupported Operations:"
-        print "  neutron_tools.py [ -b | -c | -d | -f ] dhcp-agent"
-        print "  neutron_tools.py [ -b | -d | -f ] security-group"
+        print "  neutron_tools.py [ -b | -c | -d | -f [ -P <plan> ] | -A <plan> ] [ -j ] [ -s ]"
+        print "                   [ -w <value> ] [ -T <value> ] [ -p <value> ] [ -B <value> ] [ -C <value> ] [ -x <file> ]"
+        print "                   dhcp-agent"
+        print "  neutron_tools.py [ -b | -d | -f [ -P <plan> ] | -A <plan> ] [ -K ] [ -s ] [ -B <value> ] [ -C <value> ]"
+        print "                   [ -x <file> ] security-group"
+        print "  neutron_tools.py -t [ -j ] [ -K ] [ -s ] [ -B <value> ] [ -C <value> ]"
         print "More Helps:"
         print "  neutron_tools.py -h dhcp-agent"
         print "  neutron_tools.py -h security-group"
         sys.exit()
 
     flags, args = parser.parse_args()
+    metrics.path = flags.stats
+
+    if flags.batch < 1 or flags.commit < 0:
+        logger.error("invalid batch %d or commit %d", flags.batch, flags.commit)
+        print("\nBatch must be at least 1 and commit at least 0!\n")
+        usage()
 
     if flags.help and len(args) == 0:
         usage()
 
     if flags.test:
-        do_test()
+        do_test(flags)
         sys.exit()
 
     if len(args) != NUM_ARGS:
-        logger.error("%s() %d: expect %i, get %i arguments!",
-                     __name__, sys._getframe().f_lineno, NUM_ARGS, len(args))
+        logger.error("expect %i, get %i arguments!", NUM_ARGS, len(args))
         print("\nExpect %i, get %i arguments!\n" % (NUM_ARGS, len(args)))
         usage()
 
     if (args[0] != 'dhcp-agent' and
         args[0] != 'security-group'):
-        logger.error("%s() %d: unsupported argument",
-                     __name__, sys._getframe().f_lineno)
+        logger.error("unsupported argument")
         print("\nUnsupported argument!\n")
         usage()
 
+    if flags.plan is not None and flags.fast is None:
+        logger.error("plan without fast clean up")
+        print("\nOption -P needs -f!\n")
+        usage()
+
+    if ((args[0] == 'dhcp-agent' and flags.keystone is True) or
+        (args[0] == 'security-group' and flags.join is True)):
+        logger.error("join option does not apply to %s", args[0])
+        print("\nOption -j is for dhcp-agent and -K for security-group!\n")
+        usage()
+
     if args[0] == 'dhcp-agent':
-        agent = DhcpAgent()
+        agent = DhcpAgent(flags.workers, flags.timeout, flags.persist,
+                          flags.join is True, flags.stream is True, flags.batch, flags.commit)
         if (flags.brief is None and flags.compare is None and
             flags.detail is None and flags.fast is None and
-            flags.help is None):
-            logger.error("%s() %d: missing or invalid options",
-                         __name__, sys._getframe().f_lineno)
+            flags.apply is None and flags.help is None):
+            logger.error("missing or invalid options")
             print("\nMissing or invalid options!\n")
             usage()
         if flags.help:
@@ -895,13 +1697,15 @@ def do_parsing():
         elif flags.compare is True:
             agent.compare()
         elif flags.fast is True:
-            agent.fast_clean()
+            agent.fast_clean(flags.plan)
+        elif flags.apply is not None:
+            agent.apply(flags.apply)
     elif args[0] == 'security-group':
-        sec = SecurityGroup()
+        sec = SecurityGroup(flags.stream is True, flags.batch, flags.commit, flags.keystone is True)
         if (flags.brief is None and flags.detail is None and
-            flags.fast is None and flags.help is None):
-            logger.error("%s() %d: missing or invalid options",
-                         __name__, sys._getframe().f_lineno)
+            flags.fast is None and flags.apply is None and
+            flags.help is None):
+            logger.error("missing or invalid options")
             print("\nMissing or invalid options!\n")
             usage()
         if flags.help:
@@ -911,7 +1715,9 @@ def do_parsing():
         elif flags.detail is True:
             sec.show_detail()
         elif flags.fast is True:
-            sec.fast_clean()
+            sec.fast_clean(flags.plan)
+        elif flags.apply is not None:
+            sec.apply(flags.apply)
 
 """ ===========================================================
 Main Program.
@@ -919,4 +1725,8 @@ Main Program.
 
 if __name__ == "__main__":
     do_logging()
-    do_parsing()
+    try:
+        do_parsing()
+    finally:
+        db_pool.close()
+        metrics.export()
@@ -0,0 +1,495 @@
+#! /usr/bin/python
+#
+# File:     test_dns_tools.py
+# Brief:    Tests of dns_tools.py.
+#
+# Copyright (c) 2015, Cisco Systems
+
+import os
+import random
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+import dns_tools
+
+""" ===========================================================
+Canned packets
+A fake resolver answers the CHAOS TXT queries on a local UDP socket, as
+dnsmasq does, with the name of the answer compressed to the question.
+=========================================================== """
+
+ANSWERS = {'misses.bind': ['120'], 'hits.bind': ['30'], 'cachesize.bind': ['150'],
+           'evictions.bind': ['4'], 'insertions.bind': ['90'],
+           'servers.bind': ['8.8.8.8#53 100 2', '1.1.1.1#53 20 0']}
+
+
+def question_name(packet):
+    """
+    Return the name asked by query packet, and the offset after its question.
+    """
+    offset = 12
+    labels = []
+    while ord(packet[offset]) != 0:
+        length = ord(packet[offset])
+        labels.append(packet[offset + 1:offset + 1 + length])
+        offset = offset + 1 + length
+    return '.'.join(labels), offset + 5
+
+
+def txt_response(query, strings):
+    """
+    Return response packet to query with a TXT answer of strings, if any.
+    """
+    qid = struct.unpack('!H', query[:2])[0]
+    name, end = question_name(query)
+    answers = ''
+    if strings is not None:
+        data = ''.join(chr(len(string)) + string for string in strings)
+        answers = '\xc0\x0c' + struct.pack('!HHIH', dns_tools.TXT_TYPE, dns_tools.CHAOS_CLASS,
+                                           0, len(data)) + data
+    return (struct.pack('!HHHHHH', qid, 0x8400, 1, 1 if answers else 0, 0, 0) +
+            query[12:end] + answers)
+
+
+class FakeResolver(object):
+    def __init__(self, answers):
+        self.answers = answers
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                query, address = self.sock.recvfrom(512)
+            except socket.error:
+                return
+            name = question_name(query)[0]
+            self.sock.sendto(txt_response(query, self.answers.get(name)), address)
+
+    def opener(self, pid, port):
+        """
+        Open a socket to the resolver for any pid, as DnsStats opener.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(0)
+        sock.connect(('127.0.0.1', self.port))
+        return sock
+
+    def close(self):
+        self.sock.close()
+
+""" ===========================================================
+Canned syslog
+Cache dumps of two dnsmasq interleave line by line, with lines of other
+programs between them, as in syslog. Parsing all lines at once is the
+oracle for parsing them in pieces.
+=========================================================== """
+
+SYSLOG_HEAD = 'Feb 26 17:33:49 net-001 '
+SYSLOG_START = 1424972000
+
+
+def dump(pid, ts, forwarded, local, servers=()):
+    """
+    Return lines of the cache dump of dnsmasq pid at time stamp ts.
+    """
+    head = SYSLOG_HEAD + 'dnsmasq[%d]: ' % pid
+    lines = [head + 'time %d\n' % ts,
+             head + 'cache size 150, 0/%d cache insertions re-used unexpired cache entries.\n' % local,
+             head + 'queries forwarded %d, queries answered locally %d\n' % (forwarded, local)]
+    for i, (sent, failed) in enumerate(servers):
+        lines.append(head + 'server 10.%d.0.1#53: queries sent %d, retried or failed %d\n' % (i, sent, failed))
+    return lines
+
+
+def syslog(count=6, start=SYSLOG_START, step=300):
+    """
+    Return lines of count cache dumps of dnsmasq 100 and 200, every step seconds.
+    """
+    lines = []
+    for i in range(count):
+        a = dump(100, start + i * step, 10 * i, i, [(5 * i, 0)])
+        b = dump(200, start + i * step + 1, 20 * i, 2 * i, [(7 * i, i // 2), (3 * i, 0)])
+        for j in range(len(b)):
+            lines.extend(a[j:j + 1] + b[j:j + 1])
+        lines.append(SYSLOG_HEAD + 'kernel: eth0: link up\n')
+    return lines
+
+
+def parsed(lines, since=0):
+    """
+    Return Parser with metrics of all lines at once.
+    """
+    parser = dns_tools.Parser(since, True)
+    parser.parse(lines)
+    return parser
+
+
+def results(parser):
+    return parser.data, parser.cache, parser.servers, parser.pending, parser.last
+
+""" ===========================================================
+Tests
+=========================================================== """
+
+
+class ChaosQueryTest(unittest.TestCase):
+    def test_query(self):
+        packet = dns_tools.chaos_query(3, 'hits.bind')
+        self.assertEqual(packet[:12], struct.pack('!HHHHHH', 3, 0, 1, 0, 0, 0))
+        self.assertEqual(packet[12:], '\x04hits\x04bind\x00' + struct.pack('!HH', 16, 3))
+        self.assertEqual(question_name(packet), ('hits.bind', len(packet)))
+
+
+class TxtAnswerTest(unittest.TestCase):
+    def test_answer(self):
+        query = dns_tools.chaos_query(5, 'servers.bind')
+        packet = txt_response(query, ANSWERS['servers.bind'])
+        self.assertEqual(dns_tools.txt_answer(packet), (5, ANSWERS['servers.bind']))
+
+    def test_no_answer(self):
+        query = dns_tools.chaos_query(1, 'hits.bind')
+        self.assertEqual(dns_tools.txt_answer(txt_response(query, None)), (1, []))
+
+    def test_uncompressed_name(self):
+        query = dns_tools.chaos_query(2, 'hits.bind')
+        data = '\x0230'
+        packet = (struct.pack('!HHHHHH', 2, 0x8400, 1, 1, 0, 0) + query[12:] + query[12:-4] +
+                  struct.pack('!HHIH', 16, 3, 0, len(data)) + data)
+        self.assertEqual(dns_tools.txt_answer(packet), (2, ['30']))
+
+    def test_truncated(self):
+        packet = txt_response(dns_tools.chaos_query(0, 'misses.bind'), ['120'])
+        self.assertRaises((struct.error, IndexError), dns_tools.txt_answer, packet[:20])
+
+
+class SampleTest(unittest.TestCase):
+    def test_sample(self):
+        sample = dns_tools.DnsStats().sample(ANSWERS)
+        self.assertEqual(sample, [[120, 30], [150, 4, 90], {'8.8.8.8#53': [100, 2], '1.1.1.1#53': [20, 0]}])
+
+    def test_no_servers(self):
+        answer = dict((name, strings) for name, strings in ANSWERS.items() if name != 'servers.bind')
+        self.assertEqual(dns_tools.DnsStats().sample(answer)[2], {})
+
+    def test_incomplete(self):
+        answer = dict(ANSWERS)
+        del answer['hits.bind']
+        self.assertEqual(dns_tools.DnsStats().sample(answer), None)
+        answer = dict(ANSWERS, **{'misses.bind': ['many']})
+        self.assertEqual(dns_tools.DnsStats().sample(answer), None)
+        answer = dict(ANSWERS, **{'servers.bind': ['8.8.8.8#53 100']})
+        self.assertEqual(dns_tools.DnsStats().sample(answer), None)
+
+
+class QueryTest(unittest.TestCase):
+    def test_query(self):
+        resolver = FakeResolver(ANSWERS)
+        try:
+            stats = dns_tools.DnsStats(tout=2, opener=resolver.opener)
+            samples = stats.query([100, 200])
+        finally:
+            resolver.close()
+        self.assertEqual(sorted(samples), [100, 200])
+        self.assertEqual(samples[100], stats.sample(ANSWERS))
+
+    def test_unanswered(self):
+        answers = dict(ANSWERS)
+        del answers['cachesize.bind']
+        resolver = FakeResolver(answers)
+        try:
+            samples = dns_tools.DnsStats(tout=0.5, opener=resolver.opener).query([100])
+        finally:
+            resolver.close()
+        self.assertEqual(samples, {})
+
+    def test_unopened(self):
+        stats = dns_tools.DnsStats(tout=0.5, opener=lambda pid, port: None)
+        self.assertEqual(stats.query([100]), {})
+
+
+
+class MergeTest(unittest.TestCase):
+    def setUp(self):
+        self.lines = syslog()
+        self.expected = results(parsed(self.lines))
+
+    def test_two_pieces(self):
+        for i in range(len(self.lines) + 1):
+            head = parsed(self.lines[:i])
+            head.merge(parsed(self.lines[i:]))
+            self.assertEqual(results(head), self.expected, "split at line %d" % i)
+
+    def test_three_pieces(self):
+        for i in range(len(self.lines) + 1):
+            for j in range(i, len(self.lines) + 1):
+                head = parsed(self.lines[:i])
+                head.merge(parsed(self.lines[i:j]))
+                head.merge(parsed(self.lines[j:]))
+                self.assertEqual(results(head), self.expected, "split at lines %d and %d" % (i, j))
+
+    def test_chunks(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'syslog')
+            with open(path, 'w') as f:
+                f.writelines(self.lines)
+            for size in (1, 40, 97, 500, 4096):
+                parser = dns_tools.Parser(0, True)
+                for chunk in dns_tools.split_chunks(path, size, 0, 0, True):
+                    parser.merge(dns_tools.parse_chunk(chunk))
+                self.assertEqual(results(parser), self.expected, "chunks of %d bytes" % size)
+                self.assertEqual(parser.lines, len(self.lines))
+        finally:
+            shutil.rmtree(tmp)
+
+
+class SeekTest(unittest.TestCase):
+    def setUp(self):
+        self.lines = syslog()
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'syslog')
+        with open(self.path, 'w') as f:
+            f.writelines(self.lines)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def first_at(self, ts):
+        """
+        Return offset of the first time stamp at or after ts, by reading every line.
+        """
+        offset = 0
+        for line in self.lines:
+            m = dns_tools.DUMP_RE.match(line)
+            if m is not None and m.group(2) is not None and int(m.group(2)) >= ts:
+                return offset
+            offset = offset + len(line)
+        return offset
+
+    def test_boundaries(self):
+        times = sorted(set(ts for values in parsed(self.lines).data.values() for ts in values))
+        for ts in [0] + times + [ts - 1 for ts in times] + [ts + 1 for ts in times]:
+            self.assertEqual(dns_tools.seek_time(self.path, ts), self.first_at(ts), "time stamp %d" % ts)
+
+    def test_parse_from_seek(self):
+        for ts in (SYSLOG_START, SYSLOG_START + 1, SYSLOG_START + 300, SYSLOG_START + 599, SYSLOG_START + 10 ** 6):
+            parser = dns_tools.Parser(ts, True)
+            with open(self.path) as f:
+                f.seek(dns_tools.seek_time(self.path, ts))
+                parser.parse(f)
+            self.assertEqual(results(parser), results(parsed(self.lines, ts)), "time stamp %d" % ts)
+
+    def test_empty(self):
+        open(self.path, 'w').close()
+        self.assertEqual(dns_tools.seek_time(self.path, SYSLOG_START), 0)
+
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.text = ''.join(syslog())
+        self.expected = parsed(syslog())
+        self.tmp = tempfile.mkdtemp()
+        self.log = os.path.join(self.tmp, 'syslog')
+        self.saved = dns_tools.CHECKPOINT_DIR, dns_tools.CHECKPOINT_KEEP
+        dns_tools.CHECKPOINT_DIR = os.path.join(self.tmp, 'checkpoint/')
+        dns_tools.CHECKPOINT_KEEP = 10 ** 10
+
+    def tearDown(self):
+        dns_tools.CHECKPOINT_DIR, dns_tools.CHECKPOINT_KEEP = self.saved
+        shutil.rmtree(self.tmp)
+
+    def extract(self):
+        """
+        Return Extract of the log from its checkpoint, as a new run would.
+        """
+        extract = dns_tools.Extract(self.log, incremental=True, metrics=True)
+        extract.get_data()
+        return extract
+
+    def check(self, extract, message):
+        self.assertEqual((extract.data, extract.cache, extract.servers),
+                         (self.expected.data, self.expected.cache, self.expected.servers), message)
+
+    def test_follow(self):
+        open(self.log, 'w').close()
+        for i in range(0, len(self.text), 150):
+            with open(self.log, 'a') as f:
+                f.write(self.text[i:i + 150])
+            extract = self.extract()
+        self.check(extract, "appended 150 bytes at a time")
+
+    def test_rotation(self):
+        # syslog writes whole lines, so the log is rotated at the end of a line
+        for cut in range(0, len(self.text), 73):
+            end = self.text.find('\n', cut) + 1
+            for rotate in (end, end + len(self.text[end:].split('\n', 1)[0]) + 1, len(self.text)):
+                shutil.rmtree(dns_tools.CHECKPOINT_DIR, True)
+                with open(self.log, 'w') as f:
+                    f.write(self.text[:cut])
+                self.extract()
+                with open(self.log, 'a') as f:
+                    f.write(self.text[cut:rotate])
+                os.rename(self.log, self.log + '.1')
+                with open(self.log, 'w') as f:
+                    f.write(self.text[rotate:])
+                self.check(self.extract(), "checkpoint at byte %d, rotated at byte %d" % (cut, rotate))
+
+
+class HistogramTest(unittest.TestCase):
+    def test_buckets(self):
+        data = parsed(syslog(24, step=120)).data
+        for interval in (1, 5, 15, 60):
+            period = interval * 60
+            buckets = {}
+            series = {}
+            for pid in data:
+                times = sorted(data[pid])
+                for before, ts in zip(times, times[1:]):
+                    delta = data[pid][ts] - data[pid][before]
+                    buckets[ts // period * period] = buckets.get(ts // period * period, 0) + delta
+                    series[str(pid)] = series.get(str(pid), 0) + delta
+            histogram = dns_tools.Samples(data).histogram(interval)
+            self.assertEqual(list(histogram.items()), sorted(buckets.items()), "%d minutes" % interval)
+            self.assertEqual(histogram.total, sum(buckets.values()))
+            self.assertEqual(histogram.series, series)
+            self.assertEqual(histogram.first, SYSLOG_START // period * period)
+            self.assertEqual(histogram.last, max(buckets))
+
+    def test_empty(self):
+        histogram = dns_tools.Samples({}).histogram(5)
+        self.assertEqual((list(histogram.items()), histogram.total, histogram.first), ([], 0, None))
+        histogram = dns_tools.Samples({100: {SYSLOG_START: 10}}).histogram(5)
+        self.assertEqual((list(histogram.items()), histogram.total, histogram.first),
+                         ([], 0, SYSLOG_START // 300 * 300))
+
+
+class DeltaTest(unittest.TestCase):
+    def setUp(self):
+        t = SYSLOG_START
+        self.data = {100: {t: 10, t + 300: 30, t + 600: 5, t + 900: 15},
+                     101: {t + 1200: 7, t + 1500: 20},
+                     200: {t: 0, t + 300: 4, t + 600: 9, t + 3600: 50, t + 3900: 60},
+                     300: {t + 60: 3}}
+        self.networks = {100: 'a', 101: 'a', 200: 'b'}
+
+    def lookup(self, pid, ts):
+        return self.networks.get(pid)
+
+    def deltas(self, **kwargs):
+        samples = dns_tools.Samples(self.data, self.lookup)
+        tms, owners, deltas, first, resets, restarts, gaps = samples.deltas(**kwargs)
+        rows = [(samples.keys[owners[i]], tms[i] - SYSLOG_START, deltas[i]) for i in range(len(tms))]
+        return rows, first, resets, restarts, gaps
+
+    def test_deltas(self):
+        rows = [('a', 300, 20), ('a', 600, 5), ('a', 900, 10), ('a', 1200, 7), ('a', 1500, 13),
+                ('b', 300, 4), ('b', 600, 5), ('b', 3900, 10)]
+        self.assertEqual(self.deltas(), (rows, SYSLOG_START, 1, 1, 1))
+
+    def test_max_gap(self):
+        self.assertEqual(dns_tools.Samples(self.data, self.lookup).max_gap(), dns_tools.GAP_FACTOR * 300)
+        rows, first, resets, restarts, gaps = self.deltas(max_gap=3000)
+        self.assertEqual(gaps, 0)
+        self.assertTrue(('b', 3600, 41) in rows)
+
+    def test_histogram(self):
+        histogram = dns_tools.Samples(self.data, self.lookup).histogram(15)
+        base = SYSLOG_START // 900 * 900
+        self.assertEqual(list(histogram.items()), [(base, 34), (base + 900, 30), (base + 3600, 10)])
+        self.assertEqual(histogram.series, {'a': 55, 'b': 19, '300': 0})
+        self.assertEqual((histogram.resets, histogram.restarts, histogram.gaps), (1, 1, 1))
+
+
+class RollupTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.saved = dns_tools.STORE_FILE, dns_tools.SERVERS_FILE, dns_tools.ROLLUP_FILE
+        dns_tools.STORE_FILE = os.path.join(self.tmp, 'samples.dat')
+        dns_tools.SERVERS_FILE = os.path.join(self.tmp, 'servers.dat')
+        dns_tools.ROLLUP_FILE = os.path.join(self.tmp, 'rollup.json')
+        self.start = int(time.time()) // 3600 * 3600 - 30 * 3600
+        self.gap = range(200, 220)
+        store = dns_tools.Store(dns_tools.STORE_FILE, dns_tools.SAMPLE_FIELDS)
+        rollup = dns_tools.Rollup(dns_tools.ROLLUP_FILE, store)
+        rng = random.Random(7)
+        counters = [0, 0, 0]
+        for k in range(30 * 12):
+            rows = []
+            for i in range(len(counters)):
+                counters[i] = counters[i] + rng.randint(1, 20)
+                if i == 1 and k == 100:
+                    counters[i] = 3
+                pid = 1000 + i + (10 if i == 2 and k >= 150 else 0)
+                rows.append([self.start + 300 * k, pid, store.number('network', 'net-%d' % i),
+                             counters[i], 0, 150, 0, 0])
+            if k not in self.gap:
+                store.append(rows)
+                rollup.update()
+
+    def tearDown(self):
+        dns_tools.STORE_FILE, dns_tools.SERVERS_FILE, dns_tools.ROLLUP_FILE = self.saved
+        shutil.rmtree(self.tmp)
+
+    def histograms(self, interval, ts=0):
+        """
+        Return Extract of the rollup, and histogram of the samples for the same -i and -t.
+        """
+        rolled = dns_tools.Extract(ts=ts, interval=interval, series=True)
+        rolled.get_data()
+        rolled.get_histogram()
+        raw = dns_tools.Extract(ts=ts, interval=interval, series=True, networks=True)
+        raw.get_data()
+        return rolled, raw.get_histogram()
+
+    def test_tiers(self):
+        for interval in (5, 15, 60, 1440):
+            rolled, raw = self.histograms(interval)
+            self.assertTrue(rolled.rolled_up is not None, "%d minutes" % interval)
+            buckets = dict(rolled.histogram.items())
+            self.assertEqual([(tm, buckets[tm]) for tm, queries in raw.items()], list(raw.items()))
+            self.assertEqual(sum(buckets.values()), raw.total, "%d minutes" % interval)
+            self.assertTrue(set(queries for tm, queries in buckets.items() if tm not in dict(raw.items())) <=
+                            set([0]), "%d minutes" % interval)
+
+    def test_since(self):
+        ts = self.start + 5 * 3600
+        rolled, raw = self.histograms(60, ts)
+        self.assertTrue(rolled.rolled_up is not None)
+        whole = self.histograms(60)[1]
+        self.assertEqual([item for item in rolled.histogram.items() if item[1] > 0],
+                         [item for item in whole.items() if item[0] >= ts])
+
+    def test_misaligned_since(self):
+        ts = self.start + 5 * 3600 + 30
+        rolled, raw = self.histograms(60, ts)
+        self.assertEqual(rolled.rolled_up, None)
+        self.assertEqual(list(rolled.histogram.items()), list(raw.items()))
+
+    def test_quietest_minute(self):
+        rolled = self.histograms(60)[0].histogram
+        prior = self.start + 300 * (self.gap[0] - 1)
+        empty = set(tm // 3600 * 3600 for tm in range(prior + 300, self.start + 300 * self.gap[-1] + 300, 300))
+        for i, tm in enumerate(rolled.times):
+            self.assertEqual(rolled.minima[i] == 0, tm in empty, "hour at %d" % tm)
+
+    def test_expire(self):
+        store = dns_tools.Store(dns_tools.STORE_FILE, dns_tools.SAMPLE_FIELDS)
+        collect = dns_tools.Collect()
+        collect.expire(store, self.start + dns_tools.STORE_PRUNE)
+        self.assertEqual(store.first(), self.start)
+        collect.expire(store, self.start + dns_tools.STORE_PRUNE + 3600)
+        self.assertEqual(store.first(), self.start + dns_tools.STORE_PRUNE + 3600)
+
+
+if __name__ == '__main__':
+    unittest.main()
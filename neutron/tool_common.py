@@ -0,0 +1,174 @@
+#! /usr/bin/python
+#
+# File:     tool_common.py
+# Brief:    Metrics and logging shared by neutron_tools.py and dns_tools.py.
+#
+# Copyright (c) 2015, Cisco Systems
+
+import logging
+import sys
+import os
+import time
+import collections
+import contextlib
+import functools
+import json
+import threading
+
+""" ===========================================================
+Metrics
+Named timers and counters of the phases of a run. A timer leaves the time
+of timers nested in it on the same thread to them, so the phases timed on
+the thread of the run add up to its time. A phase timed on several
+threads at once is the sum over the threads, and overlaps the others.
+The metrics are written as a Prometheus textfile for the node exporter,
+or as JSON.
+=========================================================== """
+
+
+class Metrics(object):
+    def __init__(self, prefix, name=None):
+        """
+        prefix      prefix of the Prometheus metric names
+        name        name of the logger to report to, prefix by default
+        """
+        self.prefix = prefix
+        self.logger = logging.getLogger(name or prefix)
+        self.path = None
+        self.start = time.time()
+        self.seconds = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+        self.counts = collections.defaultdict(int)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        """
+        Time the block as phase.
+        """
+        stack = self.local.__dict__.setdefault('stack', [])
+        stack.append(0.0)
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] = stack[-1] + duration
+            self.add(phase, duration - nested)
+
+    def timed(self, phase):
+        """
+        Decorate a function to run under timer phase.
+        """
+        def decorate(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(phase):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    def add(self, phase, seconds):
+        """
+        Add seconds to phase, for time measured outside a timer.
+        """
+        with self.lock:
+            self.seconds[phase] = self.seconds[phase] + seconds
+            self.calls[phase] = self.calls[phase] + 1
+
+    def count(self, name, num=1):
+        """
+        Add num to counter name.
+        """
+        with self.lock:
+            self.counts[name] = self.counts[name] + num
+
+    def text(self):
+        """
+        Return metrics in Prometheus text format.
+        """
+        p = self.prefix
+        lines = ["# HELP %s_run_seconds Duration of the last run." % p,
+                 "# TYPE %s_run_seconds gauge" % p,
+                 "%s_run_seconds %.6f" % (p, time.time() - self.start),
+                 "# HELP %s_last_run_timestamp_seconds End time of the last run." % p,
+                 "# TYPE %s_last_run_timestamp_seconds gauge" % p,
+                 "%s_last_run_timestamp_seconds %d" % (p, time.time()),
+                 "# HELP %s_phase_seconds Time spent in each phase of the last run." % p,
+                 "# TYPE %s_phase_seconds gauge" % p]
+        for phase in sorted(self.seconds):
+            lines.append('%s_phase_seconds{phase="%s"} %.6f' % (p, phase, self.seconds[phase]))
+        lines = lines + ["# HELP %s_phase_calls Number of times each phase ran in the last run." % p,
+                         "# TYPE %s_phase_calls gauge" % p]
+        for phase in sorted(self.calls):
+            lines.append('%s_phase_calls{phase="%s"} %d' % (p, phase, self.calls[phase]))
+        for name in sorted(self.counts):
+            lines = lines + ["# TYPE %s_%s gauge" % (p, name),
+                             "%s_%s %d" % (p, name, self.counts[name])]
+        return '\n'.join(lines) + '\n'
+
+    def json(self):
+        """
+        Return metrics in JSON.
+        """
+        return json.dumps({'run_seconds': time.time() - self.start, 'timestamp': int(time.time()),
+                           'phase_seconds': self.seconds, 'phase_calls': self.calls,
+                           'counts': self.counts}, indent=2, sort_keys=True) + '\n'
+
+    def export(self):
+        """
+        Write metrics to self.path, as JSON if it ends in .json, if a path is set.
+        The file is replaced at once, so a collector never reads half of it.
+        """
+        if self.path is None:
+            return
+        self.logger.info("%s", ', '.join(["%s %.3f seconds" % (phase, self.seconds[phase])
+                                          for phase in sorted(self.seconds)]))
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                f.write(self.json() if self.path.endswith('.json') else self.text())
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            self.logger.warning("%s %s", sys.exc_info()[0], sys.exc_info()[1])
+
+""" ===========================================================
+Logging
+Messages are only formatted when their level is enabled. The caller of
+each message, as Class:function, is then looked up from the frame that
+logged it, so the log keeps telling apart the load() or run() of each
+class without any cost for messages below the level.
+=========================================================== """
+LOG_FORMAT = '%(asctime)s %(levelname)s %(caller)s() %(lineno)d: %(message)s'
+
+
+class CallerFilter(logging.Filter):
+    def filter(self, record):
+        """
+        Set record.caller to Class:function of the method that logged
+        record, or to the function name outside a class.
+        """
+        record.caller = record.funcName
+        frame = sys._getframe(1)
+        while frame is not None:
+            code = frame.f_code
+            if (frame.f_lineno == record.lineno and code.co_name == record.funcName and
+                    code.co_filename == record.pathname):
+                owner = frame.f_locals.get('self')
+                if owner is not None:
+                    record.caller = "%s:%s" % (owner.__class__.__name__, record.funcName)
+                break
+            frame = frame.f_back
+        return True
+
+
+def log_handler(handler):
+    """
+    Return handler set up with LOG_FORMAT and CallerFilter.
+    """
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handler.addFilter(CallerFilter())
+    return handler